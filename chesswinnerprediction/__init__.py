@@ -1,5 +1,32 @@
-from chesswinnerprediction.dataloader.download_pgn_zst import download_file as download_pgn_zst_file
-from chesswinnerprediction.dataloader.pgn_zst_to_csv import pgn_zst_to_dataframe
-from chesswinnerprediction.processing.process_and_concat_raw_data import process_and_concat_raw_data
-from chesswinnerprediction.visualization.visualization import plot_pie, plot_draw_percentage_by_base_time
+import importlib
 
+# The modules behind these names import pandas, sklearn and matplotlib, so they are only imported
+# on first use, e.g. a scoring worker that needs just models.compact_model starts without them.
+_EXPORTS = {
+    "download_pgn_zst_file": (
+        "chesswinnerprediction.dataloader.download_pgn_zst",
+        "download_file",
+    ),
+    "pgn_zst_to_dataframe": ("chesswinnerprediction.dataloader.pgn_zst_to_csv", None),
+    "process_and_concat_raw_data": (
+        "chesswinnerprediction.processing.process_and_concat_raw_data",
+        None,
+    ),
+    "pgn_zst_to_features": ("chesswinnerprediction.processing.pgn_zst_to_features", None),
+    "plot_pie": ("chesswinnerprediction.visualization.visualization", None),
+    "plot_draw_percentage_by_base_time": (
+        "chesswinnerprediction.visualization.visualization",
+        None,
+    ),
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attribute = _EXPORTS[name]
+    value = getattr(importlib.import_module(module_name), attribute or name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,205 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from sklearn.base import ClassifierMixin
+from sklearn.metrics import ConfusionMatrixDisplay
+
+from chesswinnerprediction.baseline.constants import BASELINE_RANDOM_STATE
+from chesswinnerprediction.constants import RESULTS_STR_TO_STR
+
+BOOTSTRAP_METRICS = ["log_loss", "balanced_accuracy", "accuracy"]
+
+
+def _safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=np.float64)
+    return np.divide(
+        numerator, denominator, out=np.full_like(numerator, np.nan), where=denominator > 0
+    )
+
+
+def classification_table(conf_matrix, classes):
+    """
+    classification_report of sklearn as a DataFrame, computed from the confusion matrix.
+
+    :param conf_matrix: counts of (true class, predicted class)
+    :return: DataFrame with precision, recall, f1-score and support of every class and their
+        macro and weighted averages
+    """
+    support = conf_matrix.sum(axis=1)
+    n_predicted = conf_matrix.sum(axis=0)
+    true_positives = np.diag(conf_matrix)
+    # NaN for a class that is never predicted, as with zero_division=np.nan in print_report
+    precision = _safe_divide(true_positives, n_predicted)
+    recall = _safe_divide(true_positives, support)
+    f1 = _safe_divide(2 * true_positives, support + n_predicted)
+
+    table = pd.DataFrame(
+        {"precision": precision, "recall": recall, "f1-score": f1, "support": support},
+        index=list(classes),
+    )
+    # the averages leave the NaN scores out
+    scores = np.column_stack([precision, recall, f1])
+    is_known = ~np.isnan(scores)
+    weights = support[:, np.newaxis] * is_known
+    table.loc["macro avg"] = [*np.nanmean(scores, axis=0), support.sum()]
+    weighted_sums = (np.where(is_known, scores, 0) * weights).sum(axis=0)
+    weighted_scores = np.divide(
+        weighted_sums,
+        weights.sum(axis=0),
+        out=np.zeros(scores.shape[1]),
+        where=weights.sum(axis=0) > 0,
+    )
+    table.loc["weighted avg"] = [*weighted_scores, support.sum()]
+    table["support"] = table["support"].astype(np.int64)
+    return table
+
+
+class EvaluationResult:
+    """
+    Metrics of one split, computed from the probabilities of a single predict_proba call.
+
+    Without y_pred the predicted class is the most probable one, as in predict of the sklearn
+    classifiers, so the model is not asked for predictions again. Confidence intervals are
+    percentile bootstrap intervals: every replicate resamples the games with replacement and
+    recomputes the metrics from the cached losses and confusion cells.
+
+    :param classes: classes in the order of the columns of proba, model.classes_
+    :param y_true: true labels
+    :param proba: (n_games, n_classes) probabilities
+    :param y_pred: optional predicted labels, for models whose predict is not the argmax of
+        predict_proba, e.g. the hierarchical double-stage Model of the baseline notebooks
+    :param n_bootstrap: number of bootstrap replicates, 0 - no intervals
+    :param confidence: confidence level of the intervals
+    :param random_state: seed of the bootstrap
+    :param eps: probabilities are clipped to [eps, 1] in the log loss
+    """
+
+    def __init__(
+        self,
+        classes,
+        y_true,
+        proba,
+        y_pred=None,
+        n_bootstrap=200,
+        confidence=0.95,
+        random_state=BASELINE_RANDOM_STATE,
+        eps=1e-15,
+    ):
+        self.classes = np.asarray(classes)
+        n_classes = len(self.classes)
+        self.y_codes = self._codes(y_true)
+        self.proba = np.asarray(proba)
+        if y_pred is None:
+            self.predicted_codes = np.argmax(self.proba, axis=1)
+        else:
+            self.predicted_codes = self._codes(y_pred)
+        true_proba = self.proba[np.arange(len(self.y_codes)), self.y_codes]
+        self.losses = -np.log(np.clip(true_proba, eps, 1))
+        self.cells = self.y_codes * n_classes + self.predicted_codes
+
+        self.confusion_matrix = self._confusion_matrix()
+        self.report = classification_table(self.confusion_matrix, self.classes)
+        self.metrics = self._metrics(self.losses.mean(), self.confusion_matrix)
+        self.intervals = self._bootstrap(n_bootstrap, confidence, random_state)
+
+    def _codes(self, labels):
+        class_index = {label: idx for idx, label in enumerate(self.classes)}
+        labels = np.asarray(labels)
+        unknown = set(np.unique(labels)) - set(class_index)
+        if unknown:
+            raise ValueError(f"Labels {sorted(unknown)} are not in the classes of the model")
+        return pd.Series(labels).map(class_index).to_numpy(dtype=np.int64)
+
+    @property
+    def n_games(self):
+        return len(self.y_codes)
+
+    @property
+    def predictions(self):
+        return self.classes[self.predicted_codes]
+
+    def _confusion_matrix(self, weights=None):
+        n_classes = len(self.classes)
+        counts = np.bincount(self.cells, weights, minlength=n_classes**2)
+        return counts.astype(np.int64).reshape(n_classes, n_classes)
+
+    @staticmethod
+    def _metrics(log_loss, conf_matrix):
+        recalls = _safe_divide(np.diag(conf_matrix), conf_matrix.sum(axis=1))
+        return {
+            "log_loss": float(log_loss),
+            # classes without games are left out, as in balanced_accuracy_score
+            "balanced_accuracy": float(np.nanmean(recalls)),
+            "accuracy": float(np.trace(conf_matrix) / max(conf_matrix.sum(), 1)),
+        }
+
+    def _bootstrap(self, n_bootstrap, confidence, random_state):
+        if not n_bootstrap or not self.n_games:
+            return {}
+        rng = np.random.default_rng(random_state)
+        replicates = {metric: np.empty(n_bootstrap) for metric in BOOTSTRAP_METRICS}
+        for replicate in range(n_bootstrap):
+            # the number of times every game is drawn
+            draws = np.bincount(
+                rng.integers(self.n_games, size=self.n_games), minlength=self.n_games
+            )
+            conf_matrix = self._confusion_matrix(draws)
+            metrics = self._metrics(draws @ self.losses / self.n_games, conf_matrix)
+            for metric, value in metrics.items():
+                replicates[metric][replicate] = value
+
+        tail = (1 - confidence) / 2 * 100
+        return {
+            metric: tuple(np.percentile(values, [tail, 100 - tail]).tolist())
+            for metric, values in replicates.items()
+        }
+
+    def summary(self, prefix=""):
+        """Flat dict of the metrics and interval bounds, e.g. for mlflow.log_metrics."""
+        summary = {f"{prefix}{metric}": value for metric, value in self.metrics.items()}
+        for metric, (low, high) in self.intervals.items():
+            summary[f"{prefix}{metric}_low"] = low
+            summary[f"{prefix}{metric}_high"] = high
+        return summary
+
+
+def evaluate_model(
+    model,
+    splits,
+    n_bootstrap=200,
+    confidence=0.95,
+    random_state=BASELINE_RANDOM_STATE,
+    use_predict=None,
+):
+    """
+    Scores every split with one predict_proba call, and one predict call if use_predict.
+
+    :param splits: dict of split name to (x, y), e.g. {"train": (X_train, y_train), ...}
+    :param use_predict: take the predicted classes from model.predict instead of the argmax of
+        predict_proba, None - only for models that are not sklearn classifiers, e.g. the
+        double-stage Model of the baseline notebooks
+    :return: dict of split name to EvaluationResult
+    """
+    if use_predict is None:
+        use_predict = not isinstance(model, ClassifierMixin)
+    return {
+        name: EvaluationResult(
+            model.classes_,
+            y,
+            model.predict_proba(x),
+            y_pred=model.predict(x) if use_predict else None,
+            n_bootstrap=n_bootstrap,
+            confidence=confidence,
+            random_state=random_state,
+        )
+        for name, (x, y) in splits.items()
+    }
+
+
+def plot_confusion_matrix(result, title="Confusion Matrix"):
+    labels = [RESULTS_STR_TO_STR.get(label, label) for label in result.classes]
+    ConfusionMatrixDisplay(result.confusion_matrix, display_labels=labels).plot(cmap="Blues")
+    plt.xlabel("Predicted")
+    plt.ylabel("Actual")
+    plt.title(title)
+    plt.show()
@@ -0,0 +1,202 @@
+import json
+import os
+
+import numpy as np
+
+from chesswinnerprediction.baseline.constants import BASELINE_COLUMNS, columns_to_scale
+
+TARGET_COLUMN = "Result"
+CATEGORY_COLUMN = "Event"
+NUMERIC_COLUMNS = [
+    column for column in BASELINE_COLUMNS if column not in (TARGET_COLUMN, CATEGORY_COLUMN)
+]
+
+
+def event_name(event):
+    # tournament games have the tournament url after the event name
+    return event.split(" http")[0]
+
+
+def header_columns(data):
+    """
+    Numeric baseline columns computed from game headers.
+
+    :param data: DataFrame or dict of arrays with WhiteElo, BlackElo and either TimeControl
+        ("180+2") or BaseTime and IncrementTime
+    :return: dict of float64 arrays
+    """
+    white_elo = np.asarray(data["WhiteElo"], dtype=np.float64)
+    black_elo = np.asarray(data["BlackElo"], dtype=np.float64)
+    if "BaseTime" in data and "IncrementTime" in data:
+        base_time = np.asarray(data["BaseTime"], dtype=np.float64)
+        increment_time = np.asarray(data["IncrementTime"], dtype=np.float64)
+    else:
+        time_controls = [time_control.split("+") for time_control in data["TimeControl"]]
+        base_time, increment_time = np.array(time_controls, dtype=np.float64).reshape(-1, 2).T
+
+    return {
+        "WhiteElo": white_elo,
+        "BlackElo": black_elo,
+        "EloDiff": white_elo - black_elo,
+        "MeanElo": (white_elo + black_elo) / 2,
+        "BaseTime": base_time,
+        "IncrementTime": increment_time,
+        "ZeroIncrementTime": (increment_time == 0).astype(np.float64),
+    }
+
+
+class FeatureTransformer:
+    """
+    Frozen version of baseline.utils.transform_and_scale_df.
+
+    fit locks the column layout, the Event vocabulary and the scaling of columns_to_scale, so
+    every later batch, even a single game, gets the same float32 matrix layout as the training
+    data: the NUMERIC_COLUMNS in the BASELINE_COLUMNS order followed by one column per training
+    event, an unknown event has all of them 0. Scaling is the one of StandardScaler.
+
+    :param numeric_columns: numeric feature columns, see header_columns
+    :param scaled_columns: columns to standardize
+    """
+
+    def __init__(self, numeric_columns=None, scaled_columns=None):
+        self.numeric_columns = list(numeric_columns or NUMERIC_COLUMNS)
+        self.scaled_columns = list(scaled_columns or columns_to_scale)
+        self.events = []
+        self.means = np.zeros(len(self.numeric_columns))
+        self.scales = np.ones(len(self.numeric_columns))
+
+        self._n_fitted = 0
+        self._m2 = np.zeros(len(self.numeric_columns))
+        self._event_set = set()
+        self._freeze()
+
+    @property
+    def feature_names(self):
+        return self.numeric_columns + self.events
+
+    def partial_fit(self, data):
+        """Adds a chunk of training games to the statistics, e.g. read with iter_data_file_chunks."""
+        columns = header_columns(data)
+        values = np.column_stack([columns[column] for column in self.numeric_columns])
+        n_chunk = len(values)
+        if not n_chunk:
+            return self
+
+        # Chan's update of the running mean and sum of squared deviations
+        chunk_means = values.mean(axis=0)
+        chunk_m2 = ((values - chunk_means) ** 2).sum(axis=0)
+        n_total = self._n_fitted + n_chunk
+        delta = chunk_means - self.means
+        self.means = self.means + delta * n_chunk / n_total
+        self._m2 += chunk_m2 + delta**2 * self._n_fitted * n_chunk / n_total
+        self._n_fitted = n_total
+
+        self._event_set.update(event_name(event) for event in set(data[CATEGORY_COLUMN]))
+        self.events = sorted(self._event_set)
+        self._freeze()
+        return self
+
+    def fit(self, data):
+        self._n_fitted = 0
+        self.means = np.zeros(len(self.numeric_columns))
+        self._m2 = np.zeros(len(self.numeric_columns))
+        self._event_set = set()
+        return self.partial_fit(data)
+
+    def _freeze(self):
+        """Precomputes the arrays used by transform."""
+        std = np.sqrt(self._m2 / max(self._n_fitted, 1))
+        is_scaled = np.array([column in self.scaled_columns for column in self.numeric_columns])
+        # a constant column is only centered, as in StandardScaler
+        self.scales = np.where(is_scaled & (std > 0), std, 1.0)
+        self._offsets = np.where(is_scaled, self.means, 0.0)
+        self._event_index = {event: idx for idx, event in enumerate(self.events)}
+        self._sorted_events = np.array(self.events, dtype=object)
+        self._row = np.zeros((1, len(self.feature_names)), dtype=np.float32)
+
+    def transform(self, data, out=None):
+        """
+        :param data: DataFrame or dict of arrays with the header_columns inputs and Event
+        :param out: optional preallocated float32 array of shape (n_games, n_features) to fill
+        :return: float32 feature matrix
+        """
+        n_numeric = len(self.numeric_columns)
+        columns = header_columns(data)
+        n_games = len(columns["WhiteElo"])
+        if out is None:
+            out = np.empty((n_games, len(self.feature_names)), dtype=np.float32)
+
+        for idx, column in enumerate(self.numeric_columns):
+            out[:, idx] = (columns[column] - self._offsets[idx]) / self.scales[idx]
+
+        out[:, n_numeric:] = 0
+        if self.events:
+            events = np.array([event_name(event) for event in data[CATEGORY_COLUMN]], dtype=object)
+            positions = np.searchsorted(self._sorted_events, events)
+            positions = np.minimum(positions, len(self.events) - 1)
+            is_known = self._sorted_events[positions] == events
+            rows = np.flatnonzero(is_known)
+            out[rows, n_numeric + positions[is_known]] = 1
+        return out
+
+    def transform_game(self, headers):
+        """
+        Features of one game from its PGN headers, e.g. {"WhiteElo": "1500", "BlackElo": "1450",
+        "Event": "Rated Blitz game", "TimeControl": "180+0"}, without pandas or array allocations.
+
+        :return: (1, n_features) float32 array, reused by the next call
+        """
+        white_elo, black_elo = float(headers["WhiteElo"]), float(headers["BlackElo"])
+        base_time, increment_time = headers["TimeControl"].split("+")
+        base_time, increment_time = float(base_time), float(increment_time)
+        values = {
+            "WhiteElo": white_elo,
+            "BlackElo": black_elo,
+            "EloDiff": white_elo - black_elo,
+            "MeanElo": (white_elo + black_elo) / 2,
+            "BaseTime": base_time,
+            "IncrementTime": increment_time,
+            "ZeroIncrementTime": float(increment_time == 0),
+        }
+
+        row, n_numeric = self._row[0], len(self.numeric_columns)
+        for idx, column in enumerate(self.numeric_columns):
+            row[idx] = (values[column] - self._offsets[idx]) / self.scales[idx]
+        row[n_numeric:] = 0
+        event_idx = self._event_index.get(event_name(headers["Event"]))
+        if event_idx is not None:
+            row[n_numeric + event_idx] = 1
+        return self._row
+
+    def state(self):
+        """JSON-serialisable state of the transformer, see from_state."""
+        return {
+            "numeric_columns": self.numeric_columns,
+            "scaled_columns": self.scaled_columns,
+            "events": self.events,
+            "n_fitted": self._n_fitted,
+            "means": self.means.tolist(),
+            "m2": self._m2.tolist(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        transformer = cls(state["numeric_columns"], state["scaled_columns"])
+        transformer.events = state["events"]
+        transformer._event_set = set(state["events"])
+        transformer._n_fitted = state["n_fitted"]
+        transformer.means = np.array(state["means"])
+        transformer._m2 = np.array(state["m2"])
+        transformer._freeze()
+        return transformer
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as transformer_file:
+            json.dump(self.state(), transformer_file, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as transformer_file:
+            return cls.from_state(json.load(transformer_file))
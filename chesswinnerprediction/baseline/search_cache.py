@@ -0,0 +1,219 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import (
+    HalvingRandomSearchCV,
+    PredefinedSplit,
+    RandomizedSearchCV,
+    StratifiedKFold,
+)
+
+from chesswinnerprediction.baseline.constants import BASELINE_RANDOM_STATE
+from chesswinnerprediction.baseline.feature_transformer import TARGET_COLUMN, FeatureTransformer
+from chesswinnerprediction.baseline.streaming_trainer import TRAINING_COLUMNS
+from chesswinnerprediction.constants import DRAW_STR
+from chesswinnerprediction.processing.processing_cache import file_content_hash
+from chesswinnerprediction.processing.utils import iter_data_file_chunks
+
+# bump to invalidate the caches when the layout of the matrix changes
+SEARCH_CACHE_VERSION = 1
+X_FILE, Y_FILE, FOLDS_FILE = "x.npy", "y.npy", "test_fold.npy"
+TRANSFORMER_FILE, META_FILE = "transformer.json", "meta.json"
+
+
+def _iter_training_chunks(file_path, predict_draws, chunk_size):
+    for chunk in iter_data_file_chunks(file_path, chunk_size, TRAINING_COLUMNS):
+        if not predict_draws:
+            chunk = chunk[chunk[TARGET_COLUMN] != DRAW_STR]
+        if len(chunk):
+            yield chunk
+
+
+def build_search_cache(
+    file_path,
+    cache_dir,
+    predict_draws=True,
+    n_splits=5,
+    random_state=BASELINE_RANDOM_STATE,
+    chunk_size=125000,
+):
+    """
+    Writes the feature matrix of a processed file and its CV folds to cache_dir.
+
+    The matrix is the one of transform_and_scale_df (see FeatureTransformer) as a float32 ".npy"
+    file filled one chunk at a time, the labels are int8 codes of the sorted classes and the folds
+    are the StratifiedKFold test fold of every game. meta.json is written last, so a build that
+    did not finish is never loaded.
+
+    :param file_path: processed ".csv" or ".parquet" training file
+    :param cache_dir: directory of the cache, created if needed
+    :param predict_draws: keep the draws, as in get_x_and_y
+    :param n_splits: number of CV folds
+    :param random_state: seed of the folds
+    :param chunk_size: number of games read at once
+    :return: meta dict of the cache
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    transformer = FeatureTransformer()
+    labels = []
+    for chunk in _iter_training_chunks(file_path, predict_draws, chunk_size):
+        transformer.partial_fit(chunk)
+        labels.append(chunk[TARGET_COLUMN].to_numpy(dtype=str))
+    labels = np.concatenate(labels or [np.array([], dtype=str)])
+    classes, y = np.unique(labels, return_inverse=True)
+    y = y.astype(np.int8)
+
+    n_games, n_features = len(y), len(transformer.feature_names)
+    x = np.lib.format.open_memmap(
+        os.path.join(cache_dir, X_FILE), mode="w+", dtype=np.float32, shape=(n_games, n_features)
+    )
+    start = 0
+    for chunk in _iter_training_chunks(file_path, predict_draws, chunk_size):
+        stop = start + len(chunk)
+        transformer.transform(chunk, out=x[start:stop])
+        start = stop
+    x.flush()
+    del x
+
+    test_fold = np.empty(n_games, dtype=np.int8)
+    folds = StratifiedKFold(n_splits, shuffle=True, random_state=random_state)
+    for fold, (_, test_idx) in enumerate(folds.split(np.zeros((n_games, 1)), y)):
+        test_fold[test_idx] = fold
+    np.save(os.path.join(cache_dir, Y_FILE), y)
+    np.save(os.path.join(cache_dir, FOLDS_FILE), test_fold)
+    transformer.save(os.path.join(cache_dir, TRANSFORMER_FILE))
+
+    meta = {
+        "key": search_cache_key(file_path, predict_draws, n_splits, random_state),
+        "n_games": n_games,
+        "classes": classes.tolist(),
+        "feature_names": transformer.feature_names,
+    }
+    meta_path = os.path.join(cache_dir, META_FILE)
+    with open(meta_path + ".tmp", "w") as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
+    return meta
+
+
+def search_cache_key(file_path, predict_draws, n_splits, random_state):
+    """Changes with the content of the file and every parameter of the cached arrays."""
+    return (
+        f"{SEARCH_CACHE_VERSION}_{file_content_hash(file_path)}"
+        f"_{int(predict_draws)}_{n_splits}_{random_state}"
+    )
+
+
+class SearchCache:
+    """
+    Memory-mapped feature matrix, labels and CV folds of build_search_cache.
+
+    x is opened read-only, so joblib sends the workers of a search a reference to the file instead
+    of a pickled copy of the matrix (with both the default loky and the "multiprocessing" backend),
+    and the operating system keeps one copy of it in the page cache for all of them.
+    """
+
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        self.cache_dir = cache_dir
+        self.classes = np.array(self.meta["classes"], dtype=object)
+        self.feature_names = self.meta["feature_names"]
+        self.x = np.load(os.path.join(cache_dir, X_FILE), mmap_mode="r")
+        self.y_codes = np.load(os.path.join(cache_dir, Y_FILE))
+        self.test_fold = np.load(os.path.join(cache_dir, FOLDS_FILE))
+        self.transformer = FeatureTransformer.load(os.path.join(cache_dir, TRANSFORMER_FILE))
+
+    @property
+    def x_frame(self):
+        """x as a DataFrame without a copy, so the fitted models get feature_names_in_."""
+        return pd.DataFrame(self.x, columns=self.feature_names, copy=False)
+
+    @property
+    def y(self):
+        return pd.Series(self.classes[self.y_codes], name=TARGET_COLUMN)
+
+    @property
+    def cv(self):
+        return PredefinedSplit(self.test_fold)
+
+
+def load_search_cache(
+    file_path,
+    cache_dir,
+    predict_draws=True,
+    n_splits=5,
+    random_state=BASELINE_RANDOM_STATE,
+    chunk_size=125000,
+):
+    """
+    Opens the cache of the file, it is built first if it is missing or was built from another
+    file or with other parameters, see build_search_cache.
+    """
+    key = search_cache_key(file_path, predict_draws, n_splits, random_state)
+    meta_path = os.path.join(cache_dir, META_FILE)
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    if meta is None or meta["key"] != key:
+        print(f"Building the search cache of {file_path} in {cache_dir}")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        build_search_cache(file_path, cache_dir, predict_draws, n_splits, random_state, chunk_size)
+    return SearchCache(cache_dir)
+
+
+def cached_search(
+    estimator,
+    param_distributions,
+    cache,
+    halving=False,
+    n_iter=10,
+    factor=3,
+    min_resources="exhaust",
+    scoring="balanced_accuracy",
+    n_jobs=-1,
+    random_state=BASELINE_RANDOM_STATE,
+    **search_kwargs,
+):
+    """
+    RandomizedSearchCV, or HalvingRandomSearchCV with halving=True, on a SearchCache.
+
+    Successive halving fits n_iter candidates on min_resources games, then keeps the best
+    1 / factor of them for the next round with factor times more games, until the last round
+    uses all of them. The fitted search has the usual cv_results_, best_params_ and
+    best_estimator_, so get_worst_params_df and mlflow.sklearn.autolog work as with a plain
+    RandomizedSearchCV.
+
+    :param search_kwargs: other arguments of the search, e.g. verbose or return_train_score
+    :return: the fitted search
+    """
+    if halving:
+        search = HalvingRandomSearchCV(
+            estimator,
+            param_distributions,
+            n_candidates=n_iter,
+            factor=factor,
+            min_resources=min_resources,
+            cv=cache.cv,
+            scoring=scoring,
+            n_jobs=n_jobs,
+            random_state=random_state,
+            **search_kwargs,
+        )
+    else:
+        search = RandomizedSearchCV(
+            estimator,
+            param_distributions,
+            n_iter=n_iter,
+            cv=cache.cv,
+            scoring=scoring,
+            n_jobs=n_jobs,
+            random_state=random_state,
+            **search_kwargs,
+        )
+    return search.fit(cache.x_frame, cache.y)
@@ -0,0 +1,145 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+from chesswinnerprediction.baseline.feature_transformer import TARGET_COLUMN, FeatureTransformer
+from chesswinnerprediction.constants import DRAW_STR
+from chesswinnerprediction.processing.utils import iter_data_file_chunks
+
+# the processed columns the FeatureTransformer needs, the other columns are not read
+TRAINING_COLUMNS = ["WhiteElo", "BlackElo", "Event", "BaseTime", "IncrementTime", TARGET_COLUMN]
+
+
+def balanced_class_weights(class_counts: pd.Series):
+    """The "balanced" weights of get_class_weights, from counts instead of the labels."""
+    return class_counts.sum() / (len(class_counts) * class_counts)
+
+
+class StreamingTrainer:
+    """
+    Trains an incremental sklearn model (SGDClassifier with a probabilistic loss, GaussianNB, ...)
+    on processed files one chunk at a time, so memory use depends on chunk_size and not on the
+    number of games. The features are standardized and can be negative, so models of counts such
+    as MultinomialNB do not fit.
+
+    A first pass over the training files fits the FeatureTransformer (event vocabulary and
+    running scaler statistics) and counts the classes for balanced sample weights. Every epoch
+    then reads the training files in a new random order and calls partial_fit on the chunks of
+    each file in their order in the file, with only the games of every chunk shuffled, so
+    several smaller shards mix better than one large file. The validation log loss after each
+    epoch is used for early stopping: the model of the best epoch is kept.
+
+    :param model: estimator with partial_fit and predict_proba
+    :param predict_draws: keep draws as a class, as in get_x_and_y
+    :param balanced: weight the games by the balanced class weights
+    :param chunk_size: number of games read at once
+    :param max_epochs: largest number of passes over the training files
+    :param patience: number of epochs without improvement of the validation loss before stopping
+    :param tol: smallest decrease of the validation loss counted as an improvement
+    :param random_state: seed of the shuffling of the files and of the games of the chunks
+    """
+
+    def __init__(
+        self,
+        model,
+        predict_draws=True,
+        balanced=True,
+        chunk_size=125000,
+        max_epochs=10,
+        patience=2,
+        tol=1e-4,
+        random_state=42,
+    ):
+        self.model = model
+        self.predict_draws = predict_draws
+        self.balanced = balanced
+        self.chunk_size = chunk_size
+        self.max_epochs = max_epochs
+        self.patience = patience
+        self.tol = tol
+        self._rng = np.random.default_rng(random_state)
+
+        self.transformer = FeatureTransformer()
+        self.class_counts = pd.Series(dtype=np.int64)
+        self.class_weights = None
+        self.history = []
+        self.best_model = None
+
+    @property
+    def classes(self):
+        return self.class_counts.index.to_numpy()
+
+    def iter_chunks(self, file_paths):
+        for file_path in file_paths:
+            for chunk in iter_data_file_chunks(file_path, self.chunk_size, TRAINING_COLUMNS):
+                if not self.predict_draws:
+                    chunk = chunk[chunk[TARGET_COLUMN] != DRAW_STR]
+                if len(chunk):
+                    yield chunk
+
+    def collect_statistics(self, train_paths):
+        for chunk in self.iter_chunks(train_paths):
+            self.transformer.partial_fit(chunk)
+            chunk_counts = chunk[TARGET_COLUMN].value_counts()
+            self.class_counts = self.class_counts.add(chunk_counts, fill_value=0).astype(np.int64)
+        self.class_counts = self.class_counts.sort_index()
+        self.class_weights = balanced_class_weights(self.class_counts)
+
+    def _x_and_y(self, chunk):
+        return self.transformer.transform(chunk), chunk[TARGET_COLUMN].to_numpy(dtype=str)
+
+    def train_epoch(self, train_paths):
+        file_order = self._rng.permutation(len(train_paths))
+        for chunk in self.iter_chunks([train_paths[idx] for idx in file_order]):
+            chunk = chunk.iloc[self._rng.permutation(len(chunk))]
+            x, y = self._x_and_y(chunk)
+            sample_weight = None
+            if self.balanced:
+                sample_weight = self.class_weights[y].to_numpy()
+            self.model.partial_fit(x, y, classes=self.classes, sample_weight=sample_weight)
+
+    def evaluate(self, file_paths, model=None, eps=1e-15):
+        """:return: (log loss, accuracy) of the model on the games of the files"""
+        model = model or self.model
+        total_log_loss, n_correct, n_games = 0.0, 0, 0
+        for chunk in self.iter_chunks(file_paths):
+            x, y = self._x_and_y(chunk)
+            proba = model.predict_proba(x)
+            class_idx = np.searchsorted(model.classes_, y)
+            true_proba = proba[np.arange(len(y)), class_idx]
+            total_log_loss -= np.log(np.clip(true_proba, eps, 1)).sum()
+            n_correct += (model.classes_[np.argmax(proba, axis=1)] == y).sum()
+            n_games += len(y)
+        return float(total_log_loss / n_games), float(n_correct / n_games)
+
+    def fit(self, train_paths, valid_paths=None):
+        """
+        :param train_paths: processed ".csv" or ".parquet" training files, e.g. of several months
+        :param valid_paths: optional validation files for early stopping
+        :return: the model of the best epoch (the last one without validation files)
+        """
+        self.collect_statistics(train_paths)
+        print(f"Training on {self.class_counts.sum()} games: {self.class_counts.to_dict()}")
+
+        best_loss, n_bad_epochs = np.inf, 0
+        for epoch in range(self.max_epochs):
+            self.train_epoch(train_paths)
+            if valid_paths is None:
+                self.best_model = self.model
+                continue
+
+            valid_loss, valid_accuracy = self.evaluate(valid_paths)
+            self.history.append(
+                {"epoch": epoch, "log_loss": valid_loss, "accuracy": valid_accuracy}
+            )
+            print(f"Epoch {epoch}: log loss {valid_loss:.4f}, accuracy {valid_accuracy:.4f}")
+            if valid_loss < best_loss - self.tol:
+                best_loss, n_bad_epochs = valid_loss, 0
+                self.best_model = copy.deepcopy(self.model)
+            else:
+                n_bad_epochs += 1
+                if n_bad_epochs >= self.patience:
+                    print(f"Stopping early, the best log loss is {best_loss:.4f}")
+                    break
+        return self.best_model
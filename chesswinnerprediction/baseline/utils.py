@@ -4,16 +4,11 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from sklearn.utils.class_weight import compute_class_weight
-from sklearn.metrics import (
-    ConfusionMatrixDisplay,
-    classification_report,
-    confusion_matrix,
-    log_loss,
-    balanced_accuracy_score,
-)
+from sklearn.metrics import classification_report
 
 from chesswinnerprediction.constants import RESULTS_STR_TO_STR, DRAW_STR
 from chesswinnerprediction.baseline.constants import BASELINE_COLUMNS, columns_to_scale
+from chesswinnerprediction.baseline.evaluation import evaluate_model, plot_confusion_matrix
 
 
 def show_feature_importance(model, feature_importance, grid_y=False):
@@ -85,29 +80,51 @@ def print_report(
 
 
 def estimate_baseline_model(
-    model, feature_importance, x_train, y_train, x_test, y_test
+    model,
+    feature_importance,
+    x_train,
+    y_train,
+    x_test,
+    y_test,
+    plot=True,
+    n_bootstrap=200,
 ):
-    predict = model.predict(x_test)
-    prob_predict = model.predict_proba(x_test)
-
-    loss = log_loss(y_test, prob_predict)
-    print(f"Log Loss on test data: {round(loss, 4)}")
-
-    weighted_accuracy = balanced_accuracy_score(y_test, predict)
-    print(f"Balanced Accuracy on test data: {round(weighted_accuracy*100, 2)}%\n")
-
-    print_report(model, x_train, y_train, x_test, y_test)
-
-    conf_matrix = confusion_matrix(y_test, predict, labels=model.classes_)
-    labels = [RESULTS_STR_TO_STR[label] for label in model.classes_]
-    ConfusionMatrixDisplay(conf_matrix, display_labels=labels).plot(cmap="Blues")
-    plt.xlabel("Predicted")
-    plt.ylabel("Actual")
-    plt.title("Confusion Matrix")
-    plt.show()
+    """
+    Prints the metrics of the model on the train and test data and plots its confusion matrix.
+
+    Each split is scored with a single predict_proba call, and a predict call for models that
+    are not sklearn classifiers, see evaluation.evaluate_model.
+
+    :param plot: draw the confusion matrix and the feature importance
+    :param n_bootstrap: number of bootstrap replicates of the confidence intervals, 0 - none
+    :return: dict of "train" and "test" EvaluationResult
+    """
+    results = evaluate_model(
+        model, {"train": (x_train, y_train), "test": (x_test, y_test)}, n_bootstrap=n_bootstrap
+    )
+    test_result = results["test"]
+    for metric, title, scale, digits, unit in [
+        ("log_loss", "Log Loss", 1, 4, ""),
+        ("balanced_accuracy", "Balanced Accuracy", 100, 2, "%"),
+    ]:
+        value = round(test_result.metrics[metric] * scale, digits)
+        line = f"{title} on test data: {value}{unit}"
+        if metric in test_result.intervals:
+            low, high = test_result.intervals[metric]
+            line += f" [{round(low * scale, digits)}{unit}, {round(high * scale, digits)}{unit}]"
+        print(line)
+
+    print("\n" + " " * 24 + "Classification Report")
+    reports = pd.concat(
+        [results["train"].report, test_result.report], axis=1, keys=["Train", "Test"]
+    )
+    print(reports.round(2).to_string())
 
-    if feature_importance is not None:
-        show_feature_importance(model, feature_importance)
+    if plot:
+        plot_confusion_matrix(test_result)
+        if feature_importance is not None:
+            show_feature_importance(model, feature_importance)
+    return results
 
 
 def get_class_weights(y, verbose=False):
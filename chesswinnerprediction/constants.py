@@ -7,11 +7,13 @@ from config import ROOT_DIR
 MIN_DATE = "2017-03"  # 2017 - March; size - 2.17 GB; games - 11,346,745
 BASE_NAME = "lichess_db_standard_rated_"
 EXAMPLE_NAME = BASE_NAME + MIN_DATE
-EXAMPLE_URL = f"https://database.lichess.org/standard/{EXAMPLE_NAME}.pgn.zst"
+BASE_URL = "https://database.lichess.org/standard/"
+EXAMPLE_URL = f"{BASE_URL}{EXAMPLE_NAME}.pgn.zst"
 
 # Folder paths
 EXTERNAL_FOLDER_PATH = os.path.join(ROOT_DIR, "data", "external")
 RAW_FOLDER_PATH = os.path.join(ROOT_DIR, "data", "raw")
+INTERIM_FOLDER_PATH = os.path.join(ROOT_DIR, "data", "interim")
 PROCESSED_FOLDER_PATH = os.path.join(ROOT_DIR, "data", "processed")
 
 EXAMPLE_CSV_DIR = os.path.join(RAW_FOLDER_PATH, EXAMPLE_NAME)
@@ -50,13 +52,16 @@ MIN_GAME_DURATION = 0  # seconds
 
 BASELINE_COLUMNS = [
     "Event",
+    "Site",
     "WhiteElo",
     "BlackElo",
     "TimeControl",
     "Result",
     "times_list",
+    "evaluations_list",
     "Termination",
     "ECO",
+    "Opening",
     "White",
     "Black"
 ]
@@ -1,33 +1,320 @@
+import io
 import os
+import json
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from tqdm import tqdm
 
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+STATE_SAVE_INTERVAL = 64 * DOWNLOAD_BLOCK_SIZE
 
-def download_file(url, dest_folder):
-    if not os.path.exists(dest_folder):
-        os.makedirs(dest_folder)
 
-    # todo remove this)
-    # filename = url.split("/")[-1]
-    filename = os.path.basename(url)
-    file_path = os.path.join(dest_folder, filename)
+def get_remote_file_info(url):
+    with requests.head(url, allow_redirects=True) as response:
+        response.raise_for_status()
+        size = response.headers.get("content-length")
+        return {
+            "size": int(size) if size is not None else None,
+            "etag": response.headers.get("etag"),
+            "accept_ranges": response.headers.get("accept-ranges") == "bytes",
+        }
 
-    if os.path.exists(file_path):
-        print(f"File already exists at: {file_path}")
-        return file_path
 
-    print(f"Starting downloading {url}")
+def load_download_state(state_path, remote_info):
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as state_file:
+        state = json.load(state_file)
+    if state["size"] != remote_info["size"] or state["etag"] != remote_info["etag"]:
+        print("Remote file has changed, starting download from scratch")
+        return None
+    return state
+
+
+def save_download_state(state_path, state):
+    tmp_state_path = state_path + ".tmp"
+    with open(tmp_state_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_state_path, state_path)
+
+
+def plan_segments(size, n_segments):
+    segment_size = max(-(-size // n_segments), 1)
+    return [
+        [start, min(start + segment_size, size) - 1, 0] for start in range(0, size, segment_size)
+    ]
+
+
+def request_range(url, start, end, etag):
+    headers = {"Range": f"bytes={start}-{end}"}
+    if etag is not None:
+        headers["If-Range"] = etag
+    response = requests.get(url, headers=headers, stream=True)
+    response.raise_for_status()
+    if response.status_code != 206:
+        response.close()
+        raise ValueError(f"Server did not return the requested range of {url}, retry later")
+    return response
+
+
+class SegmentDownloader:
+    """Downloads byte ranges of a file into a preallocated ".part" file and tracks progress."""
+
+    def __init__(self, url, part_path, state_path, state, pbar):
+        self.url = url
+        self.part_path = part_path
+        self.state_path = state_path
+        self.state = state
+        self.pbar = pbar
+        self._lock = threading.Lock()
+
+    def _update(self, segment, n_bytes, save):
+        with self._lock:
+            segment[2] += n_bytes
+            self.pbar.update(n_bytes)
+            if save:
+                save_download_state(self.state_path, self.state)
+
+    def download_segment(self, segment):
+        start, end, done = segment
+        if start + done > end:
+            return
+
+        with request_range(self.url, start + done, end, self.state["etag"]) as response:
+            with open(self.part_path, "r+b") as out_file:
+                out_file.seek(start + done)
+                unsaved = 0
+                try:
+                    for data in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                        out_file.write(data)
+                        unsaved += len(data)
+                        if unsaved >= STATE_SAVE_INTERVAL:
+                            # the data must be on disk before the state says so
+                            out_file.flush()
+                            self._update(segment, unsaved, save=True)
+                            unsaved = 0
+                finally:
+                    out_file.flush()
+                    self._update(segment, unsaved, save=True)
+
+    def run(self, n_workers):
+        segments = self.state["segments"]
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for future in [executor.submit(self.download_segment, s) for s in segments]:
+                future.result()
+
+
+def download_without_ranges(url, file_path):
+    part_path = file_path + ".part"
     with requests.get(url, stream=True) as response:
         response.raise_for_status()
         total_size = int(response.headers.get("content-length", 0))
-        block_size = 1024
-
-        with open(file_path, "wb") as out_file:
+        with open(part_path, "wb") as out_file:
             with tqdm(total=total_size, unit="iB", unit_scale=True) as pbar:
-                for data in response.iter_content(block_size):
+                for data in response.iter_content(DOWNLOAD_BLOCK_SIZE):
                     pbar.update(len(data))
                     out_file.write(data)
 
+    if total_size and os.path.getsize(part_path) != total_size:
+        raise ValueError(f"Downloaded {os.path.getsize(part_path)} of {total_size} bytes")
+    os.replace(part_path, file_path)
+
+
+def prepare_download(url, file_path):
+    """
+    Checks a local copy of the file against the server.
+
+    :return: (remote file info, download state or None if the file is complete)
+    """
+    part_path, state_path = file_path + ".part", file_path + ".part.json"
+    remote_info = get_remote_file_info(url)
+    size = remote_info["size"]
+
+    if os.path.exists(file_path):
+        local_size = os.path.getsize(file_path)
+        if size is None or local_size == size:
+            print(f"File already exists at: {file_path}")
+            return remote_info, None
+
+        if local_size < size:
+            print(f"Local file has {local_size} of {size} bytes, resuming download")
+            # files of an interrupted download used to be saved under the final name
+            os.replace(file_path, part_path)
+            segments = [[0, size - 1, local_size]]
+            state = {"size": size, "etag": remote_info["etag"], "segments": segments}
+            save_download_state(state_path, state)
+        else:
+            print(f"Local file is larger than the remote one, downloading {url} again")
+            os.remove(file_path)
+
+    state = load_download_state(state_path, remote_info)
+    if state is None or not os.path.exists(part_path):
+        segments = plan_segments(size, 1) if size is not None else []
+        state = {"size": size, "etag": remote_info["etag"], "segments": segments}
+        with open(part_path, "wb"):
+            pass
+    return remote_info, state
+
+
+def finish_download(file_path, state):
+    part_path, state_path = file_path + ".part", file_path + ".part.json"
+    size = state["size"]
+    downloaded = sum(segment[2] for segment in state["segments"])
+    if downloaded != size or os.path.getsize(part_path) != size:
+        raise ValueError(f"Downloaded {downloaded} bytes, the server reported {size}")
+    os.replace(part_path, file_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
     print(f"File downloaded to: {file_path}")
+
+
+def download_file(url, dest_folder, n_segments=1):
+    """
+    Downloads a file, resuming an interrupted download with HTTP Range requests.
+
+    Progress is kept in "{file}.part" and "{file}.part.json" and is discarded when the size or
+    ETag of the remote file changes. The finished file is checked against the server size.
+
+    :param url: file url
+    :param dest_folder: folder to save the file to
+    :param n_segments: number of byte ranges downloaded in parallel
+    :return: path to the downloaded file
+    """
+    if not os.path.exists(dest_folder):
+        os.makedirs(dest_folder)
+
+    filename = os.path.basename(url)
+    file_path = os.path.join(dest_folder, filename)
+
+    remote_info, state = prepare_download(url, file_path)
+    if state is None:
+        return file_path
+
+    size = remote_info["size"]
+    if size is None or not remote_info["accept_ranges"]:
+        print(f"Server does not support resuming, downloading {url} from scratch")
+        download_without_ranges(url, file_path)
+        return file_path
+
+    part_path, state_path = file_path + ".part", file_path + ".part.json"
+    is_new = all(segment[2] == 0 for segment in state["segments"])
+    if is_new and n_segments > 1:
+        state["segments"] = plan_segments(size, n_segments)
+    if os.path.getsize(part_path) < size:
+        os.truncate(part_path, size)
+    save_download_state(state_path, state)
+
+    done = sum(segment[2] for segment in state["segments"])
+    print(f"Starting downloading {url}")
+    with tqdm(total=size, initial=done, unit="iB", unit_scale=True) as pbar:
+        downloader = SegmentDownloader(url, part_path, state_path, state, pbar)
+        downloader.run(n_workers=len(state["segments"]))
+
+    finish_download(file_path, state)
     return file_path
+
+
+class TeeDownloadReader(io.RawIOBase):
+    """
+    Reads a partially downloaded file, then the rest of it from the server.
+
+    Bytes coming from the server are appended to the ".part" file on the way through.
+    """
+
+    def __init__(self, url, part_path, state_path, state, pbar):
+        self.url = url
+        self.state_path = state_path
+        self.state = state
+        self.pbar = pbar
+
+        self._segment = state["segments"][0]
+        self._local_size = self._segment[2]
+        self._local_file = open(part_path, "r+b")
+        self._position = 0
+        self._response = None
+        self._unsaved = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._position < self._local_size:
+            n_bytes = min(len(buffer), self._local_size - self._position)
+            self._local_file.seek(self._position)
+            n_bytes = self._local_file.readinto(memoryview(buffer)[:n_bytes])
+        else:
+            if self._response is None:
+                if self._position > self._segment[1]:
+                    return 0
+                self._response = request_range(
+                    self.url, self._position, self._segment[1], self.state["etag"]
+                )
+            n_bytes = self._response.raw.readinto(buffer)
+            if not n_bytes:
+                return 0
+            self._local_file.seek(self._position)
+            self._local_file.write(memoryview(buffer)[:n_bytes])
+            self._segment[2] += n_bytes
+            self._unsaved += n_bytes
+            if self._unsaved >= STATE_SAVE_INTERVAL:
+                self._local_file.flush()
+                save_download_state(self.state_path, self.state)
+                self._unsaved = 0
+            self.pbar.update(n_bytes)
+
+        self._position += n_bytes
+        return n_bytes
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+        if not self._local_file.closed:
+            self._local_file.flush()
+            save_download_state(self.state_path, self.state)
+            self._local_file.close()
+        super().close()
+
+
+@contextmanager
+def open_url_stream(url, dest_folder):
+    """
+    Opens a remote file for reading while it is being downloaded.
+
+    Ingestion can start right away, e.g. by passing the stream to pgn_zst_to_dataframe. The
+    downloaded bytes are saved to dest_folder, an interrupted download is resumed, and the file
+    gets its final name once it has been read to the end and matches the server size.
+
+    :return: binary file-like object
+    """
+    if not os.path.exists(dest_folder):
+        os.makedirs(dest_folder)
+
+    file_path = os.path.join(dest_folder, os.path.basename(url))
+    remote_info, state = prepare_download(url, file_path)
+    if state is None:
+        with open(file_path, "rb") as local_file:
+            yield local_file
+        return
+
+    size = remote_info["size"]
+    if size is None or not remote_info["accept_ranges"]:
+        raise ValueError(f"Server does not support range requests for {url}")
+
+    # only the downloaded prefix of the first segment can be read in order
+    first_segment = state["segments"][0]
+    state["segments"] = [[0, size - 1, first_segment[2] if first_segment[0] == 0 else 0]]
+    part_path, state_path = file_path + ".part", file_path + ".part.json"
+    save_download_state(state_path, state)
+
+    with tqdm(total=size, initial=state["segments"][0][2], unit="iB", unit_scale=True) as pbar:
+        reader = TeeDownloadReader(url, part_path, state_path, state, pbar)
+        try:
+            yield io.BufferedReader(reader, buffer_size=DOWNLOAD_BLOCK_SIZE)
+        finally:
+            reader.close()
+
+    if state["segments"][0][2] == size:
+        finish_download(file_path, state)
@@ -0,0 +1,120 @@
+import copy
+from functools import partial
+
+from chesswinnerprediction.dataloader.pgn_scanner import parse_headers
+
+
+def header_int(header_data, name):
+    try:
+        return int(header_data.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def event_in(header_data, events):
+    # tournament games have the tournament url after the event name
+    return header_data.get("Event", "").split(" http")[0] in events
+
+
+def time_control_in(header_data, time_controls):
+    return header_data.get("TimeControl") in time_controls
+
+
+def elo_in_range(header_data, min_elo=None, max_elo=None):
+    """Both players must have a known rating within [min_elo, max_elo]."""
+    for name in ["WhiteElo", "BlackElo"]:
+        elo = header_int(header_data, name)
+        if elo is None:
+            return False
+        if min_elo is not None and elo < min_elo:
+            return False
+        if max_elo is not None and elo > max_elo:
+            return False
+    return True
+
+
+def result_not_in(header_data, results):
+    return header_data.get("Result") not in results
+
+
+class GameFilter:
+    """
+    Header predicates checked before the movetext of a game is parsed.
+
+    Every predicate has a name, a game is dropped by the first predicate it fails and the drop is
+    counted under that name. Predicates get the parsed headers dict and must be picklable (module
+    level functions or functools.partial of them) to be used with n_jobs > 1.
+
+    :param events: event names to keep, e.g. ["Rated Blitz game", "Rated Blitz tournament"]
+    :param time_controls: TimeControl values to keep, e.g. ["180+0", "300+3"]
+    :param min_elo: minimal rating of both players
+    :param max_elo: maximal rating of both players
+    :param exclude_results: Result values to drop, e.g. ["*"] for unfinished games
+    """
+
+    def __init__(
+        self, events=None, time_controls=None, min_elo=None, max_elo=None, exclude_results=None
+    ):
+        self.predicates = {}
+        self.n_games = 0
+        self.n_dropped = {}
+
+        if events is not None:
+            self.add("Event", partial(event_in, events=set(events)))
+        if time_controls is not None:
+            self.add("TimeControl", partial(time_control_in, time_controls=set(time_controls)))
+        if min_elo is not None or max_elo is not None:
+            self.add("Elo", partial(elo_in_range, min_elo=min_elo, max_elo=max_elo))
+        if exclude_results is not None:
+            self.add("Result", partial(result_not_in, results=set(exclude_results)))
+
+    def add(self, name, predicate):
+        self.predicates[name] = predicate
+        self.n_dropped[name] = 0
+        return self
+
+    def _failed_predicate(self, header_data):
+        for name, predicate in self.predicates.items():
+            if not predicate(header_data):
+                return name
+        return None
+
+    def accepts(self, header_data):
+        self.n_games += 1
+        failed = self._failed_predicate(header_data)
+        if failed is not None:
+            self.n_dropped[failed] += 1
+        return failed is None
+
+    def accepts_record(self, headers):
+        """accepts for a raw header record, the game is counted in the report."""
+        return self.accepts(parse_headers(headers))
+
+    def matches_record(self, headers):
+        """
+        Whether a raw header record passes all predicates, without counting the game, used to
+        skip the games saved by a previous run.
+        """
+        return self._failed_predicate(parse_headers(headers)) is None
+
+    @property
+    def n_accepted(self):
+        return self.n_games - sum(self.n_dropped.values())
+
+    def empty_copy(self):
+        """Copy with the same predicates and zero counters, to be sent to worker processes."""
+        game_filter = copy.copy(self)
+        game_filter.n_games = 0
+        game_filter.n_dropped = {name: 0 for name in self.predicates}
+        return game_filter
+
+    def merge(self, other):
+        """Adds the counters of a worker copy of this filter."""
+        self.n_games += other.n_games
+        for name, n_dropped in other.n_dropped.items():
+            self.n_dropped[name] += n_dropped
+
+    def report(self):
+        print(f"Kept {self.n_accepted} of {self.n_games} games")
+        for name, n_dropped in self.n_dropped.items():
+            print(f"  dropped by {name}: {n_dropped}")
@@ -0,0 +1,293 @@
+import re
+
+import numpy as np
+
+# Evaluations are stored as int16 centipawns from White's point of view.
+# Mate in n is stored as +-(EVAL_MATE_SCORE - n), a move without an evaluation as EVAL_MISSING.
+EVAL_MATE_SCORE = 32000
+EVAL_MAX_CENTIPAWNS = 30000
+EVAL_MISSING = np.iinfo(np.int16).min
+
+# SAN move (without "!"/"?" annotations) followed by its comment with an optional eval and a clock:
+#   e4 { [%eval 0.17] [%clk 0:03:00] }    or    e4?! { [%clk 0:03:00] }
+MOVE_PATTERN = re.compile(
+    rb"([^\s{}!?]+)[!?]*\s+\{\s*(?:\[%eval\s+([^\]\s]+)\]\s*)?\[%clk\s+(\d+):(\d+):(\d+)\]\s*\}"
+)
+# comment of a regular move, "{ [%eval 0.17] [%clk 0:03:00] }" or "{ [%clk 0:03:00] }": the
+# head of an eval, the tail of the clock read back from the "}", and the positions in the tail
+# and weights of the "H:MM:SS" digits
+EVAL_HEAD = b"{ [%eval "
+CLOCK_TAIL = b" [%clk 0:00:00] }"
+CLOCK_DIGITS = [7, 9, 10, 12, 13]
+CLOCK_DIGIT_SECONDS = np.array([3600, 600, 60, 10, 1], dtype=np.int32)
+# evals are joined with their "]", which is replaced by a space to parse them as integers
+EVAL_SEPARATORS = bytes.maketrans(b"]", b" ")
+EVAL_DECIMALS = 2
+# games are scanned in chunks of this many games, so the arrays of a chunk stay in cache
+SCAN_CHUNK_GAMES = 512
+
+
+def eval_to_centipawns(evaluation):
+    if not evaluation:
+        return EVAL_MISSING
+    if evaluation[0] == 35:  # b"#"
+        moves_to_mate = int(evaluation[1:])
+        # the sign is read from the token, "#-0" is mated black with moves_to_mate = 0
+        if evaluation[1:2] == b"-":
+            return -EVAL_MATE_SCORE - moves_to_mate
+        return EVAL_MATE_SCORE - moves_to_mate
+    centipawns = round(float(evaluation) * 100)
+    return max(-EVAL_MAX_CENTIPAWNS, min(EVAL_MAX_CENTIPAWNS, centipawns))
+
+
+def centipawns_to_eval(centipawns):
+    """Inverse of eval_to_centipawns, returns pawns as float, "#n" for mates and None if missing."""
+    centipawns = int(centipawns)
+    if centipawns == EVAL_MISSING:
+        return None
+    if abs(centipawns) > EVAL_MAX_CENTIPAWNS:
+        moves_to_mate = EVAL_MATE_SCORE - abs(centipawns)
+        return f"#{moves_to_mate}" if centipawns > 0 else f"#-{moves_to_mate}"
+    return centipawns / 100
+
+
+def parse_movetext(moves):
+    """
+    Parses Lichess movetext with clock (and optionally eval) comments.
+
+    :param moves: movetext as bytes
+    :return: (SAN moves list, int16 evals array, int32 remaining clock seconds array,
+        parse_success - False if some commented move could not be parsed)
+    """
+    matches = MOVE_PATTERN.findall(moves)
+
+    chess_moves = [match[0].decode("utf-8") for match in matches]
+    evaluations = np.fromiter(
+        (eval_to_centipawns(match[1]) for match in matches), dtype=np.int16, count=len(matches)
+    )
+    times = np.fromiter(
+        (int(h) * 3600 + int(m) * 60 + int(s) for _, _, h, m, s in matches),
+        dtype=np.int32,
+        count=len(matches),
+    )
+
+    parse_success = len(matches) == moves.count(b"{")
+    return chess_moves, evaluations, times, parse_success
+
+
+def evals_to_centipawns(evaluations):
+    """
+    Vectorised eval_to_centipawns.
+
+    :param evaluations: whitespace-separated eval strings, e.g. "0.17 -1.25 #3 #-2"
+    :return: int16 array of centipawns
+    """
+    if not evaluations.strip():
+        return np.array([], dtype=np.int16)
+    # "#n" is parsed as the two numbers nan, n - the first marks a mate, the second is dropped
+    values = np.fromstring(evaluations.replace("#", "nan "), sep=" ")
+    is_mate = np.isnan(values)
+    is_mate_distance = np.roll(is_mate, 1)
+    moves_to_mate = values[is_mate_distance]
+
+    values[is_mate] = 0
+    centipawns = np.clip(np.rint(values * 100), -EVAL_MAX_CENTIPAWNS, EVAL_MAX_CENTIPAWNS)
+    # signbit, as "#-0" is parsed to -0.0
+    centipawns[is_mate] = np.where(
+        np.signbit(moves_to_mate),
+        -EVAL_MATE_SCORE - moves_to_mate,
+        EVAL_MATE_SCORE - moves_to_mate,
+    )
+    return centipawns[~is_mate_distance].astype(np.int16)
+
+
+def ranges_to_bytes(chars, starts, ends):
+    """The bytes chars[starts[i]:ends[i]] of all ranges, joined."""
+    sizes = ends - starts
+    offsets = np.cumsum(sizes) - sizes
+    return chars[np.arange(sizes.sum()) + np.repeat(starts - offsets, sizes)].tobytes()
+
+
+def scan_evals(text, ends):
+    """
+    Vectorised eval_to_centipawns of evals joined as bytes, e.g. b"0.17]#-2]-1.5]".
+
+    The evals are parsed as integers without their "#" and "." and scaled by their decimals.
+
+    :param ends: positions of the "]" of every eval in text
+    :return: int16 array of centipawns
+    :raises ValueError: for a malformed eval, or one with more than EVAL_DECIMALS decimals
+    """
+    if not len(ends):
+        return np.array([], dtype=np.int16)
+    chars = np.frombuffer(text, dtype=np.uint8)
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    dots = np.flatnonzero(chars == ord("."))
+    dot_evals = np.searchsorted(ends, dots)
+    decimals = np.zeros(len(ends), dtype=np.int64)
+    decimals[dot_evals] = ends[dot_evals] - dots - 1
+    is_mate = chars[starts] == ord("#")
+    # the sign is read from the token, "#-0" is mated black with 0 moves to mate
+    is_negative = chars[starts + is_mate] == ord("-")
+    has_dot = np.zeros(len(ends), dtype=bool)
+    has_dot[dot_evals] = True
+    n_digits = ends - starts - is_mate - is_negative - has_dot
+    if (
+        (np.diff(dot_evals) == 0).any()
+        or (decimals > EVAL_DECIMALS).any()
+        or (is_mate & has_dot).any()
+        or np.count_nonzero(chars == ord("#")) != np.count_nonzero(is_mate)
+        or np.count_nonzero(chars == ord("-")) != np.count_nonzero(is_negative)
+        or np.count_nonzero(chars == ord("]")) != len(ends)
+        or (n_digits < 1).any()
+    ):
+        raise ValueError("Malformed evals")
+    values = np.fromstring(
+        text.translate(EVAL_SEPARATORS, b"#.").decode("ascii"), dtype=np.int64, sep=" "
+    )
+    # fromstring stops at the first malformed eval with old numpy versions
+    if len(values) != len(ends):
+        raise ValueError("Malformed evals")
+
+    values = np.abs(values)
+    centipawns = np.minimum(values * 10 ** (EVAL_DECIMALS - decimals), EVAL_MAX_CENTIPAWNS)
+    centipawns = np.where(is_mate, EVAL_MATE_SCORE - values, centipawns)
+    return np.where(is_negative, -centipawns, centipawns).astype(np.int16)
+
+
+def scan_movetexts(movetexts):
+    """
+    Parses movetexts with one scan of their joined bytes, see parse_movetexts.
+
+    In a regular game every comment is "{ [%eval E] [%clk H:MM:SS] }" or "{ [%clk H:MM:SS] }",
+    with single spaces around it, and the move number and the SAN move are the only tokens
+    between two comments. The clocks are read at fixed offsets from the "}", and the SAN moves
+    and evals of all games are cut out of the bytes and converted at once.
+
+    :param movetexts: list of movetexts as bytes, about SCAN_CHUNK_GAMES
+    :return: lists of SAN moves, int16 evals arrays and int32 clock arrays, and a bool array of
+        regular games, the lists have empty values for the other games
+    :raises ValueError: for a chunk with a null byte or a malformed eval, see scan_evals
+    """
+    n_games = len(movetexts)
+    text = b"\0".join(movetexts).translate(None, b"!?")
+    if text.count(b"\0") != n_games - 1:
+        raise ValueError("A movetext contains a null byte")
+    # padded, so an eval head can be read past the last byte
+    chars = np.frombuffer(text + bytes(len(EVAL_HEAD)), dtype=np.uint8)
+    game_ends = np.flatnonzero(chars == 0)[:n_games]
+    game_starts = np.concatenate([[0], game_ends[:-1] + 1])
+
+    def game_ids(positions):
+        return np.searchsorted(game_ends, positions)
+
+    # whitespace other than single spaces, or a different number of "{" and "}"
+    spaces = np.flatnonzero(chars == ord(" "))
+    opens, closes = np.flatnonzero(chars == ord("{")), np.flatnonzero(chars == ord("}"))
+    n_moves = np.bincount(game_ids(opens), minlength=n_games)
+    is_irregular = (n_moves == 0) | (n_moves != np.bincount(game_ids(closes), minlength=n_games))
+    is_irregular[game_ids(spaces[1:][np.diff(spaces) == 1])] = True
+    is_irregular[game_ids(np.flatnonzero((chars > 0) & (chars < ord(" "))))] = True
+
+    # the i-th "{" and "}" left are the comment of one move
+    opens = opens[~is_irregular[game_ids(opens)]]
+    closes = closes[~is_irregular[game_ids(closes)]]
+    games = game_ids(opens)
+    is_first = np.ones(len(games), dtype=bool)
+    is_first[1:] = games[1:] != games[:-1]
+    is_last = np.ones(len(games), dtype=bool)
+    is_last[:-1] = is_first[1:]
+
+    tail = np.frombuffer(CLOCK_TAIL, dtype=np.uint8)
+    is_tail_char = ~np.isin(np.arange(len(tail)), CLOCK_DIGITS)
+    tails = chars[(closes + 1 - len(tail))[:, None] + np.arange(len(tail))]
+    clock_digits = tails[:, CLOCK_DIGITS] - tail[CLOCK_DIGITS]
+    heads = chars[opens[:, None] + np.arange(len(EVAL_HEAD))]
+    # an eval ends with the "]" right before the tail
+    eval_ends = closes + 1 - len(tail)
+    has_eval = closes - opens > len(tail)
+    previous = np.where(is_first, game_starts[games] - 1, np.roll(closes, 1))
+    before_open = np.searchsorted(spaces, opens)
+    is_valid = (
+        (opens < closes)
+        & (tails[:, is_tail_char] == tail[is_tail_char]).all(axis=1)
+        & (clock_digits <= 9).all(axis=1)
+        & np.where(
+            has_eval,
+            (heads == np.frombuffer(EVAL_HEAD, dtype=np.uint8)).all(axis=1)
+            & (eval_ends - 1 > opens + len(EVAL_HEAD))
+            & (chars[eval_ends - 1] == ord("]"))
+            & (
+                np.searchsorted(spaces, eval_ends)
+                == np.searchsorted(spaces, opens + len(EVAL_HEAD))
+            ),
+            closes - opens == len(tail),
+        )
+        # " 12... Nf3 {" between comments, "1. e4 {" at the start of a game
+        & (chars[opens - 1] == ord(" "))
+        & (before_open - np.searchsorted(spaces, previous) == np.where(is_first, 2, 3))
+        # " 1-0" after the last comment
+        & (
+            ~is_last
+            | (np.searchsorted(spaces, game_ends[games]) - np.searchsorted(spaces, closes) == 1)
+        )
+    )
+    is_irregular[games[~is_valid]] = True
+
+    is_regular_move = ~is_irregular[games]
+    times = clock_digits[is_regular_move].astype(np.int32) @ CLOCK_DIGIT_SECONDS
+    is_eval = has_eval & is_regular_move
+    eval_starts = opens[is_eval] + len(EVAL_HEAD)
+    eval_offsets = np.cumsum(eval_ends[is_eval] - eval_starts)
+    evals = np.full(len(times), EVAL_MISSING, dtype=np.int16)
+    evals[has_eval[is_regular_move]] = scan_evals(
+        ranges_to_bytes(chars, eval_starts, eval_ends[is_eval]), eval_offsets - 1
+    )
+    # the SAN moves with the space after them
+    opens = opens[is_regular_move]
+    san_starts = spaces[before_open[is_regular_move] - 2] + 1
+    all_moves = ranges_to_bytes(chars, san_starts, opens).decode("utf-8").split()
+
+    move_ends = np.cumsum(np.where(is_irregular, 0, n_moves)).tolist()
+    bounds = list(zip([0] + move_ends[:-1], move_ends))
+    chess_moves = [all_moves[start:end] for start, end in bounds]
+    evals_list = [evals[start:end] for start, end in bounds]
+    times_list = [times[start:end] for start, end in bounds]
+    return chess_moves, evals_list, times_list, ~is_irregular
+
+
+def parse_movetexts(movetexts):
+    """
+    Batch version of parse_movetext.
+
+    Regular Lichess movetext is scanned in chunks of SCAN_CHUNK_GAMES games with scan_movetexts,
+    without a Python loop over the moves. Other games are parsed one by one with parse_movetext.
+
+    :param movetexts: list of movetexts as bytes
+    :return: lists of SAN moves, int16 evals arrays, int32 clock arrays and parse_success flags
+    """
+    chess_moves, evals_list, times_list, parse_success = [], [], [], []
+    for start in range(0, len(movetexts), SCAN_CHUNK_GAMES):
+        end = start + SCAN_CHUNK_GAMES
+        chunk = movetexts[start:end]
+        try:
+            chunk_moves, chunk_evals, chunk_times, is_regular = scan_movetexts(chunk)
+        except ValueError:
+            # all games of the chunk are parsed one by one
+            chunk_moves, chunk_evals, chunk_times = ([None] * len(chunk) for _ in range(3))
+            is_regular = np.zeros(len(chunk), dtype=bool)
+
+        chunk_success = [True] * len(chunk)
+        for idx in np.flatnonzero(~is_regular).tolist():
+            (
+                chunk_moves[idx],
+                chunk_evals[idx],
+                chunk_times[idx],
+                chunk_success[idx],
+            ) = parse_movetext(chunk[idx])
+        chess_moves.extend(chunk_moves)
+        evals_list.extend(chunk_evals)
+        times_list.extend(chunk_times)
+        parse_success.extend(chunk_success)
+
+    return chess_moves, evals_list, times_list, parse_success
@@ -0,0 +1,248 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+import zstandard as zstd
+
+from chesswinnerprediction.dataloader.pgn_scanner import (
+    MOVES_PATTERN,
+    RECORD_SEPARATOR,
+    PGNStreamScanner,
+    parse_headers,
+)
+
+INDEX_HEADER_TITLES = ["White", "Black", "WhiteElo", "BlackElo"]
+INDEX_SCHEMA = pa.schema(
+    [
+        ("offset", pa.int64()),
+        ("length", pa.int32()),
+        ("frame", pa.int32()),
+        ("site_id", pa.string()),
+        ("White", pa.string()),
+        ("Black", pa.string()),
+        ("WhiteElo", pa.int16()),
+        ("BlackElo", pa.int16()),
+    ]
+)
+SEEKABLE_FRAME_SIZE = 8 * 1024 * 1024
+
+
+class FrameTrackingReader(io.RawIOBase):
+    """
+    Decompresses a .pgn.zst file frame by frame and records where every zstd frame starts.
+
+    ``frames`` holds (compressed offset, decompressed offset) pairs of the frames read so far.
+    """
+
+    def __init__(self, compressed_file, chunk_size=1024 * 1024):
+        self.compressed_file = compressed_file
+        self.chunk_size = chunk_size
+        self.frames = []
+
+        self._decompressor = None
+        self._input = b""
+        self._input_offset = 0
+        self._output = b""
+        self._output_pos = 0
+        self._decompressed_offset = 0
+
+    def readable(self):
+        return True
+
+    def _decompress_more(self):
+        if not self._input:
+            self._input = self.compressed_file.read(self.chunk_size)
+            if not self._input:
+                return False
+
+        if self._decompressor is None:
+            self.frames.append((self._input_offset, self._decompressed_offset))
+            self._decompressor = zstd.ZstdDecompressor().decompressobj()
+
+        data, self._input = self._input, b""
+        self._output = self._decompressor.decompress(data)
+        self._output_pos = 0
+        self._decompressed_offset += len(self._output)
+
+        if self._decompressor.eof:
+            self._input = self._decompressor.unused_data
+            self._decompressor = None
+        self._input_offset += len(data) - len(self._input)
+        return True
+
+    def readinto(self, buffer):
+        while self._output_pos == len(self._output):
+            if not self._decompress_more():
+                return 0
+
+        n_bytes = min(len(buffer), len(self._output) - self._output_pos)
+        start, stop = self._output_pos, self._output_pos + n_bytes
+        buffer[:n_bytes] = self._output[start:stop]
+        self._output_pos = stop
+        return n_bytes
+
+
+def header_to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PGNIndex:
+    """
+    Byte-offset index of the games in a .pgn.zst archive.
+
+    Game ``i`` of the index is the ``i``-th game saved by pgn_zst_to_dataframe, so rows of the raw
+    shards map to index rows as ``shard_idx * split_size + row``. Random access costs one seek
+    plus decompression from the start of the zstd frame holding the game, use
+    write_seekable_pgn_zst to split single-frame Lichess archives into small frames.
+
+    :param games: DataFrame with INDEX_SCHEMA columns, one row per game
+    :param frames: array of (compressed offset, decompressed offset) rows, one per zstd frame
+    """
+
+    def __init__(self, games: pd.DataFrame, frames):
+        self.games = games
+        self.frames = np.asarray(frames, dtype=np.int64).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.games)
+
+    @classmethod
+    def build(cls, pgn_zst_path):
+        offsets, lengths, site_ids = [], [], []
+        headers = {title: [] for title in INDEX_HEADER_TITLES}
+
+        with open(pgn_zst_path, "rb") as compressed_file:
+            reader = FrameTrackingReader(compressed_file)
+            with tqdm(unit="B", unit_scale=True, desc="Indexing file") as pbar:
+                record_offset, header_offset, header_part = 0, 0, b""
+                for record in PGNStreamScanner(reader, pbar=pbar).iter_records():
+                    if MOVES_PATTERN in record:
+                        header_data = parse_headers(header_part)
+                        offsets.append(header_offset)
+                        game_end = record_offset + len(record) + len(RECORD_SEPARATOR)
+                        lengths.append(game_end - header_offset)
+                        site_ids.append(header_data.get("Site", "").rsplit("/", 1)[-1])
+                        for title in INDEX_HEADER_TITLES:
+                            headers[title].append(header_data.get(title, None))
+
+                    header_part, header_offset = record, record_offset
+                    record_offset += len(record) + len(RECORD_SEPARATOR)
+
+        frames = np.asarray(reader.frames, dtype=np.int64).reshape(-1, 2)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        frame_idx = np.searchsorted(frames[:, 1], offsets, side="right") - 1
+
+        games = pd.DataFrame(
+            {
+                "offset": offsets,
+                "length": np.asarray(lengths, dtype=np.int32),
+                "frame": frame_idx.astype(np.int32),
+                "site_id": site_ids,
+                "White": headers["White"],
+                "Black": headers["Black"],
+                "WhiteElo": [header_to_int(value) for value in headers["WhiteElo"]],
+                "BlackElo": [header_to_int(value) for value in headers["BlackElo"]],
+            }
+        )
+        return cls(games, frames)
+
+    def save(self, index_path):
+        table = pa.Table.from_pandas(self.games, schema=INDEX_SCHEMA, preserve_index=False)
+        metadata = {b"frames": json.dumps(self.frames.tolist()).encode()}
+        pq.write_table(table.replace_schema_metadata(metadata), index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        table = pq.read_table(index_path)
+        frames = json.loads(table.schema.metadata[b"frames"])
+        return cls(table.to_pandas(), frames)
+
+    def locate(self, game_idx):
+        """
+        :return: (compressed offset of the frame, number of decompressed bytes to skip in it),
+            game_idx == len(index) points right after the last game
+        """
+        if game_idx < len(self.games):
+            offset = int(self.games["offset"].iat[game_idx])
+        elif len(self.games):
+            offset = int(self.games["offset"].iat[-1] + self.games["length"].iat[-1])
+        else:
+            offset = 0
+
+        frame_idx = max(np.searchsorted(self.frames[:, 1], offset, side="right") - 1, 0)
+        frame_compressed_offset, frame_offset = self.frames[frame_idx]
+        return int(frame_compressed_offset), offset - int(frame_offset)
+
+    def read_games(self, pgn_zst_path, game_ids):
+        """
+        Decodes the given games without decompressing the rest of the archive.
+
+        Games of one frame are read in a single forward pass over that frame.
+
+        :return: list of PGN texts (headers + movetext, b"\\n\\n" terminated) in game_ids order
+        """
+        game_ids = np.asarray(game_ids, dtype=np.int64)
+        requested_games = self.games.iloc[np.unique(game_ids)]
+
+        games = {}
+        with open(pgn_zst_path, "rb") as compressed_file:
+            for frame_idx, frame_games in requested_games.groupby("frame"):
+                frame_compressed_offset, frame_offset = self.frames[frame_idx]
+
+                compressed_file.seek(frame_compressed_offset)
+                decompressor = zstd.ZstdDecompressor()
+                with decompressor.stream_reader(
+                    compressed_file, read_across_frames=True, closefd=False
+                ) as reader:
+                    for game_idx, offset, length in zip(
+                        frame_games.index, frame_games["offset"], frame_games["length"]
+                    ):
+                        reader.seek(int(offset - frame_offset))
+                        games[game_idx] = reader.read(int(length))
+
+        return [games[game_idx] for game_idx in game_ids]
+
+    def read_game_range(self, pgn_zst_path, start, stop):
+        """
+        :return: decompressed PGN text of games [start, stop) as one block that can be passed to
+            parse_pgn_block
+        """
+        stop = min(stop, len(self.games))
+        if start >= stop:
+            return b""
+
+        frame_compressed_offset, skip_bytes = self.locate(start)
+        end_offset = self.games["offset"].iat[stop - 1] + self.games["length"].iat[stop - 1]
+        size = int(end_offset - self.games["offset"].iat[start])
+
+        with open(pgn_zst_path, "rb") as compressed_file:
+            compressed_file.seek(frame_compressed_offset)
+            decompressor = zstd.ZstdDecompressor()
+            with decompressor.stream_reader(compressed_file, read_across_frames=True) as reader:
+                reader.seek(skip_bytes)
+                return reader.read(size)
+
+
+def write_seekable_pgn_zst(pgn_zst_path, output_path, frame_size=SEEKABLE_FRAME_SIZE, level=3):
+    """
+    Recompresses a .pgn.zst archive into independent zstd frames cut at game boundaries.
+
+    The decompressed content is unchanged, so the result can be read by any zstd tool, while
+    PGNIndex only needs to decompress one small frame to reach any game.
+
+    :param frame_size: approximate decompressed size of one frame
+    """
+    compressor = zstd.ZstdCompressor(level=level)
+    with open(pgn_zst_path, "rb") as compressed_file, open(output_path, "wb") as output_file:
+        decompressor = zstd.ZstdDecompressor()
+        with decompressor.stream_reader(compressed_file, read_across_frames=True) as reader:
+            with tqdm(unit="B", unit_scale=True, desc="Recompressing file") as pbar:
+                for block in PGNStreamScanner(reader, frame_size, pbar).iter_game_blocks():
+                    output_file.write(compressor.compress(block))
@@ -0,0 +1,128 @@
+RECORD_SEPARATOR = b"\n\n"
+GAME_BOUNDARY = b"\n\n[Event"
+# a movetext record of a game with clock annotations, evals are optional
+MOVES_PATTERN = b"[%clk "
+
+SCANNER_BLOCK_SIZE = 1024 * 1024
+
+
+class PGNStreamScanner:
+    """
+    Splits a decompressed PGN stream into blank-line separated records.
+
+    Blocks are read with ``readinto`` straight into one reusable bytearray and every block is split
+    into records at once, so only the unfinished tail of a block is ever moved or scanned again.
+
+    :param reader: binary file-like object with a ``readinto`` method (e.g. zstd stream_reader)
+    :param block_size: number of bytes to read at once
+    :param pbar: optional tqdm progress bar updated with the number of bytes read
+    """
+
+    def __init__(self, reader, block_size=SCANNER_BLOCK_SIZE, pbar=None):
+        self.reader = reader
+        self.block_size = block_size
+        self.pbar = pbar
+        self.bytes_read = 0
+
+        self._buffer = bytearray(2 * block_size)
+        self._start = 0
+        self._end = 0
+
+    def _fill(self):
+        """Moves the unfinished tail to the front of the buffer and reads the next block."""
+        start, end = self._start, self._end
+        if start:
+            self._buffer[: end - start] = self._buffer[start:end]
+            self._start, self._end = 0, end - start
+
+        free_from, free_to = self._end, self._end + self.block_size
+        if len(self._buffer) < free_to:
+            self._buffer.extend(bytes(self.block_size))
+
+        with memoryview(self._buffer) as view:
+            n_read = self.reader.readinto(view[free_from:free_to])
+
+        if not n_read:
+            return False
+
+        self._end += n_read
+        self.bytes_read += n_read
+        if self.pbar is not None:
+            self.pbar.update(n_read)
+        return True
+
+    def skip_games(self, n_games, pattern=MOVES_PATTERN, accept=None):
+        """
+        Consumes records up to and including the n-th movetext record containing ``pattern``.
+
+        The next record yielded by the scanner is the header of the following game.
+
+        :param accept: optional callable on the header record of a game, games it rejects are
+            skipped without being counted
+        """
+        header = b""
+        while n_games:
+            idx = self._buffer.find(RECORD_SEPARATOR, self._start, self._end)
+            if idx == -1:
+                if not self._fill():
+                    return
+                continue
+
+            start = self._start
+            if self._buffer.find(pattern, start, idx) != -1:
+                if accept is None or accept(header):
+                    n_games -= 1
+            if accept is not None:
+                header = bytes(self._buffer[start:idx])
+            self._start = idx + len(RECORD_SEPARATOR)
+
+    def iter_records(self):
+        """
+        Yields every record that is terminated by a blank line, without the separator.
+
+        An unterminated remainder at the end of the stream is dropped, the same way the
+        original ``buffer.split(b"\\n\\n")`` reader did.
+        """
+        while self._fill():
+            start, end = self._start, self._end
+            with memoryview(self._buffer) as view:
+                parts = bytes(view[start:end]).split(RECORD_SEPARATOR)
+            # the last part is not terminated yet, it stays in the buffer
+            self._start = self._end - len(parts[-1])
+            yield from parts[:-1]
+
+    def iter_game_blocks(self):
+        """
+        Yields game-aligned blocks of roughly ``block_size`` bytes.
+
+        Each block ends with the blank line that precedes an "[Event" header, so it can be
+        parsed independently of its neighbours. The last block holds the rest of the stream.
+        """
+        buffer = self._buffer
+        while self._fill():
+            if self._end - self._start < self.block_size:
+                continue
+            idx = buffer.rfind(GAME_BOUNDARY, self._start, self._end)
+            if idx == -1:
+                continue
+            start, stop = self._start, idx + len(RECORD_SEPARATOR)
+            with memoryview(buffer) as view:
+                block = bytes(view[start:stop])
+            self._start = stop
+            yield block
+
+        start, end = self._start, self._end
+        if start < end:
+            with memoryview(buffer) as view:
+                block = bytes(view[start:end])
+            self._start = end
+            yield block
+
+
+def parse_headers(headers):
+    """Parses a PGN header record like b'[Event "Rated Blitz game"]\\n...' into a dict."""
+    header_data = {}
+    for header in headers.split(b"\n"):
+        name, value = header.decode("utf-8")[1:-1].split(" ", 1)
+        header_data[name] = value[1:-1]
+    return header_data
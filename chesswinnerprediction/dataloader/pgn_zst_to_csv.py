@@ -1,8 +1,24 @@
 import os
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from functools import partial
 
 from tqdm import tqdm
 import zstandard as zstd
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from chesswinnerprediction.dataloader.movetext import parse_movetexts
+from chesswinnerprediction.dataloader.pgn_index import PGNIndex
+from chesswinnerprediction.dataloader.pgn_scanner import (
+    MOVES_PATTERN,
+    SCANNER_BLOCK_SIZE,
+    PGNStreamScanner,
+    parse_headers,
+)
 
 
 HEADER_TITLES = [
@@ -24,85 +40,324 @@ MOVE_TITLES = ["chess_moves_list", "evaluations_list", "times_list", "parse_succ
 DATA_TITLES = HEADER_TITLES + MOVE_TITLES
 HEADER_TITLES_SET = set(HEADER_TITLES)
 
+INT_HEADER_TITLES = ["WhiteElo", "BlackElo", "WhiteRatingDiff", "BlackRatingDiff"]
+
+# Typed layout of the parquet shards, list columns are stored as offsets + values arrays
+RAW_PARQUET_SCHEMA = pa.schema(
+    [(title, pa.int16() if title in INT_HEADER_TITLES else pa.string()) for title in HEADER_TITLES]
+    + [
+        ("chess_moves_list", pa.list_(pa.string())),
+        ("evaluations_list", pa.list_(pa.int16())),
+        ("times_list", pa.list_(pa.int32())),
+        ("parse_success", pa.bool_()),
+    ]
+)
+OUTPUT_FORMATS = ("csv", "parquet")
 
-def process_moves_and_evals_and_ckl(moves):
-    # TODO: process "?" and "!" in moves
-    moves = moves.replace(b"!", b"").replace(b"?", b"").decode("utf-8")
-    split_moves = moves.split(". ")[1:]
+PARALLEL_BLOCK_SIZE = 16 * 1024 * 1024
 
-    parse_success = True
-    chess_moves, evaluations, times = [], [], []
-    for move_parts in map(str.split, split_moves):
-        if len(move_parts) != 8:
-            parse_success = False
-            break
 
-        chess_move = move_parts[0]
-        evaluation = move_parts[3][:-1]
-        clk = move_parts[5][:-1]
+def process_and_add_headers(headers, data, game_filter=None):
+    """:return: False if the game is rejected by game_filter and its headers are not added"""
+    header_data = parse_headers(headers)
+    if game_filter is not None and not game_filter.accepts(header_data):
+        return False
+    for name in HEADER_TITLES:
+        data[name].append(header_data.get(name, None))
+    return True
 
-        chess_moves.append(chess_move)
-        evaluations.append(evaluation)
-        times.append(clk)
 
-    return chess_moves, evaluations, times, parse_success
+def header_value_to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 
-def process_and_add_moves(moves, data):
-    chess_moves, evaluations, times, parse_success = process_moves_and_evals_and_ckl(moves)
+def arrays_to_list_array(arrays, dtype):
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int32)
+    np.cumsum([len(values) for values in arrays], out=offsets[1:])
+    values = np.concatenate(arrays).astype(dtype) if arrays else np.array([], dtype=dtype)
+    return pa.ListArray.from_arrays(offsets, values)
 
-    data["chess_moves_list"].append(chess_moves)
-    data["evaluations_list"].append(evaluations)
-    data["times_list"].append(times)
-    data["parse_success"].append(parse_success)
 
+def data_to_arrow_table(data):
+    columns = dict(data)
+    for title in INT_HEADER_TITLES:
+        columns[title] = [header_value_to_int(value) for value in data[title]]
+    columns["evaluations_list"] = arrays_to_list_array(data["evaluations_list"], np.int16)
+    columns["times_list"] = arrays_to_list_array(data["times_list"], np.int32)
+    return pa.Table.from_pydict(columns, schema=RAW_PARQUET_SCHEMA)
 
-def process_and_add_headers(headers, data):
-    header_data = {}
-    for header in headers.split(b"\n"):
-        name, value = header.decode("utf-8")[1:-1].split(" ", 1)
-        header_data[name] = value[1:-1]
 
-    for name in HEADER_TITLES:
-        data[name].append(header_data.get(name, None))
+def data_to_csv_df(data):
+    csv_data = dict(data)
+    for title in ["evaluations_list", "times_list"]:
+        csv_data[title] = [values.tolist() for values in data[title]]
+    return pd.DataFrame(csv_data)
 
 
-def save_df_and_clear_data(df_dir_path, data, idx):
-    file_path_with_idx = os.path.join(df_dir_path, f"data_{idx}.csv")
+def save_df_and_clear_data(df_dir_path, data, idx, output_format="csv"):
+    file_path_with_idx = os.path.join(df_dir_path, f"data_{idx}.{output_format}")
     print(f"\nSaving data to {file_path_with_idx}")
-    pd.DataFrame(data).to_csv(file_path_with_idx, index=False)
+    # write to a temporary file first, so an existing shard is always a complete one
+    tmp_file_path = file_path_with_idx + ".tmp"
+    if output_format == "parquet":
+        pq.write_table(data_to_arrow_table(data), tmp_file_path)
+    else:
+        data_to_csv_df(data).to_csv(tmp_file_path, index=False)
+    os.replace(tmp_file_path, file_path_with_idx)
     for values in data.values():
         values.clear()
 
 
-def pgn_zst_to_dataframe(pgn_zst_path, df_dir_path, split_size=125000):
-    MOVES_PATTERN = b"] [%clk "
+def count_saved_shards(df_dir_path, output_format="csv"):
+    n_shards = 0
+    while os.path.exists(os.path.join(df_dir_path, f"data_{n_shards}.{output_format}")):
+        n_shards += 1
+    return n_shards
+
+
+@contextmanager
+def open_pgn_zst_scanner(
+    pgn_zst_path, block_size=SCANNER_BLOCK_SIZE, start_game=0, index_path=None, game_filter=None
+):
+    """
+    Opens a .pgn.zst archive as a PGNStreamScanner positioned at the start_game-th game.
+
+    With a PGNIndex the scanner starts decompressing from the zstd frame holding the game,
+    otherwise the preceding games are skipped without being parsed.
+
+    :param pgn_zst_path: path to the archive or a binary file-like object (e.g. open_url_stream)
+    :param game_filter: optional GameFilter, start_game then counts only the accepted games and
+        the index is not used, as its rows are all games of the archive
+    """
+    if isinstance(pgn_zst_path, str):
+        file_context = open(pgn_zst_path, "rb")
+    else:
+        file_context = nullcontext(pgn_zst_path)
+        index_path = None
+    if game_filter is not None:
+        index_path = None
+
+    with file_context as compressed_file:
+        skip_bytes = 0
+        if start_game and index_path is not None:
+            frame_compressed_offset, skip_bytes = PGNIndex.load(index_path).locate(start_game)
+            compressed_file.seek(frame_compressed_offset)
+
+        decompressor = zstd.ZstdDecompressor()
+        with decompressor.stream_reader(compressed_file, read_across_frames=True) as reader:
+            if skip_bytes:
+                reader.seek(skip_bytes)
+            with tqdm(unit="B", unit_scale=True, desc="Reading file") as pbar:
+                scanner = PGNStreamScanner(reader, block_size, pbar)
+                if start_game and index_path is None:
+                    accept = game_filter.matches_record if game_filter is not None else None
+                    scanner.skip_games(start_game, accept=accept)
+                yield scanner
+
+
+def parse_pgn_block(block, game_filter=None):
+    """
+    Parses a game-aligned block of decompressed PGN text.
+
+    Only records terminated by a blank line are processed, exactly as the serial reader does,
+    so a block must be cut right after a "\\n\\n" that precedes an "[Event" header.
+
+    :param block: bytes starting at an "[Event" header
+    :param game_filter: optional GameFilter, the movetext of rejected games is not parsed
+    :return: dict with DATA_TITLES keys and per-game lists of values
+    """
+    data = {title: [] for title in DATA_TITLES}
+    header_part, movetexts = b"", []
+    for part in block.split(b"\n\n")[:-1]:
+        if MOVES_PATTERN in part and process_and_add_headers(header_part, data, game_filter):
+            movetexts.append(part)
+        header_part = part
+
+    for title, values in zip(MOVE_TITLES, parse_movetexts(movetexts)):
+        data[title] = values
+    return data
+
+
+def parse_pgn_block_with_filter(block, game_filter):
+    """parse_pgn_block for worker processes, also returns the filter with the block counters."""
+    return parse_pgn_block(block, game_filter), game_filter
+
+
+def imap_in_order(executor, fn, iterable, max_in_flight):
+    """Like executor.map, but keeps at most max_in_flight tasks submitted at once."""
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(fn, item))
+        if len(futures) >= max_in_flight:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def imap_unordered(executor, fn, iterable, max_in_flight):
+    """Like imap_in_order, but yields results as soon as they are ready."""
+    futures = set()
+    for item in iterable:
+        futures.add(executor.submit(fn, item))
+        if len(futures) >= max_in_flight:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def extend_and_save_data(df_dir_path, data, block_data, file_idx, split_size, output_format):
+    n_games = len(block_data["chess_moves_list"])
+    start = 0
+    while start < n_games:
+        n_free = split_size - len(data["chess_moves_list"])
+        stop = min(n_games, start + n_free)
+        for title in DATA_TITLES:
+            data[title].extend(block_data[title][start:stop])
+        start = stop
+
+        if len(data["chess_moves_list"]) >= split_size:
+            save_df_and_clear_data(df_dir_path, data, file_idx, output_format)
+            file_idx += 1
+    return file_idx
+
+
+def pgn_zst_to_dataframe_parallel(
+    pgn_zst_path,
+    df_dir_path,
+    split_size=125000,
+    n_jobs=None,
+    output_format="csv",
+    first_shard=0,
+    index_path=None,
+    game_filter=None,
+):
+    """
+    Multi-core version of pgn_zst_to_dataframe.
+
+    The decompressed stream is cut into game-aligned blocks at "\\n\\n[Event" boundaries and the
+    blocks are parsed in a process pool. Results are merged in stream order, so the saved
+    shards are identical to the serial ones.
+
+    :param pgn_zst_path: path to the .pgn.zst archive
+    :param df_dir_path: directory to save "data_{idx}.{output_format}" shards to
+    :param split_size: number of games in one shard
+    :param n_jobs: number of worker processes (default: os.cpu_count())
+    :param output_format: "csv" or "parquet"
+    :param first_shard: index of the first shard to write, the games of the previous shards
+        are skipped
+    :param index_path: optional PGNIndex file used to seek to the first game
+    :param game_filter: optional GameFilter, its counters are merged from the workers
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    max_in_flight = 2 * n_jobs
+
+    data = {title: [] for title in DATA_TITLES}
+    file_idx = first_shard
+    start_game = first_shard * split_size
+
+    parse_block = parse_pgn_block
+    if game_filter is not None:
+        parse_block = partial(parse_pgn_block_with_filter, game_filter=game_filter.empty_copy())
+
+    with open_pgn_zst_scanner(
+        pgn_zst_path, PARALLEL_BLOCK_SIZE, start_game, index_path, game_filter
+    ) as scanner:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            blocks = scanner.iter_game_blocks()
+            for block_data in imap_in_order(executor, parse_block, blocks, max_in_flight):
+                if game_filter is not None:
+                    block_data, block_filter = block_data
+                    game_filter.merge(block_filter)
+                file_idx = extend_and_save_data(
+                    df_dir_path, data, block_data, file_idx, split_size, output_format
+                )
+
+    save_df_and_clear_data(df_dir_path, data, file_idx, output_format)
+
+
+def pgn_zst_to_dataframe_serial(
+    pgn_zst_path, df_dir_path, split_size, output_format, first_shard, index_path, game_filter
+):
+    data = {title: [] for title in DATA_TITLES}
+    file_idx = first_shard
+    start_game = first_shard * split_size
+
+    with open_pgn_zst_scanner(
+        pgn_zst_path, start_game=start_game, index_path=index_path, game_filter=game_filter
+    ) as scanner:
+        for block in scanner.iter_game_blocks():
+            block_data = parse_pgn_block(block, game_filter)
+            file_idx = extend_and_save_data(
+                df_dir_path, data, block_data, file_idx, split_size, output_format
+            )
+
+    save_df_and_clear_data(df_dir_path, data, file_idx, output_format)
+
+
+def pgn_zst_to_dataframe(
+    pgn_zst_path,
+    df_dir_path,
+    split_size=125000,
+    n_jobs=1,
+    output_format="csv",
+    resume=False,
+    index_path=None,
+    game_filter=None,
+):
+    """
+    Decodes a .pgn.zst archive into "data_{idx}.{output_format}" shards of split_size games.
+
+    :param pgn_zst_path: path to the .pgn.zst archive or a binary file-like object
+    :param df_dir_path: directory to save the shards to
+    :param split_size: number of games in one shard
+    :param n_jobs: number of worker processes, 1 - parse in the current process
+    :param output_format: "csv" or "parquet"
+    :param resume: continue an interrupted run, the last saved shard is written again
+    :param index_path: optional PGNIndex file of the archive to seek to the resumed game
+    :param game_filter: optional GameFilter checked on the headers of every game, the movetext
+        of rejected games is never parsed. Pass the same filter when resuming.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}. Use one of {OUTPUT_FORMATS}")
+
     ZST_COMPRESSION_INDEX = (
         7.1  # info from https://database.lichess.org/#standard_games
     )
-    estimated_total_size = os.path.getsize(pgn_zst_path) * ZST_COMPRESSION_INDEX
-    print(f"Estimated total size: ~{estimated_total_size / (1024 ** 3):.1f}GB")
+    if isinstance(pgn_zst_path, str):
+        estimated_total_size = os.path.getsize(pgn_zst_path) * ZST_COMPRESSION_INDEX
+        print(f"Estimated total size: ~{estimated_total_size / (1024 ** 3):.1f}GB")
 
-    data = {title: [] for title in DATA_TITLES}
-    file_idx = 0
+    first_shard = 0
+    if resume:
+        first_shard = max(count_saved_shards(df_dir_path, output_format) - 1, 0)
+        print(f"Resuming from shard {first_shard}")
 
-    with open(pgn_zst_path, "rb") as compressed_file:
-        with zstd.ZstdDecompressor().stream_reader(compressed_file) as reader:
-            with tqdm(unit="B", unit_scale=True, desc="Reading file") as pbar:
-                buffer, part = b"", b""
-                for chunk in iter(lambda: reader.read(size=4096), b""):
-                    buffer += chunk
-                    pbar.update(len(chunk))
-                    while b"\n\n" in buffer:
-                        header_part = part
-                        part, buffer = buffer.split(b"\n\n", maxsplit=1)
-                        if MOVES_PATTERN in part:
-                            process_and_add_headers(header_part, data)
-                            process_and_add_moves(part, data)
-
-                        if len(data["chess_moves_list"]) >= split_size:
-                            save_df_and_clear_data(df_dir_path, data, file_idx)
-                            file_idx += 1
-
-    save_df_and_clear_data(df_dir_path, data, file_idx)
+    if n_jobs != 1:
+        pgn_zst_to_dataframe_parallel(
+            pgn_zst_path,
+            df_dir_path,
+            split_size,
+            n_jobs,
+            output_format,
+            first_shard,
+            index_path,
+            game_filter,
+        )
+    else:
+        pgn_zst_to_dataframe_serial(
+            pgn_zst_path,
+            df_dir_path,
+            split_size,
+            output_format,
+            first_shard,
+            index_path,
+            game_filter,
+        )
 
+    if game_filter is not None:
+        game_filter.report()
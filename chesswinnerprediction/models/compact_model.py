@@ -0,0 +1,227 @@
+import json
+
+import numpy as np
+
+from chesswinnerprediction.baseline.feature_transformer import FeatureTransformer
+from chesswinnerprediction.constants import DRAW_STR
+
+# A compact model is one uncompressed ".npz" file of plain arrays (no pickles), read with NumPy
+# only: the kind of the model, its classes, the feature names of the input columns, the optional
+# FeatureTransformer state, and the coefficients or the flattened tree nodes.
+# version 2: trees route missing values with missing_go_to_left, version 1 files send them right
+FORMAT_VERSION = 2
+LINEAR, DOUBLE_STAGE, TREES = "linear", "double_stage", "trees"
+# links of a linear model from the decision function to the probabilities
+BINARY_LINK, SOFTMAX_LINK, OVR_LINK = "binary", "softmax", "ovr"
+
+
+def _linear_arrays(model, prefix=""):
+    n_classes = len(model.classes_)
+    multi_class = getattr(model, "multi_class", "auto")
+    if n_classes == 2:
+        link = BINARY_LINK
+    elif multi_class == "ovr" or (multi_class == "auto" and model.solver == "liblinear"):
+        link = OVR_LINK
+    else:
+        link = SOFTMAX_LINK
+    return {
+        f"{prefix}coef": np.asarray(model.coef_, dtype=np.float64),
+        f"{prefix}intercept": np.asarray(model.intercept_, dtype=np.float64).reshape(-1),
+        f"{prefix}link": np.array(link),
+        f"{prefix}classes": np.asarray(model.classes_).astype(str),
+    }
+
+
+def _tree_arrays(estimators):
+    """Nodes of all trees in one set of arrays, child indices are global node indices."""
+    children_left, children_right, features, thresholds, values, roots = [], [], [], [], [], []
+    missing_go_to_left = []
+    n_nodes = 0
+    for estimator in estimators:
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+        children_left.append(np.where(is_leaf, -1, tree.children_left + n_nodes))
+        children_right.append(np.where(is_leaf, -1, tree.children_right + n_nodes))
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        # the side of every split that missing values take, sklearn >= 1.3
+        missing_go_to_left.append(
+            getattr(tree, "missing_go_to_left", np.zeros(tree.node_count, dtype=bool))
+        )
+        # class fractions of the nodes, in the order of the classes of the model
+        value = tree.value[:, 0, :]
+        values.append(value / np.maximum(value.sum(axis=1, keepdims=True), 1e-12))
+        roots.append(n_nodes)
+        n_nodes += tree.node_count
+
+    node_dtype = np.int32 if n_nodes < 2**31 else np.int64
+    return {
+        "children_left": np.concatenate(children_left).astype(node_dtype),
+        "children_right": np.concatenate(children_right).astype(node_dtype),
+        "feature": np.concatenate(features).astype(np.int32),
+        "threshold": np.concatenate(thresholds).astype(np.float64),
+        "missing_go_to_left": np.concatenate(missing_go_to_left).astype(bool),
+        "value": np.concatenate(values).astype(np.float32),
+        "roots": np.array(roots, dtype=node_dtype),
+    }
+
+
+def export_model(model, path, feature_names=None, transformer=None):
+    """
+    Writes a fitted baseline model as a compact model file, see CompactModel.
+
+    Supported are LogisticRegression (and other linear classifiers with coef_ and
+    predict_proba of a logistic regression), the double-stage Model of the baseline notebooks
+    (win_to_draw_splitter and black_to_white_splitter logistic regressions), DecisionTreeClassifier
+    and the forests of decision trees (RandomForestClassifier, ExtraTreesClassifier).
+
+    :param path: ".npz" file to write
+    :param feature_names: names of the input columns, default: model.feature_names_in_
+    :param transformer: optional fitted FeatureTransformer, so the file can score raw headers
+    """
+    if feature_names is None:
+        feature_names = getattr(model, "feature_names_in_", None)
+    if feature_names is None and transformer is not None:
+        feature_names = transformer.feature_names
+    if feature_names is None:
+        raise ValueError("The feature names are needed, the model has no feature_names_in_")
+
+    if hasattr(model, "win_to_draw_splitter") and hasattr(model, "black_to_white_splitter"):
+        kind = DOUBLE_STAGE
+        arrays = {
+            **_linear_arrays(model.win_to_draw_splitter, "draw_"),
+            **_linear_arrays(model.black_to_white_splitter, "win_"),
+        }
+        classes = np.array([DRAW_STR, *arrays["win_classes"]])
+    elif hasattr(model, "estimators_") or hasattr(model, "tree_"):
+        kind = TREES
+        classes = np.asarray(model.classes_).astype(str)
+        estimators = model.estimators_ if hasattr(model, "estimators_") else [model]
+        if not all(hasattr(estimator, "tree_") for estimator in estimators):
+            raise ValueError(f"Only forests of decision trees are supported, not {model}")
+        arrays = _tree_arrays(estimators)
+    elif hasattr(model, "coef_"):
+        kind = LINEAR
+        arrays = _linear_arrays(model)
+        classes = arrays.pop("classes")
+    else:
+        raise ValueError(f"Cannot export {type(model).__name__}")
+
+    transformer_state = json.dumps(transformer.state()) if transformer is not None else ""
+
+    with open(path, "wb") as model_file:
+        np.savez(
+            model_file,
+            format_version=FORMAT_VERSION,
+            kind=np.array(kind),
+            classes=np.asarray(classes).astype(str),
+            feature_names=np.asarray(feature_names).astype(str),
+            transformer=np.array(transformer_state),
+            **arrays,
+        )
+
+
+def _linear_proba(arrays, x, prefix=""):
+    decision = x @ arrays[f"{prefix}coef"].T + arrays[f"{prefix}intercept"]
+    link = str(arrays[f"{prefix}link"])
+    if link == BINARY_LINK:
+        positive = 1 / (1 + np.exp(-decision[:, 0]))
+        return np.column_stack([1 - positive, positive])
+    if link == OVR_LINK:
+        proba = 1 / (1 + np.exp(-decision))
+        return proba / proba.sum(axis=1, keepdims=True)
+    decision -= decision.max(axis=1, keepdims=True)
+    proba = np.exp(decision)
+    return proba / proba.sum(axis=1, keepdims=True)
+
+
+class CompactModel:
+    """
+    NumPy-only evaluator of the files of export_model.
+
+    Loading reads a few arrays, without sklearn, pandas or pickles, so a scoring worker starts in
+    milliseconds. Trees are evaluated for all rows and trees at once, one level per step.
+
+    :param arrays: dict of the arrays of the file
+    """
+
+    def __init__(self, arrays):
+        if int(arrays["format_version"]) > FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact model version {int(arrays['format_version'])}")
+        self.arrays = arrays
+        self.kind = str(arrays["kind"])
+        self.classes_ = arrays["classes"]
+        self.feature_names = arrays["feature_names"].tolist()
+        self.transformer = None
+        if str(arrays["transformer"]):
+            self.transformer = FeatureTransformer.from_state(
+                json.loads(str(arrays["transformer"]))
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as model_file:
+            return cls({name: model_file[name] for name in model_file.files})
+
+    def _tree_proba(self, x):
+        arrays = self.arrays
+        missing_go_to_left = arrays.get("missing_go_to_left")
+        if missing_go_to_left is None:
+            missing_go_to_left = np.zeros(len(arrays["children_left"]), dtype=bool)
+        # sklearn compares float32 features with the float64 thresholds
+        x = np.asarray(x, dtype=np.float32)
+        nodes = np.broadcast_to(arrays["roots"], (len(x), len(arrays["roots"]))).copy()
+        is_split = arrays["children_left"][nodes] != -1
+        while is_split.any():
+            split_rows, split_nodes = np.nonzero(is_split)[0], nodes[is_split]
+            values = x[split_rows, arrays["feature"][split_nodes]]
+            goes_left = np.where(
+                np.isnan(values),
+                missing_go_to_left[split_nodes],
+                values <= arrays["threshold"][split_nodes],
+            )
+            nodes[is_split] = np.where(
+                goes_left,
+                arrays["children_left"][split_nodes],
+                arrays["children_right"][split_nodes],
+            )
+            is_split = arrays["children_left"][nodes] != -1
+        return arrays["value"][nodes].mean(axis=1, dtype=np.float64)
+
+    def predict_proba(self, x):
+        """
+        :param x: (n_games, n_features) matrix with the columns of feature_names, e.g. of the
+            FeatureTransformer of the model
+        :return: probabilities in the order of classes_
+        """
+        if hasattr(x, "to_numpy"):
+            x = x[self.feature_names].to_numpy()
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim != 2 or x.shape[1] != len(self.feature_names):
+            raise ValueError(f"Expected {len(self.feature_names)} feature columns")
+
+        if self.kind == TREES:
+            return self._tree_proba(x)
+        if self.kind == LINEAR:
+            return _linear_proba(self.arrays, x)
+
+        # P(draw) from the first stage, P(win) splits between the classes of the second one
+        draw_classes = self.arrays["draw_classes"].tolist()
+        win_proba = _linear_proba(self.arrays, x, "draw_")[:, draw_classes.index("True")]
+        proba = np.empty((len(x), len(self.classes_)))
+        proba[:, 0] = 1 - win_proba
+        proba[:, 1:] = _linear_proba(self.arrays, x, "win_") * win_proba[:, np.newaxis]
+        return proba
+
+    def predict(self, x):
+        """
+        The most probable class. For the double-stage Model this is not the hierarchical predict
+        of the notebooks (win or draw first, then black or white), the probabilities are the same.
+        """
+        return self.classes_[np.argmax(self.predict_proba(x), axis=1)]
+
+    def predict_proba_headers(self, data):
+        """Probabilities of games from their headers, see FeatureTransformer.transform."""
+        if self.transformer is None:
+            raise ValueError("The model was exported without a FeatureTransformer")
+        return self.predict_proba(self.transformer.transform(data))
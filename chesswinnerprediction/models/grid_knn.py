@@ -0,0 +1,174 @@
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.neighbors import KDTree, KNeighborsClassifier
+
+
+def snap_to_grid(x, resolution):
+    """Rounds every column with a positive resolution to a multiple of it, the others are kept."""
+    x = np.asarray(x, dtype=np.float64)
+    resolution = np.broadcast_to(np.asarray(resolution, dtype=np.float64), x.shape[1:])
+    is_quantised = resolution > 0
+    if not is_quantised.any():
+        return x
+    snapped = x.copy()
+    snapped[:, is_quantised] = (
+        np.round(x[:, is_quantised] / resolution[is_quantised]) * resolution[is_quantised]
+    )
+    return snapped
+
+
+class GridKNNClassifier(BaseEstimator, ClassifierMixin):
+    """
+    KNeighborsClassifier on result counts of grid cells instead of single games.
+
+    fit snaps the features to a grid (resolution 0 keeps a column exact) and keeps one point per
+    non-empty cell, the mean of its games, with the per-class counts of its games. Rated games
+    have integer ratings and a few time controls and events, so even without quantisation
+    millions of games collapse into far fewer cells. A query takes the nearest cells from a
+    KDTree until they hold n_neighbors games, the last cell counted with the fraction that is
+    needed, so without sample weights a query reads fewer than 2 * n_neighbors cells whatever the
+    number of games. Queries are snapped to the same grid and every distinct one is looked up
+    once per batch.
+
+    With resolution 0 the probabilities are the ones of KNeighborsClassifier, except that games
+    tied at the distance of the last neighbour are counted proportionally instead of in an
+    arbitrary order, see compare_with_brute_force.
+
+    :param n_neighbors: number of neighbour games
+    :param weights: "uniform" or "distance", as in KNeighborsClassifier
+    :param resolution: grid step of every feature, a scalar or one value per column, in the units
+        of the features (standard deviations for the scaled columns of transform_and_scale_df)
+    :param initial_cells: number of cells read by the first lookup of a query, queries that need
+        more are repeated with twice as many cells, None - enough cells of the mean size for
+        n_neighbors games and 20% more
+    :param batch_size: number of distinct queries looked up at once
+    :param leaf_size: leaf size of the KDTree
+    """
+
+    def __init__(
+        self,
+        n_neighbors=75,
+        weights="uniform",
+        resolution=0.0,
+        initial_cells=None,
+        batch_size=10000,
+        leaf_size=30,
+    ):
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.resolution = resolution
+        self.initial_cells = initial_cells
+        self.batch_size = batch_size
+        self.leaf_size = leaf_size
+
+    def fit(self, x, y, sample_weight=None):
+        """
+        :param sample_weight: optional weights of the games, e.g. balanced class weights, a cell
+            holds the sum of the weights of its games and n_neighbors counts weight
+        """
+        if self.weights not in ("uniform", "distance"):
+            raise ValueError(f"Unknown weights: {self.weights}")
+        if hasattr(x, "columns"):
+            self.feature_names_in_ = np.asarray(x.columns, dtype=object)
+        x = np.asarray(x, dtype=np.float64)
+        self.classes_, y_codes = np.unique(np.asarray(y), return_inverse=True)
+        n_classes = len(self.classes_)
+        if sample_weight is None:
+            sample_weight = np.ones(len(x))
+
+        cells, cell_ids = np.unique(snap_to_grid(x, self.resolution), axis=0, return_inverse=True)
+        cell_ids = cell_ids.reshape(-1)
+        n_cells = len(cells)
+        n_games = np.bincount(cell_ids, minlength=n_cells)
+        self.cell_points_ = (
+            np.column_stack(
+                [np.bincount(cell_ids, weights=column, minlength=n_cells) for column in x.T]
+            )
+            / n_games[:, np.newaxis]
+        )
+        self.cell_counts_ = np.bincount(
+            cell_ids * n_classes + y_codes,
+            weights=sample_weight,
+            minlength=n_cells * n_classes,
+        ).reshape(n_cells, n_classes)
+
+        self._tree = KDTree(self.cell_points_, leaf_size=self.leaf_size)
+        self.n_features_in_ = x.shape[1]
+        return self
+
+    def _vote(self, distances, cell_idx):
+        """Class weights of the nearest cells, each row has to reach n_neighbors games."""
+        counts = self.cell_counts_[cell_idx]
+        totals = counts.sum(axis=2)
+        games_before = np.cumsum(totals, axis=1) - totals
+        parts = np.clip((self.n_neighbors - games_before) / np.maximum(totals, 1e-12), 0, 1)
+        counts = counts * parts[:, :, np.newaxis]
+        if self.weights == "distance":
+            is_exact = (distances == 0) & (parts > 0)
+            has_exact = is_exact.any(axis=1, keepdims=True)
+            with np.errstate(divide="ignore"):
+                inverse_distances = np.where(has_exact, is_exact, 1 / distances)
+            counts = counts * inverse_distances[:, :, np.newaxis]
+        return counts.sum(axis=1)
+
+    def _lookup(self, queries):
+        votes = np.empty((len(queries), len(self.classes_)))
+        n_cells = len(self.cell_points_)
+        pending = np.arange(len(queries))
+        n_read = self.initial_cells
+        if n_read is None:
+            mean_games = self.cell_counts_.sum() / n_cells
+            n_read = int(np.ceil(1.2 * self.n_neighbors / mean_games))
+        n_read = max(min(n_read, n_cells), 1)
+        while len(pending):
+            distances, cell_idx = self._tree.query(queries[pending], k=n_read)
+            total_games = self.cell_counts_[cell_idx].sum(axis=(1, 2))
+            is_done = (total_games >= self.n_neighbors) | (n_read == n_cells)
+            votes[pending[is_done]] = self._vote(distances[is_done], cell_idx[is_done])
+            pending = pending[~is_done]
+            n_read = min(2 * n_read, n_cells)
+        return votes
+
+    def predict_proba(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        queries, query_ids = np.unique(
+            snap_to_grid(x, self.resolution), axis=0, return_inverse=True
+        )
+        query_ids = query_ids.reshape(-1)
+
+        votes = np.empty((len(queries), len(self.classes_)))
+        for start in range(0, len(queries), self.batch_size):
+            stop = start + self.batch_size
+            votes[start:stop] = self._lookup(queries[start:stop])
+        proba = votes / np.maximum(votes.sum(axis=1, keepdims=True), 1e-12)
+        return proba[query_ids]
+
+    def predict(self, x):
+        return self.classes_[np.argmax(self.predict_proba(x), axis=1)]
+
+
+def compare_with_brute_force(model, x_train, y_train, x_sample, atol=1e-6):
+    """
+    Checks a fitted GridKNNClassifier against a brute-force KNeighborsClassifier with the same
+    neighbours on a sample of queries.
+
+    :return: dict with the largest and the mean absolute difference of the probabilities, the
+        share of queries with a difference above atol and the share of equal predictions
+    """
+    brute_knn = KNeighborsClassifier(
+        n_neighbors=model.n_neighbors, weights=model.weights, algorithm="brute"
+    )
+    brute_knn.fit(np.asarray(x_train, dtype=np.float64), np.asarray(y_train))
+    x_sample = np.asarray(x_sample, dtype=np.float64)
+    expected = brute_knn.predict_proba(x_sample)
+    proba = model.predict_proba(x_sample)
+
+    differences = np.abs(proba - expected).max(axis=1)
+    return {
+        "max_proba_diff": float(differences.max()),
+        "mean_proba_diff": float(differences.mean()),
+        "share_above_atol": float((differences > atol).mean()),
+        "label_agreement": float(
+            (brute_knn.classes_[expected.argmax(axis=1)] == model.predict(x_sample)).mean()
+        ),
+    }
@@ -0,0 +1,464 @@
+import asyncio
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+from chesswinnerprediction.constants import BLACK_WIN_STR, DRAW_STR, WHITE_WIN_STR
+from chesswinnerprediction.dataloader.movetext import EVAL_MISSING, parse_movetext
+from chesswinnerprediction.dataloader.pgn_scanner import MOVES_PATTERN, parse_headers
+from chesswinnerprediction.processing.game_features import EVAL_CAP, evals_to_ragged
+from chesswinnerprediction.processing.utils import iter_data_file_chunks, times_to_ragged
+
+# raw shard columns the model is trained on, see pgn_zst_to_csv
+LIVE_COLUMNS = ["WhiteElo", "BlackElo", "TimeControl", "Result", "times_list", "evaluations_list"]
+LIVE_CLASSES = np.array(sorted([BLACK_WIN_STR, WHITE_WIN_STR, DRAW_STR]))
+LIVE_FEATURES = [
+    "EloDiff",
+    "Eval",
+    "EvalSquashed",
+    "HasEval",
+    "Progress",
+    "EvalProgress",
+    "CalmProgress",
+    "WhiteClock",
+    "BlackClock",
+    "ClockDiff",
+    "ClockLogRatio",
+    "BlackToMove",
+]
+# the game progress feature stops growing after this number of plies
+MAX_PROGRESS_PLIES = 160
+INITIAL_CAPACITY = 1024
+
+
+def live_features(
+    elo_diff, base_time, increment_time, white_clock, black_clock, evaluation, has_eval, plies
+):
+    """
+    Features of positions of running games, the same for training and for the live updates.
+
+    :param evaluation: last known eval in centipawns, see dataloader.movetext
+    :param has_eval: whether the game had an eval yet
+    :param plies: number of half-moves played
+    :return: (n_positions, len(LIVE_FEATURES)) float64 array
+    """
+    plies = np.asarray(plies, dtype=np.float64)
+    # the time a side gets for a game of 40 moves
+    time_budget = np.maximum(np.asarray(base_time) + 40 * np.asarray(increment_time), 1.0)
+    white_share = np.asarray(white_clock) / time_budget
+    black_share = np.asarray(black_clock) / time_budget
+
+    pawns = np.clip(evaluation, -EVAL_CAP, EVAL_CAP) / 100 * np.asarray(has_eval)
+    squashed = np.tanh(pawns / 2)
+    progress = np.minimum(plies, MAX_PROGRESS_PLIES) / 80
+    return np.column_stack(
+        [
+            np.asarray(elo_diff) / 400,
+            pawns,
+            squashed,
+            np.asarray(has_eval, dtype=np.float64),
+            progress,
+            squashed * progress,
+            (1 - np.abs(squashed)) * progress,
+            white_share,
+            black_share,
+            white_share - black_share,
+            np.log((np.asarray(white_clock) + 1.0) / (np.asarray(black_clock) + 1.0)),
+            plies % 2,
+        ]
+    )
+
+
+def parse_time_control(time_controls):
+    """:return: base and increment seconds of "180+2" time controls, NaN for "-" """
+    parts = [time_control.split("+") for time_control in time_controls]
+    parts = [part if len(part) == 2 else ["nan", "nan"] for part in parts]
+    return np.array(parts, dtype=np.float64).reshape(-1, 2).T
+
+
+def sample_positions(data, plies_per_game, rng):
+    """
+    Random positions of finished games with their features.
+
+    Every game gets plies_per_game positions drawn from the start (0 plies) to the end, so long
+    and short games count the same.
+
+    :param data: raw shard chunk with the LIVE_COLUMNS
+    :return: (features, results) of the positions
+    """
+    base_time, increment_time = parse_time_control(data["TimeControl"])
+    clocks, offsets = times_to_ragged(data["times_list"])
+    evals, eval_offsets = evals_to_ragged(data["evaluations_list"])
+    if not np.array_equal(offsets, eval_offsets):
+        raise ValueError("The clocks and evals of the games have different lengths")
+    # a padding value, so positions before the first move can index the arrays
+    clocks, evals = np.append(clocks, 0), np.append(evals, EVAL_MISSING)
+
+    is_valid = ~np.isnan(base_time) & np.isin(data["Result"].to_numpy(dtype=str), LIVE_CLASSES)
+    game_ids = np.repeat(np.flatnonzero(is_valid), plies_per_game)
+    n_plies = np.diff(offsets)
+    plies = rng.integers(0, n_plies[game_ids] + 1)
+    starts = offsets[:-1][game_ids]
+
+    # last clock of white: ply 0, 2, ..., of black: ply 1, 3, ... before the position
+    white_ply, black_ply = (plies - 1) // 2 * 2, (plies - 2) // 2 * 2 + 1
+    white_clock = np.where(
+        white_ply >= 0, clocks[starts + np.maximum(white_ply, 0)], base_time[game_ids]
+    )
+    black_clock = np.where(
+        black_ply >= 0, clocks[starts + np.maximum(black_ply, 0)], base_time[game_ids]
+    )
+
+    # the last known eval of the game before the position
+    is_known = evals != EVAL_MISSING
+    last_known = np.maximum.accumulate(np.where(is_known, np.arange(len(evals)), -1))
+    known_idx = last_known[np.where(plies > 0, starts + plies - 1, len(evals) - 1)]
+    has_eval = (plies > 0) & (known_idx >= starts)
+    evaluation = np.where(has_eval, evals[known_idx], 0)
+
+    elo_diff = data["WhiteElo"].to_numpy(dtype=np.float64) - data["BlackElo"].to_numpy(
+        dtype=np.float64
+    )
+    features = live_features(
+        elo_diff[game_ids],
+        base_time[game_ids],
+        increment_time[game_ids],
+        white_clock,
+        black_clock,
+        evaluation,
+        has_eval,
+        plies,
+    )
+    return features, data["Result"].to_numpy(dtype=str)[game_ids]
+
+
+class LiveWinProbabilityModel:
+    """
+    Multinomial logistic regression of the result on the position of a running game: ratings,
+    remaining clocks, the last eval and the number of moves played, see live_features.
+
+    Predicting is a (n, 12) x (12, 3) product and a softmax, so updating a game costs the same at
+    any move. The classes are in the order of the sklearn baselines: "0-1", "1-0", "1/2-1/2".
+
+    :param regularization: inverse regularization strength of the logistic regression
+    """
+
+    def __init__(self, regularization=1.0):
+        self.regularization = regularization
+        self.classes_ = LIVE_CLASSES
+        self.coef = np.zeros((len(LIVE_CLASSES), len(LIVE_FEATURES)))
+        self.intercept = np.zeros(len(LIVE_CLASSES))
+
+    def fit(
+        self, file_paths, max_games=200000, plies_per_game=8, chunk_size=125000, random_state=42
+    ):
+        """
+        :param file_paths: raw ".csv" or ".parquet" shards of pgn_zst_to_csv, with the clocks and
+            evals of the moves
+        :param max_games: number of games to take positions from
+        :param plies_per_game: number of random positions of every game
+        """
+        rng = np.random.default_rng(random_state)
+        features, results, n_games = [], [], 0
+        for file_path in file_paths:
+            for chunk in iter_data_file_chunks(file_path, chunk_size, LIVE_COLUMNS):
+                chunk = chunk.iloc[: max_games - n_games]
+                chunk_features, chunk_results = sample_positions(chunk, plies_per_game, rng)
+                features.append(chunk_features)
+                results.append(chunk_results)
+                n_games += len(chunk)
+                if n_games >= max_games:
+                    break
+            if n_games >= max_games:
+                break
+
+        regression = LogisticRegression(C=self.regularization, max_iter=1000)
+        regression.fit(np.concatenate(features), np.concatenate(results))
+        coef, intercept = regression.coef_, regression.intercept_
+        if len(regression.classes_) == 2:
+            # a binary regression has the logits of the second class against the first one
+            coef = np.vstack([np.zeros_like(coef), coef])
+            intercept = np.concatenate([[0.0], intercept])
+
+        # a class without training positions gets probability 0
+        self.coef = np.zeros((len(LIVE_CLASSES), len(LIVE_FEATURES)))
+        self.intercept = np.full(len(LIVE_CLASSES), -np.inf)
+        class_idx = np.searchsorted(LIVE_CLASSES, regression.classes_)
+        self.coef[class_idx], self.intercept[class_idx] = coef, intercept
+        return self
+
+    def predict_proba(self, features):
+        logits = features @ self.coef.T + self.intercept
+        logits -= logits.max(axis=1, keepdims=True)
+        proba = np.exp(logits)
+        return proba / proba.sum(axis=1, keepdims=True)
+
+    def save(self, path):
+        np.savez(
+            path, regularization=self.regularization, coef=self.coef, intercept=self.intercept
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            model = cls(float(state["regularization"]))
+            model.coef, model.intercept = state["coef"], state["intercept"]
+        return model
+
+
+class LiveGameTable:
+    """
+    State of many running games in flat arrays of 25 bytes per game, updated in batches.
+
+    A game gets a slot in start_game and gives it back in end_game. update_batch applies the moves
+    of any number of games with one feature computation and one model product, the moves of a game
+    that appears several times in a batch are applied in their order.
+
+    :param model: fitted LiveWinProbabilityModel
+    :param capacity: initial number of slots, the arrays grow when needed
+    """
+
+    def __init__(self, model, capacity=INITIAL_CAPACITY):
+        self.model = model
+        self._slots = {}
+        self._free_slots = []
+        self._n_used = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        state = {
+            "elo_diff": np.zeros(capacity, dtype=np.float32),
+            "base_time": np.zeros(capacity, dtype=np.int32),
+            "increment_time": np.zeros(capacity, dtype=np.int32),
+            "white_clock": np.zeros(capacity, dtype=np.int32),
+            "black_clock": np.zeros(capacity, dtype=np.int32),
+            "evaluation": np.zeros(capacity, dtype=np.int16),
+            "has_eval": np.zeros(capacity, dtype=bool),
+            "plies": np.zeros(capacity, dtype=np.int16),
+        }
+        for name, column in state.items():
+            old_column = getattr(self, name, None)
+            if old_column is not None:
+                column[: len(old_column)] = old_column
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, game_id):
+        return game_id in self._slots
+
+    def _features(self, slots):
+        return live_features(
+            self.elo_diff[slots],
+            self.base_time[slots],
+            self.increment_time[slots],
+            self.white_clock[slots],
+            self.black_clock[slots],
+            self.evaluation[slots],
+            self.has_eval[slots],
+            self.plies[slots],
+        )
+
+    def start_game(self, game_id, headers):
+        """
+        :param headers: PGN headers with WhiteElo, BlackElo and TimeControl, e.g. of parse_headers
+        :return: probabilities before the first move
+        """
+        if game_id in self._slots:
+            raise ValueError(f"Game {game_id} is already running")
+        # the headers are parsed before a slot is taken, so a game with bad headers is not kept
+        (base_time,), (increment_time,) = parse_time_control([headers["TimeControl"]])
+        if np.isnan(base_time):
+            base_time = increment_time = 0
+        try:
+            elo_diff = float(headers["WhiteElo"]) - float(headers["BlackElo"])
+        except ValueError:
+            raise ValueError(
+                f"Game {game_id} has no ratings: {headers['WhiteElo']}, {headers['BlackElo']}"
+            ) from None
+
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            slot = self._n_used
+            self._n_used += 1
+            if self._n_used > len(self.plies):
+                self._allocate(2 * len(self.plies))
+        self._slots[game_id] = slot
+
+        self.elo_diff[slot] = elo_diff
+        self.base_time[slot], self.increment_time[slot] = base_time, increment_time
+        self.white_clock[slot] = self.black_clock[slot] = base_time
+        self.evaluation[slot], self.has_eval[slot], self.plies[slot] = 0, False, 0
+        return self.model.predict_proba(self._features([slot]))[0]
+
+    def end_game(self, game_id):
+        self._free_slots.append(self._slots.pop(game_id))
+
+    def update_batch(self, game_ids, clocks, evaluations=None):
+        """
+        Applies one move per entry.
+
+        :param game_ids: ids of started games
+        :param clocks: remaining seconds of the side that moved, after the move
+        :param evaluations: optional evals after the moves in centipawns, EVAL_MISSING if unknown
+        :return: (n_moves, 3) probabilities after every move, in the order of model.classes_
+        """
+        try:
+            slots = np.fromiter((self._slots[game_id] for game_id in game_ids), dtype=np.int64)
+        except KeyError as e:
+            raise ValueError(f"Game {e.args[0]} was not started") from None
+        clocks = np.asarray(clocks, dtype=np.int32)
+        if evaluations is None:
+            evaluations = np.full(len(slots), EVAL_MISSING, dtype=np.int16)
+        evaluations = np.asarray(evaluations, dtype=np.int16)
+
+        # rank of every move among the moves of its game in the batch
+        order = np.argsort(slots, kind="stable")
+        sorted_slots = slots[order]
+        is_first = np.ones(len(slots), dtype=bool)
+        is_first[1:] = sorted_slots[1:] != sorted_slots[:-1]
+        group_starts = np.maximum.accumulate(np.where(is_first, np.arange(len(slots)), 0))
+        ranks = np.empty(len(slots), dtype=np.int64)
+        ranks[order] = np.arange(len(slots)) - group_starts
+
+        proba = np.empty((len(slots), len(self.model.classes_)))
+        for rank in range(ranks.max() + 1 if len(slots) else 0):
+            moves = np.flatnonzero(ranks == rank)
+            round_slots = slots[moves]
+            is_white = self.plies[round_slots] % 2 == 0
+            self.white_clock[round_slots[is_white]] = clocks[moves[is_white]]
+            self.black_clock[round_slots[~is_white]] = clocks[moves[~is_white]]
+            is_known = evaluations[moves] != EVAL_MISSING
+            self.evaluation[round_slots[is_known]] = evaluations[moves[is_known]]
+            self.has_eval[round_slots[is_known]] = True
+            self.plies[round_slots] += 1
+            proba[moves] = self.model.predict_proba(self._features(round_slots))
+        return proba
+
+    def update(self, game_id, clock, evaluation=EVAL_MISSING):
+        return self.update_batch([game_id], [clock], [evaluation])[0]
+
+
+class LivePredictionServer:
+    """
+    asyncio front of a LiveGameTable: every game coroutine awaits move, and the moves that arrive
+    while a batch is collected are applied together, so thousands of games share one update.
+
+    :param table: LiveGameTable of the games
+    :param batch_size: largest number of moves applied at once
+    :param max_delay: seconds to wait for more moves after the first one of a batch
+    """
+
+    def __init__(self, table, batch_size=4096, max_delay=0.001):
+        self.table = table
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._queue = asyncio.Queue()
+
+    def start_game(self, game_id, headers):
+        return self.table.start_game(game_id, headers)
+
+    def end_game(self, game_id):
+        """Frees the game, after the probabilities of its last move were received."""
+        self.table.end_game(game_id)
+
+    async def move(self, game_id, clock, evaluation=EVAL_MISSING):
+        """:return: probabilities after the move, in the order of model.classes_"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((game_id, clock, evaluation, future))
+        return await future
+
+    async def run(self):
+        """Applies the queued moves until cancelled."""
+        while True:
+            events = [await self._queue.get()]
+            if self.max_delay:
+                await asyncio.sleep(self.max_delay)
+            while len(events) < self.batch_size and not self._queue.empty():
+                events.append(self._queue.get_nowait())
+
+            # a move of an unknown or ended game fails alone, the other moves are applied
+            for game_id, _, _, future in events:
+                if game_id not in self.table and not future.done():
+                    future.set_exception(ValueError(f"Game {game_id} was not started"))
+            events = [event for event in events if event[0] in self.table]
+            if not events:
+                continue
+
+            game_ids, clocks, evaluations, futures = zip(*events)
+            try:
+                proba = self.table.update_batch(game_ids, clocks, evaluations)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, move_proba in zip(futures, proba):
+                if not future.done():
+                    future.set_result(move_proba)
+
+
+def replay_pgn_games(records, table, batch_games=1024):
+    """
+    Replays the games of a PGN stream move by move, batch_games of them side by side.
+
+    Games without ratings or with an unreadable TimeControl are skipped, as start_game rejects
+    them.
+
+    :param records: PGN records, e.g. PGNStreamScanner.iter_records()
+    :param table: LiveGameTable, the games are started and ended in it
+    :return: generator of (headers, (n_plies + 1, 3) probabilities from the start of the game
+        to its last move)
+    """
+    games, header_record = [], b""
+    for record in records:
+        if MOVES_PATTERN in record and header_record:
+            headers = parse_headers(header_record)
+            if _has_live_headers(headers):
+                _, evaluations, clocks, _ = parse_movetext(record)
+                games.append((headers, clocks, evaluations))
+            if len(games) == batch_games:
+                yield from _replay_batch(games, table)
+                games = []
+        header_record = record
+    if games:
+        yield from _replay_batch(games, table)
+
+
+def _has_live_headers(headers):
+    try:
+        float(headers["WhiteElo"]), float(headers["BlackElo"])
+        parse_time_control([headers["TimeControl"]])
+    except (KeyError, ValueError):
+        return False
+    return True
+
+
+def _replay_batch(games, table):
+    # private ids, unique to the batch, so they never clash with other games of the table
+    game_ids = [object() for _ in games]
+    trajectories, n_started = [], 0
+    try:
+        for game_id, (headers, clocks, _) in zip(game_ids, games):
+            trajectories.append(np.empty((len(clocks) + 1, len(table.model.classes_))))
+            trajectories[-1][0] = table.start_game(game_id, headers)
+            n_started += 1
+
+        n_plies = np.array([len(clocks) for _, clocks, _ in games])
+        for ply in range(n_plies.max(initial=0)):
+            running = np.flatnonzero(n_plies > ply)
+            proba = table.update_batch(
+                [game_ids[idx] for idx in running],
+                [games[idx][1][ply] for idx in running],
+                [games[idx][2][ply] for idx in running],
+            )
+            for idx, move_proba in zip(running, proba):
+                trajectories[idx][ply + 1] = move_proba
+    finally:
+        for game_id in game_ids[:n_started]:
+            table.end_game(game_id)
+
+    for (headers, _, _), trajectory in zip(games, trajectories):
+        yield headers, trajectory
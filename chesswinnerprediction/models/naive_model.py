@@ -1,4 +1,5 @@
 import numpy as np
+from sklearn.linear_model import LogisticRegression
 
 from chesswinnerprediction.constants import (
     WHITE_WIN_STR,
@@ -27,3 +28,177 @@ def estimate_prediction_by_elo(white_elo, black_elo, result, count_draws=True):
     if count_draws:
         return right_predictions / len(white_elo)
     return right_predictions / np.sum(result != DRAW_STR)
+
+
+# Lichess time classes by the estimated game duration, base + 40 * increment seconds:
+# bullet, blitz, rapid, classical
+TIME_CLASS_BOUNDS = np.array([180, 480, 1500])
+ELO_SCALE = 400
+
+
+def time_classes(base_time, increment_time):
+    estimated_duration = np.asarray(base_time) + 40 * np.asarray(increment_time)
+    return np.searchsorted(TIME_CLASS_BOUNDS, estimated_duration, side="right")
+
+
+class EloHistogramModel:
+    """
+    Probabilistic Elo baseline: win/draw/loss probabilities by EloDiff, MeanElo and time class.
+
+    Games are only counted into a histogram of (EloDiff bin, MeanElo bin, time class, result), so
+    fitting is a multinomial logistic regression on the non-empty cells weighted by their counts,
+    O(bins) whatever the number of games, and the histograms of shards or months can be merged.
+    The probabilities of all cells are precomputed, predicting is a table lookup.
+
+    The classes are in the order of the sklearn baselines: "0-1", "1-0", "1/2-1/2".
+
+    :param diff_bin: width of the EloDiff bins, differences are clipped to +-max_diff
+    :param max_diff: largest rating difference with its own bins
+    :param mean_bin: width of the MeanElo bins, mean ratings are clipped to [min_mean, max_mean]
+    :param min_mean: lowest mean rating
+    :param max_mean: highest mean rating
+    :param regularization: inverse regularization strength of the logistic regression
+    """
+
+    classes_ = np.array(sorted([WHITE_WIN_STR, BLACK_WIN_STR, DRAW_STR]))
+
+    def __init__(
+        self,
+        diff_bin=25,
+        max_diff=800,
+        mean_bin=100,
+        min_mean=600,
+        max_mean=3000,
+        regularization=1.0,
+    ):
+        self.diff_bin, self.max_diff = diff_bin, max_diff
+        self.mean_bin, self.min_mean, self.max_mean = mean_bin, min_mean, max_mean
+        self.regularization = regularization
+
+        self.n_diff_bins = 2 * (max_diff // diff_bin) + 1
+        self.n_mean_bins = (max_mean - min_mean) // mean_bin + 1
+        self.n_time_classes = len(TIME_CLASS_BOUNDS) + 1
+        self.shape = (self.n_diff_bins, self.n_mean_bins, self.n_time_classes)
+        self.counts = np.zeros(self.shape + (len(self.classes_),), dtype=np.int64)
+        self.proba_table = None
+
+    def cells(self, white_elo, black_elo, base_time, increment_time):
+        """Flat histogram cell of every game."""
+        white_elo = np.asarray(white_elo, dtype=np.int64)
+        black_elo = np.asarray(black_elo, dtype=np.int64)
+        elo_diff = np.clip(white_elo - black_elo, -self.max_diff, self.max_diff)
+        diff_bins = (elo_diff + self.max_diff + self.diff_bin // 2) // self.diff_bin
+        mean_elo = np.clip((white_elo + black_elo) // 2, self.min_mean, self.max_mean)
+        mean_bins = (mean_elo - self.min_mean) // self.mean_bin
+        time_class = time_classes(base_time, increment_time)
+        return np.ravel_multi_index((diff_bins, mean_bins, time_class), self.shape)
+
+    def _data_cells(self, data):
+        return self.cells(
+            data["WhiteElo"], data["BlackElo"], data["BaseTime"], data["IncrementTime"]
+        )
+
+    def _outcomes(self, data):
+        results = np.asarray(data["Result"], dtype=str)
+        is_known = np.isin(results, self.classes_)
+        if not is_known.all():
+            unknown = sorted(set(results[~is_known].tolist()))
+            raise ValueError(f"Results {unknown} are not in the classes of the model, drop them")
+        return np.searchsorted(self.classes_, results)
+
+    def partial_fit(self, data):
+        """Counts the games of a chunk with WhiteElo, BlackElo, BaseTime, IncrementTime and Result."""
+        outcomes = self._outcomes(data)
+        flat_idx = self._data_cells(data) * len(self.classes_) + outcomes
+        self.counts += np.bincount(flat_idx, minlength=self.counts.size).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        """Adds the histogram of another model with the same bins, e.g. fitted on another shard."""
+        if other.counts.shape != self.counts.shape:
+            raise ValueError("Only models with the same bins can be merged")
+        self.counts += other.counts
+        return self
+
+    def cell_features(self):
+        """Features of the centers of all cells, in the flat cell order."""
+        cell_idx = np.arange(np.prod(self.shape))
+        diff_idx, mean_idx, time_class = np.unravel_index(cell_idx, self.shape)
+        elo_diff = (diff_idx * self.diff_bin - self.max_diff) / ELO_SCALE
+        mean_elo = (self.min_mean + (mean_idx + 0.5) * self.mean_bin - 1500) / ELO_SCALE
+        abs_diff = np.abs(elo_diff)
+
+        features = [elo_diff, abs_diff, elo_diff**2, mean_elo, mean_elo**2, elo_diff * mean_elo]
+        features.append(abs_diff * mean_elo)
+        for time_class_idx in range(1, self.n_time_classes):
+            is_class = (time_class == time_class_idx).astype(np.float64)
+            features += [is_class, is_class * elo_diff, is_class * abs_diff, is_class * mean_elo]
+        return np.column_stack(features)
+
+    def fit(self, data=None):
+        """
+        Fits the probability table on the histogram, after counting data if it is given.
+
+        :return: self
+        """
+        if data is not None:
+            self.partial_fit(data)
+
+        n_classes = len(self.classes_)
+        flat_counts = self.counts.reshape(-1, n_classes)
+        cell_idx, outcomes = np.nonzero(flat_counts)
+        if not len(cell_idx):
+            raise ValueError("No games to fit the model on")
+
+        features = self.cell_features()
+        logistic_regression = LogisticRegression(C=self.regularization, max_iter=1000)
+        logistic_regression.fit(
+            features[cell_idx],
+            self.classes_[outcomes],
+            sample_weight=flat_counts[cell_idx, outcomes],
+        )
+        # a class missing from the histogram gets probability 0
+        proba_table = np.zeros((len(features), n_classes))
+        class_idx = np.searchsorted(self.classes_, logistic_regression.classes_)
+        proba_table[:, class_idx] = logistic_regression.predict_proba(features)
+        self.proba_table = proba_table
+        return self
+
+    def predict_proba(self, data):
+        """:return: (n_games, 3) probabilities of the classes_"""
+        if self.proba_table is None:
+            raise ValueError("The model is not fitted")
+        return self.proba_table[self._data_cells(data)]
+
+    def predict(self, data):
+        return self.classes_[np.argmax(self.predict_proba(data), axis=1)]
+
+    def log_loss(self, data, eps=1e-15):
+        """Mean log loss of the games of data, the same value as sklearn.metrics.log_loss."""
+        outcomes = self._outcomes(data)
+        proba = self.predict_proba(data)[np.arange(len(outcomes)), outcomes]
+        return -np.mean(np.log(np.clip(proba, eps, 1)))
+
+    def histogram_log_loss(self, counts, eps=1e-15):
+        """Mean log loss of the games of a histogram, e.g. of the test set, in O(bins)."""
+        flat_counts = counts.reshape(-1, len(self.classes_))
+        log_proba = np.log(np.clip(self.proba_table, eps, 1))
+        return -(flat_counts * log_proba).sum() / flat_counts.sum()
+
+    def save(self, path):
+        np.savez(
+            path,
+            bins=[self.diff_bin, self.max_diff, self.mean_bin, self.min_mean, self.max_mean],
+            regularization=self.regularization,
+            counts=self.counts,
+            proba_table=self.proba_table if self.proba_table is not None else np.empty(0),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            model = cls(*state["bins"].tolist(), regularization=float(state["regularization"]))
+            model.counts = state["counts"]
+            if state["proba_table"].size:
+                model.proba_table = state["proba_table"]
+        return model
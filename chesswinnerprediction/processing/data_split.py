@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from chesswinnerprediction.processing.stream_writer import DataFrameStreamWriter
+from chesswinnerprediction.processing.utils import iter_data_file_chunks
+
+SPLIT_NAMES = ["train", "valid", "test"]
+HASH_MODE, TIME_MODE = "hash", "time"
+
+
+def count_rows(file_path, chunk_size=125000):
+    if file_path.endswith(".parquet"):
+        return pq.ParquetFile(file_path).metadata.num_rows
+    # a single column is enough to count the games of a csv file
+    first_column = pd.read_csv(file_path, nrows=0).columns[0]
+    return sum(
+        len(chunk) for chunk in iter_data_file_chunks(file_path, chunk_size, [first_column])
+    )
+
+
+def hash_fractions(keys, random_state=42):
+    """Maps keys to [0, 1), the same key gets the same value in every run and on every machine."""
+    hash_key = f"{random_state:016d}"[-16:]
+    hashes = pd.util.hash_array(np.asarray(keys, dtype=str).astype(object), hash_key=hash_key)
+    # the top 53 bits fit a float64 exactly
+    return (hashes >> np.uint64(11)).astype(np.float64) / 2**53
+
+
+def fractions_to_splits(fractions, split_sizes):
+    """Index in SPLIT_NAMES of every fraction, split i takes [sum(sizes[:i]), sum(sizes[:i + 1]))."""
+    bounds = np.cumsum(split_sizes)[:-1]
+    return np.searchsorted(bounds, fractions, side="right")
+
+
+def split_file(
+    file_path,
+    output_paths,
+    split_sizes,
+    mode=HASH_MODE,
+    key_column="Site",
+    random_state=42,
+    chunk_size=125000,
+    train_sampler=None,
+):
+    """
+    Splits a processed file into train, valid and test files one chunk at a time.
+
+    In the "hash" mode a game goes to a split by the hash of its key_column, so the assignment
+    does not depend on the order or the number of rows, and all games of one key (e.g. "White"
+    for a split by player) end up in the same split. In the "time" mode the file is split into
+    consecutive parts, the games have to be in chronological order, as in the files written with
+    process_and_concat_raw_data(..., ordered=True), so validation and test games are played after
+    the training ones.
+
+    :param file_path: processed ".csv" or ".parquet" file
+    :param output_paths: paths of the train, valid and test files
+    :param split_sizes: fractions of the train, valid and test splits
+    :param mode: "hash" or "time"
+    :param key_column: column to hash in the "hash" mode
+    :param random_state: seed of the hash, another value gives another split
+    :param chunk_size: number of games read at once
+    :param train_sampler: optional sampling.ReservoirSampler to feed the training games to, e.g.
+        to write small experiment subsets of the training split
+    :return: list of the number of games in every split
+    """
+    if mode == TIME_MODE:
+        n_rows = count_rows(file_path, chunk_size)
+    elif mode != HASH_MODE:
+        raise ValueError(f"Unknown split mode: {mode}")
+
+    writers = [DataFrameStreamWriter(output_path) for output_path in output_paths]
+    n_read = 0
+    try:
+        for chunk in iter_data_file_chunks(file_path, chunk_size):
+            if mode == HASH_MODE:
+                if key_column not in chunk.columns:
+                    raise ValueError(f"No {key_column} column in {file_path} to split by")
+                fractions = hash_fractions(chunk[key_column], random_state)
+            else:
+                fractions = (n_read + np.arange(len(chunk))) / n_rows
+            n_read += len(chunk)
+
+            splits = fractions_to_splits(fractions, split_sizes)
+            for split, writer in enumerate(writers):
+                writer.write(chunk[splits == split])
+            if train_sampler is not None:
+                train_sampler.update(chunk[splits == 0])
+    finally:
+        for writer in writers:
+            writer.close()
+
+    return [writer.n_rows for writer in writers]
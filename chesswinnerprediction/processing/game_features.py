@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+
+from chesswinnerprediction.dataloader.movetext import EVAL_MISSING, evals_to_centipawns
+
+# A side is in time trouble once its clock is below this part of the base time
+TIME_TROUBLE_FRACTION = 0.1
+# Evals are capped before taking differences, so a mate or a won position is one large value
+EVAL_CAP = 1000  # centipawns
+BLUNDER_CENTIPAWNS = 300
+EVAL_AT_MOVES = [10, 20, 30]
+
+SIDES = ["White", "Black"]
+
+
+def evals_to_ragged(evaluations_list):
+    """
+    Converts per-game eval lists to one flat array, the same way as utils.times_to_ragged.
+
+    :param evaluations_list: eval lists as arrays (parquet shards) or strings (csv shards), either
+        int16 centipawns "[17, -32768, ...]" or the old "['0.17', '#-3', ...]"
+    :return: (int16 array of centipawns of all games, see dataloader.movetext, int64 array of
+        len(evaluations_list) + 1 offsets)
+    """
+    evaluations_list = list(evaluations_list)
+    if evaluations_list and isinstance(evaluations_list[0], str):
+        lengths = [evals_str.count(",") + (len(evals_str) > 2) for evals_str in evaluations_list]
+        text = " ".join(evaluations_list)
+        is_old_format = "'" in text
+        for symbol in "[]',":
+            text = text.replace(symbol, " ")
+        if is_old_format:
+            values = evals_to_centipawns(text)
+        elif sum(lengths):
+            values = np.fromstring(text, dtype=np.int16, sep=" ")
+        else:
+            values = np.array([], dtype=np.int16)
+        if len(values) != sum(lengths):
+            raise ValueError("The eval lists could not be parsed to their number of moves")
+    else:
+        lengths = [len(evaluations) for evaluations in evaluations_list]
+        values = np.concatenate(evaluations_list or [[]]).astype(np.int16)
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return values, offsets
+
+
+def ply_positions(offsets):
+    """:return: (game index of every ply of the flat array, index of the ply within its game)"""
+    game_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return game_ids, np.arange(offsets[-1]) - offsets[:-1][game_ids]
+
+
+def segment_sum(values, segments, n_segments):
+    return np.bincount(segments, weights=values, minlength=n_segments)
+
+
+def segment_extreme(ufunc, values, segments, n_segments):
+    """
+    ufunc.reduce of every segment (np.maximum or np.minimum), NaN for an empty segment.
+
+    Sorted segments, e.g. the game ids of ply_positions, are reduced in place with reduceat,
+    others are sorted first.
+    """
+    result = np.full(n_segments, np.nan)
+    if not len(values):
+        return result
+    if (segments[1:] < segments[:-1]).any():
+        order = np.argsort(segments, kind="stable")
+        values, segments = values[order], segments[order]
+    is_start = np.ones(len(segments), dtype=bool)
+    is_start[1:] = segments[1:] != segments[:-1]
+    starts = np.flatnonzero(is_start)
+    result[segments[starts]] = ufunc.reduceat(values, starts)
+    return result
+
+
+def side_major_order(game_ids, plies, n_games):
+    """
+    Order of the plies by side and game, with the side-major segment id of every ordered ply, so
+    per-side extremes are one sorted segment_extreme, see side_extreme.
+    """
+    is_black = plies % 2 == 1
+    order = np.concatenate([np.flatnonzero(~is_black), np.flatnonzero(is_black)])
+    return order, game_ids[order] + n_games * is_black[order]
+
+
+def side_extreme(ufunc, values, side_order, n_games):
+    """segment_extreme of the plies of every side, in the order of add_side_columns."""
+    order, segments = side_order
+    result = segment_extreme(ufunc, values[order], segments, 2 * n_games)
+    return result.reshape(2, n_games).T.ravel()
+
+
+def segment_mean(values, segments, n_segments):
+    counts = np.bincount(segments, minlength=n_segments)
+    sums = segment_sum(values, segments, n_segments)
+    return np.divide(sums, counts, out=np.full(n_segments, np.nan), where=counts > 0)
+
+
+def add_side_columns(data, name, side_values, dtype=np.float32):
+    # side_values are [white of game 0, black of game 0, white of game 1, ...]
+    for side, side_name in enumerate(SIDES):
+        data[f"{side_name}{name}"] = side_values[side::2].astype(dtype)
+
+
+def add_time_usage_features(data: pd.DataFrame, values, offsets) -> pd.DataFrame:
+    """
+    Adds per-side move time and time trouble features, see utils.times_to_ragged for the input.
+
+    The time of a move is the previous clock of the side + increment - its clock after the move,
+    the first move of a side is counted from the base time and without the increment.
+    """
+    n_games, n_sides = len(data), 2 * len(data)
+    game_ids, plies = ply_positions(offsets)
+    side_ids = 2 * game_ids + plies % 2
+    base_time = data["BaseTime"].to_numpy(dtype=np.int64)[game_ids]
+    increment_time = data["IncrementTime"].to_numpy(dtype=np.int64)[game_ids]
+
+    clocks = values.astype(np.int64)
+    is_first_move = plies < 2
+    previous_clocks = np.where(
+        is_first_move, base_time, clocks[np.maximum(np.arange(len(clocks)) - 2, 0)]
+    )
+    move_times = previous_clocks + np.where(is_first_move, 0, increment_time) - clocks
+    move_times = np.maximum(move_times, 0)
+    in_time_trouble = clocks < TIME_TROUBLE_FRACTION * base_time
+
+    time_trouble_moves = np.bincount(side_ids[in_time_trouble], minlength=n_sides)
+    add_side_columns(data, "MeanMoveTime", segment_mean(move_times, side_ids, n_sides))
+    side_order = side_major_order(game_ids, plies, n_games)
+    add_side_columns(
+        data, "MaxMoveTime", side_extreme(np.maximum, move_times, side_order, n_games)
+    )
+    add_side_columns(data, "MinClock", side_extreme(np.minimum, clocks, side_order, n_games))
+    add_side_columns(data, "TimeTroubleMoves", time_trouble_moves, np.int16)
+    add_side_columns(data, "TimeTrouble", time_trouble_moves > 0, np.int8)
+    return data
+
+
+def add_eval_features(data: pd.DataFrame, evals, offsets) -> pd.DataFrame:
+    """
+    Adds eval trajectory features, see evals_to_ragged for the input.
+
+    The eval loss of a move is how much it worsened the eval for the side that made it, both
+    evals capped at +-EVAL_CAP. Games without evals get NaN features and HasEvals = 0.
+    """
+    n_games, n_sides = len(data), 2 * len(data)
+    game_ids, plies = ply_positions(offsets)
+    ply_idx = np.arange(len(evals))
+    is_known = evals != EVAL_MISSING
+    capped = np.clip(evals, -EVAL_CAP, EVAL_CAP).astype(np.float64)
+
+    known_games = game_ids[is_known]
+    data["HasEvals"] = (np.bincount(known_games, minlength=n_games) > 0).astype(np.int8)
+    max_evals = segment_extreme(np.maximum, capped[is_known], known_games, n_games)
+    min_evals = segment_extreme(np.minimum, capped[is_known], known_games, n_games)
+    data["EvalSwing"] = (max_evals - min_evals).astype(np.float32)
+
+    last_known = segment_extreme(np.maximum, ply_idx[is_known], known_games, n_games)
+    has_known = ~np.isnan(last_known)
+    final_evals = np.full(n_games, np.nan)
+    final_evals[has_known] = capped[last_known[has_known].astype(np.int64)]
+    data["FinalEval"] = final_evals.astype(np.float32)
+
+    n_plies = np.diff(offsets)
+    for move in EVAL_AT_MOVES:
+        # the eval after the move of black
+        ply = offsets[:-1] + 2 * move - 1
+        is_valid = n_plies >= 2 * move
+        is_valid[is_valid] = is_known[ply[is_valid]]
+        evals_at_move = np.full(n_games, np.nan, dtype=np.float32)
+        evals_at_move[is_valid] = capped[ply[is_valid]]
+        data[f"EvalAtMove{move}"] = evals_at_move
+
+    previous_idx = np.maximum(ply_idx - 1, 0)
+    has_loss = (plies > 0) & is_known & is_known[previous_idx]
+    eval_changes = capped - capped[previous_idx]
+    # white wants the eval to go up, black wants it to go down
+    losses = np.maximum(np.where(plies % 2 == 0, -eval_changes, eval_changes), 0)[has_loss]
+    loss_side_ids = (2 * game_ids + plies % 2)[has_loss]
+
+    blunders = np.bincount(loss_side_ids[losses >= BLUNDER_CENTIPAWNS], minlength=n_sides)
+    has_side_losses = np.bincount(loss_side_ids, minlength=n_sides) > 0
+    add_side_columns(data, "MeanEvalLoss", segment_mean(losses, loss_side_ids, n_sides))
+    add_side_columns(
+        data,
+        "MaxEvalLoss",
+        side_extreme(
+            np.maximum,
+            losses,
+            side_major_order(game_ids[has_loss], plies[has_loss], n_games),
+            n_games,
+        ),
+    )
+    add_side_columns(data, "Blunders", np.where(has_side_losses, blunders, np.nan))
+    return data
@@ -0,0 +1,245 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from chesswinnerprediction.constants import (
+    BASE_NAME,
+    BASE_URL,
+    MIN_DATE,
+    EXTERNAL_FOLDER_PATH,
+    RAW_FOLDER_PATH,
+    INTERIM_FOLDER_PATH,
+)
+from chesswinnerprediction.dataloader.download_pgn_zst import download_file
+from chesswinnerprediction.dataloader.pgn_zst_to_csv import (
+    PARALLEL_BLOCK_SIZE,
+    count_saved_shards,
+    pgn_zst_to_dataframe,
+)
+from chesswinnerprediction.processing.process_and_concat_raw_data import (
+    process_and_concat_raw_data,
+)
+
+# Stages of a month in the manifest, in the order they are done
+DOWNLOADED, DECODED, PROCESSED = "downloaded", "decoded", "processed"
+STAGES = [DOWNLOADED, DECODED, PROCESSED]
+
+# Rough memory use, used only to decide how many jobs can run at once
+RAW_GAME_MEMORY = 4 * 1024  # one parsed game waiting in the shard buffer
+PROCESSED_GAME_MEMORY = 1024  # one processed game waiting to be written
+BLOCK_MEMORY_FACTOR = 8  # parsed block size relative to the decompressed block
+
+
+def archive_months(start_month=MIN_DATE, end_month=None):
+    """
+    :param start_month: first month as "YYYY-MM", not earlier than MIN_DATE
+    :param end_month: last month, default - the previous month, the latest published archive
+    :return: list of "YYYY-MM" months
+    """
+    if start_month < MIN_DATE:
+        raise ValueError(
+            f"Data in {start_month} does not contain 'clk' and 'eval' data. "
+            f"You must use data from {MIN_DATE} or later!"
+        )
+    if end_month is None:
+        today = date.today()
+        year, month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+        end_month = f"{year}-{month:02d}"
+
+    year, month = map(int, start_month.split("-"))
+    months = []
+    while f"{year}-{month:02d}" <= end_month:
+        months.append(f"{year}-{month:02d}")
+        year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+    return months
+
+
+def archive_url(month):
+    return f"{BASE_URL}{BASE_NAME}{month}.pgn.zst"
+
+
+class IngestionManifest:
+    """
+    JSON file with the progress of every month, saved after each finished stage.
+
+    An entry looks like {"stage": "decoded", "n_shards": 90, ...}, a failed month also has
+    an "error" field that is cleared once the month is retried.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self._lock = threading.Lock()
+        self.months = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self.months = json.load(manifest_file)["months"]
+
+    def stage(self, month):
+        return self.months.get(month, {}).get("stage")
+
+    def is_done(self, month, stage):
+        month_stage = self.stage(month)
+        return month_stage is not None and STAGES.index(month_stage) >= STAGES.index(stage)
+
+    def update(self, month, **fields):
+        with self._lock:
+            self.months.setdefault(month, {}).update(fields)
+            tmp_manifest_path = self.manifest_path + ".tmp"
+            with open(tmp_manifest_path, "w") as manifest_file:
+                json.dump({"months": self.months}, manifest_file, indent=2, sort_keys=True)
+            os.replace(tmp_manifest_path, self.manifest_path)
+
+
+class ResourceLimiter:
+    """Counting semaphore that can take several units at once, e.g. cores or megabytes."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._used = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, amount):
+        # a job larger than the whole budget still runs, but alone
+        amount = min(amount, self.capacity)
+        with self._condition:
+            self._condition.wait_for(lambda: self._used + amount <= self.capacity)
+            self._used += amount
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._used -= amount
+                self._condition.notify_all()
+
+
+def estimate_decode_memory_mb(split_size, n_jobs):
+    in_flight_blocks = 2 * n_jobs * PARALLEL_BLOCK_SIZE * BLOCK_MEMORY_FACTOR
+    return (split_size * RAW_GAME_MEMORY + in_flight_blocks) // 2**20
+
+
+def estimate_process_memory_mb(split_size, n_jobs):
+    # process_and_concat_raw_data keeps at most 2 * n_jobs shards in flight
+    in_flight_shards = 2 * n_jobs * split_size * (RAW_GAME_MEMORY + PROCESSED_GAME_MEMORY)
+    return in_flight_shards // 2**20
+
+
+class ArchiveIngestion:
+    """
+    Downloads, decodes and processes monthly Lichess archives concurrently.
+
+    Every month goes through download -> decode to raw shards -> process to one interim file.
+    Months run in parallel, while the stages share three budgets: concurrent downloads, CPU
+    cores and memory (estimated from the number of buffered games). Finished stages are recorded
+    in the manifest, so a rerun skips finished months and resumes decoding from the last saved
+    shard.
+
+    :param manifest_path: path of the JSON manifest
+    :param max_downloads: number of archives downloaded at once
+    :param n_cpus: number of cores shared by the decode and process jobs
+    :param memory_gb: memory budget shared by the decode and process jobs
+    :param n_jobs: number of processes of one decode or process job
+    :param split_size: number of games in one raw shard
+    :param output_format: "csv" or "parquet", used for the raw shards and the interim files
+    :param n_segments: number of byte ranges downloaded in parallel for one archive
+    :param delete_archives: delete an archive once its month is decoded
+    :param game_filter: optional GameFilter, every month gets its own copy of it
+    """
+
+    def __init__(
+        self,
+        manifest_path,
+        max_downloads=2,
+        n_cpus=None,
+        memory_gb=8,
+        n_jobs=4,
+        split_size=125000,
+        output_format="csv",
+        n_segments=1,
+        delete_archives=False,
+        game_filter=None,
+    ):
+        self.manifest = IngestionManifest(manifest_path)
+        self.n_cpus = n_cpus or os.cpu_count()
+        self.n_jobs = min(n_jobs, self.n_cpus)
+        self.split_size = split_size
+        self.output_format = output_format
+        self.n_segments = n_segments
+        self.delete_archives = delete_archives
+        self.game_filter = game_filter
+        self.max_decodes = max(self.n_cpus // self.n_jobs, 1)
+
+        self.network = ResourceLimiter(max_downloads)
+        self.cpus = ResourceLimiter(self.n_cpus)
+        self.memory = ResourceLimiter(int(memory_gb * 1024))
+
+    def download(self, month):
+        with self.network.reserve(1):
+            archive_path = download_file(archive_url(month), EXTERNAL_FOLDER_PATH, self.n_segments)
+        self.manifest.update(month, stage=DOWNLOADED, archive_path=archive_path)
+
+    def decode(self, month):
+        archive_path = self.manifest.months[month]["archive_path"]
+        raw_dir = os.path.join(RAW_FOLDER_PATH, f"{BASE_NAME}{month}")
+        os.makedirs(raw_dir, exist_ok=True)
+        game_filter = self.game_filter.empty_copy() if self.game_filter is not None else None
+
+        memory_mb = estimate_decode_memory_mb(self.split_size, self.n_jobs)
+        with self.cpus.reserve(self.n_jobs), self.memory.reserve(memory_mb):
+            # resume=True also continues a month whose decoding was interrupted
+            pgn_zst_to_dataframe(
+                archive_path,
+                raw_dir,
+                split_size=self.split_size,
+                n_jobs=self.n_jobs,
+                output_format=self.output_format,
+                resume=True,
+                game_filter=game_filter,
+            )
+
+        n_shards = count_saved_shards(raw_dir, self.output_format)
+        self.manifest.update(month, stage=DECODED, raw_dir=raw_dir, n_shards=n_shards)
+        if self.delete_archives:
+            os.remove(archive_path)
+
+    def process(self, month):
+        month_info = self.manifest.months[month]
+        os.makedirs(INTERIM_FOLDER_PATH, exist_ok=True)
+        interim_file = os.path.join(
+            INTERIM_FOLDER_PATH, f"{BASE_NAME}{month}.{self.output_format}"
+        )
+
+        memory_mb = estimate_process_memory_mb(self.split_size, self.n_jobs)
+        with self.cpus.reserve(self.n_jobs), self.memory.reserve(memory_mb):
+            process_and_concat_raw_data(month_info["raw_dir"], interim_file, n_jobs=self.n_jobs)
+        self.manifest.update(month, stage=PROCESSED, interim_file=interim_file)
+
+    def run_month(self, month):
+        try:
+            if not self.manifest.is_done(month, DECODED):
+                self.download(month)
+                self.decode(month)
+            if not self.manifest.is_done(month, PROCESSED):
+                self.process(month)
+            self.manifest.update(month, error=None)
+        except Exception as e:
+            print(f"Error in {month}: {e}")
+            self.manifest.update(month, error=str(e))
+
+    def run(self, months):
+        """
+        :param months: list of "YYYY-MM" months, see archive_months
+        :return: list of months that failed
+        """
+        months = [month for month in months if not self.manifest.is_done(month, PROCESSED)]
+        print(f"{len(months)} months to ingest")
+
+        # enough months in flight to keep every download and decode slot busy
+        max_workers = self.network.capacity + self.max_decodes
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.run_month, months))
+
+        return [month for month in months if self.manifest.months[month].get("error")]
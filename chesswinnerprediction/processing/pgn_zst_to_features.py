@@ -0,0 +1,76 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pandas as pd
+
+from chesswinnerprediction.dataloader.pgn_zst_to_csv import (
+    data_to_arrow_table,
+    imap_in_order,
+    open_pgn_zst_scanner,
+    parse_pgn_block,
+)
+from chesswinnerprediction.processing.stream_writer import DataFrameStreamWriter
+from chesswinnerprediction.processing.utils import process_data_df
+
+FEATURES_BLOCK_SIZE = 32 * 1024 * 1024
+
+
+def raw_data_to_features(data) -> pd.DataFrame:
+    if not data["chess_moves_list"]:
+        return pd.DataFrame()
+
+    # the arrow table has the same typed columns as a parquet raw shard
+    raw_df = data_to_arrow_table(data).to_pandas()
+    return process_data_df(raw_df)
+
+
+def pgn_block_to_features(block, game_filter=None) -> pd.DataFrame:
+    return raw_data_to_features(parse_pgn_block(block, game_filter))
+
+
+def pgn_block_to_features_with_filter(block, game_filter):
+    return pgn_block_to_features(block, game_filter), game_filter
+
+
+def pgn_zst_to_features(
+    pgn_zst_path, output_file, n_jobs=1, block_size=FEATURES_BLOCK_SIZE, game_filter=None
+):
+    """
+    Decodes a .pgn.zst archive and writes model-ready features in a single pass.
+
+    Every game-aligned block of the decompressed stream goes through the same processing as
+    process_and_concat_raw_data, but without saving and re-reading the raw shards.
+
+    :param pgn_zst_path: path to the .pgn.zst archive
+    :param output_file: ".csv" or ".parquet" file to write the processed games to
+    :param n_jobs: number of worker processes (0 or None - all cores)
+    :param block_size: size of the decompressed blocks processed at once
+    :param game_filter: optional GameFilter, the movetext of rejected games is not parsed
+    :return: number of written games
+    """
+    n_jobs = n_jobs or os.cpu_count()
+
+    with open_pgn_zst_scanner(pgn_zst_path, block_size) as scanner:
+        blocks = scanner.iter_game_blocks()
+        with DataFrameStreamWriter(output_file) as writer:
+            if n_jobs == 1:
+                for block in blocks:
+                    writer.write(pgn_block_to_features(block, game_filter))
+            else:
+                to_features = pgn_block_to_features
+                if game_filter is not None:
+                    to_features = partial(
+                        pgn_block_to_features_with_filter, game_filter=game_filter.empty_copy()
+                    )
+                with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                    for features in imap_in_order(executor, to_features, blocks, 2 * n_jobs):
+                        if game_filter is not None:
+                            features, block_filter = features
+                            game_filter.merge(block_filter)
+                        writer.write(features)
+
+    if game_filter is not None:
+        game_filter.report()
+    print(f"Saved {writer.n_rows} games to {output_file}")
+    return writer.n_rows
@@ -0,0 +1,276 @@
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from chesswinnerprediction.processing.stream_writer import DataFrameStreamWriter
+from chesswinnerprediction.processing.utils import iter_data_file_chunks
+
+PLAYER_HISTORY_COLUMNS = [
+    f"{side}{feature}"
+    for feature in ["Games", "Score", "RecentScore", "OppElo", "EloTrend"]
+    for side in ["White", "Black"]
+]
+
+INITIAL_CAPACITY = 1024
+NO_SCORE = 0.5  # score of a player without finished games
+FEATURE_DTYPES = {
+    "Games": np.int32,
+    "Score": np.float32,
+    "RecentScore": np.float32,
+    "OppElo": np.float32,
+    "EloTrend": np.int32,
+}
+
+
+def hash_player_names(names):
+    # a stable 64-bit hash, the same name gets the same key in every run and every month
+    return pd.util.hash_array(np.asarray(names, dtype=str).astype(object))
+
+
+def group_by_player(player_ids):
+    """
+    :return: (order that sorts the rows by player and keeps the game order within a player,
+        start of the group of every sorted row, index of every sorted row within its group)
+    """
+    order = np.argsort(player_ids, kind="stable")
+    sorted_ids = player_ids[order]
+    is_first = np.ones(len(sorted_ids), dtype=bool)
+    is_first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    group_starts = np.flatnonzero(is_first)
+    group_lengths = np.diff(np.append(group_starts, len(sorted_ids)))
+    row_starts = np.repeat(group_starts, group_lengths)
+    return order, row_starts, np.arange(len(sorted_ids)) - row_starts
+
+
+def exclusive_group_cumsum(values, row_starts):
+    cumsum = np.cumsum(values) - values
+    return cumsum - cumsum[row_starts]
+
+
+def group_ema_scan(values, ranks, decay):
+    """
+    Inclusive scan of the moving average update y -> (1 - decay) * y + decay * value per group.
+
+    Every row gets the update of all rows of its group up to it as y -> scale * y + shift, combined
+    by doubling: log2(longest group) vectorized steps instead of one step per row.
+
+    :return: (scale, shift) arrays
+    """
+    scale = np.full(len(values), 1 - decay)
+    shift = decay * values.astype(np.float64)
+    step = 1
+    while step <= ranks.max(initial=0):
+        rows = np.flatnonzero(ranks >= step)
+        scale[rows], shift[rows] = (
+            scale[rows] * scale[rows - step],
+            scale[rows] * shift[rows - step] + shift[rows],
+        )
+        step *= 2
+    return scale, shift
+
+
+class PlayerHistory:
+    """
+    Per-player state of all games seen so far, turned into point-in-time features of new games.
+
+    Games have to come in chronological order. A game gets the features of both players as they
+    were before the game, and only then the game is added to their state, so a feature never
+    depends on the result of its own game or of a later one.
+
+    The state is a set of numpy columns indexed by a player id, about 34 bytes per player:
+    a sorted array of 64-bit name hashes to find the id, the number of games, the points,
+    an exponential moving average of recent scores, the sum of opponent ratings and the last seen
+    rating. It can be saved and loaded to continue with the next monthly archive.
+
+    :param recent_decay: weight of the latest game in the recent score
+    """
+
+    def __init__(self, recent_decay=0.1):
+        self.recent_decay = recent_decay
+        self.n_players = 0
+        self._keys = np.empty(0, dtype=np.uint64)
+        self._key_ids = np.empty(0, dtype=np.int32)
+        self._allocate(INITIAL_CAPACITY)
+
+    def _allocate(self, capacity):
+        state = {
+            "n_games": np.zeros(capacity, dtype=np.int32),
+            # 2 for a win, 1 for a draw, keeps the points integer
+            "points2": np.zeros(capacity, dtype=np.int32),
+            "recent": np.full(capacity, NO_SCORE, dtype=np.float32),
+            "opp_elo_sum": np.zeros(capacity, dtype=np.int64),
+            "last_elo": np.zeros(capacity, dtype=np.int16),
+        }
+        for name, column in state.items():
+            old_column = getattr(self, name, None)
+            if old_column is not None:
+                column[: len(old_column)] = old_column
+            setattr(self, name, column)
+
+    def player_ids(self, names):
+        """Ids of the players, players seen for the first time get new ids."""
+        keys = hash_player_names(names)
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+        positions = np.searchsorted(self._keys, unique_keys)
+        is_known = positions < len(self._keys)
+        is_known[is_known] = self._keys[positions[is_known]] == unique_keys[is_known]
+
+        new_keys = unique_keys[~is_known]
+        if len(new_keys):
+            new_ids = np.arange(self.n_players, self.n_players + len(new_keys), dtype=np.int32)
+            self.n_players += len(new_keys)
+            if self.n_players > len(self.n_games):
+                self._allocate(max(2 * len(self.n_games), self.n_players))
+
+            insert_at = np.searchsorted(self._keys, new_keys)
+            self._keys = np.insert(self._keys, insert_at, new_keys)
+            self._key_ids = np.insert(self._key_ids, insert_at, new_ids)
+            positions = np.searchsorted(self._keys, unique_keys)
+
+        return self._key_ids[positions][inverse]
+
+    def _features_and_update(self, ids, elos, opp_elos, points2):
+        """Features of the player rows of a chunk, then adds all of the rows to the state."""
+        order, row_starts, ranks = group_by_player(ids)
+        ids, elos, opp_elos, points2 = ids[order], elos[order], opp_elos[order], points2[order]
+        # previous row of the same player, for the rows that are not the player's first in the chunk
+        has_previous = np.flatnonzero(ranks > 0)
+        is_last = np.ones(len(ids), dtype=bool)
+        is_last[:-1] = row_starts[1:] != row_starts[:-1]
+
+        n_games = self.n_games[ids] + ranks
+        points2_sum = self.points2[ids] + exclusive_group_cumsum(points2, row_starts)
+        opp_elo_sum = self.opp_elo_sum[ids] + exclusive_group_cumsum(opp_elos, row_starts)
+        last_elo = self.last_elo[ids].astype(np.int64)
+        last_elo[has_previous] = elos[has_previous - 1]
+        recent = self.recent[ids].astype(np.float64)
+        scale, shift = group_ema_scan(points2 / 2, ranks, self.recent_decay)
+        recent_after = scale * recent + shift
+        recent[has_previous] = recent_after[has_previous - 1]
+
+        has_games = n_games > 0
+        safe_n_games = np.maximum(n_games, 1)
+        sorted_features = {
+            "Games": n_games,
+            "Score": np.where(has_games, points2_sum / (2 * safe_n_games), NO_SCORE),
+            "RecentScore": recent,
+            "OppElo": np.where(has_games, opp_elo_sum / safe_n_games, elos),
+            "EloTrend": np.where(has_games, elos - last_elo, 0),
+        }
+        features = {}
+        for name, values in sorted_features.items():
+            features[name] = np.empty(len(ids), dtype=FEATURE_DTYPES[name])
+            features[name][order] = values
+
+        last_ids = ids[is_last]
+        self.n_games[last_ids] = n_games[is_last] + 1
+        self.points2[last_ids] = points2_sum[is_last] + points2[is_last]
+        self.recent[last_ids] = recent_after[is_last]
+        self.opp_elo_sum[last_ids] = opp_elo_sum[is_last] + opp_elos[is_last]
+        self.last_elo[last_ids] = elos[is_last]
+        return features
+
+    def transform(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds the PLAYER_HISTORY_COLUMNS to processed games and adds the games to the history.
+
+        The games of a chunk are grouped by player, and the state before every game is the
+        stored state plus a prefix sum over the earlier games of the player in the chunk, so
+        there is no loop over games or over the games of one player.
+
+        :param data: chronologically ordered processed games, see processing.utils.process_file
+        """
+        n = len(data)
+        # one row per player per game: white of game 0, black of game 0, white of game 1, ...
+        names = np.empty(2 * n, dtype=object)
+        names[0::2], names[1::2] = data["White"].to_numpy(), data["Black"].to_numpy()
+        white_elos, black_elos = data["WhiteElo"].to_numpy(), data["BlackElo"].to_numpy()
+        elos = np.empty(2 * n, dtype=np.int64)
+        elos[0::2], elos[1::2] = white_elos, black_elos
+        opp_elos = np.empty(2 * n, dtype=np.int64)
+        opp_elos[0::2], opp_elos[1::2] = black_elos, white_elos
+        draws = data["Draw"].to_numpy(dtype=np.int32)
+        points2 = np.empty(2 * n, dtype=np.int32)
+        points2[0::2] = 2 * data["WhiteWin"].to_numpy(dtype=np.int32) + draws
+        points2[1::2] = 2 * data["BlackWin"].to_numpy(dtype=np.int32) + draws
+
+        ids = self.player_ids(names)
+        features = self._features_and_update(ids, elos, opp_elos, points2)
+
+        # a game against oneself: black was read after the white side of the same game was added
+        is_self_game = ids[0::2] == ids[1::2]
+        if is_self_game.any():
+            white_rows = 2 * np.flatnonzero(is_self_game)
+            black_rows = white_rows + 1
+            for name in ["Games", "Score", "RecentScore"]:
+                features[name][black_rows] = features[name][white_rows]
+            has_games = features["Games"][white_rows] > 0
+            elo_shift = elos[black_rows] - elos[white_rows]
+            features["OppElo"][black_rows] = np.where(
+                has_games, features["OppElo"][white_rows], elos[black_rows]
+            )
+            features["EloTrend"][black_rows] = np.where(
+                has_games, features["EloTrend"][white_rows] + elo_shift, 0
+            )
+
+        data = data.copy()
+        for name, values in features.items():
+            data[f"White{name}"] = values[0::2]
+            data[f"Black{name}"] = values[1::2]
+        return data
+
+    def save(self, path):
+        n = self.n_players
+        np.savez(
+            path,
+            recent_decay=self.recent_decay,
+            keys=self._keys,
+            key_ids=self._key_ids,
+            n_games=self.n_games[:n],
+            points2=self.points2[:n],
+            recent=self.recent[:n],
+            opp_elo_sum=self.opp_elo_sum[:n],
+            last_elo=self.last_elo[:n],
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            history = cls(recent_decay=float(state["recent_decay"]))
+            history._keys, history._key_ids = state["keys"], state["key_ids"]
+            history.n_players = len(history._keys)
+            for name in ["n_games", "points2", "recent", "opp_elo_sum", "last_elo"]:
+                setattr(history, name, state[name])
+        history._allocate(max(history.n_players, INITIAL_CAPACITY))
+        return history
+
+
+def add_player_history(input_file, output_file, state_path=None, chunk_size=125000):
+    """
+    Adds the player history features to a processed file in one pass over its chunks.
+
+    :param input_file: processed ".csv" or ".parquet" file in the archive order, e.g. written
+        with process_and_concat_raw_data(..., ordered=True)
+    :param output_file: ".csv" or ".parquet" file to write the games with the features to
+    :param state_path: optional ".npz" file with the history of the previous months, it is
+        loaded if it exists and saved with this file's games added
+    :param chunk_size: number of games read at once
+    :return: PlayerHistory after the last game
+    """
+    if state_path is not None and os.path.exists(state_path):
+        history = PlayerHistory.load(state_path)
+        print(f"Loaded the history of {history.n_players} players from {state_path}")
+    else:
+        history = PlayerHistory()
+
+    with DataFrameStreamWriter(output_file) as writer:
+        for chunk in tqdm(iter_data_file_chunks(input_file, chunk_size)):
+            writer.write(history.transform(chunk))
+
+    if state_path is not None:
+        history.save(state_path)
+    print(f"Saved {writer.n_rows} games of {history.n_players} players to {output_file}")
+    return history
@@ -1,23 +1,63 @@
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-import pandas as pd
 from tqdm import tqdm
 
+from chesswinnerprediction.dataloader.pgn_zst_to_csv import imap_in_order, imap_unordered
+from chesswinnerprediction.processing.processing_cache import process_file_cached
+from chesswinnerprediction.processing.stream_writer import DataFrameStreamWriter
 from chesswinnerprediction.processing.utils import process_file
 
-
-def process_and_concat_raw_data(dir_path, output_file):
-    csv_files = [os.path.join(dir_path, file_name) for file_name in os.listdir(dir_path) if file_name.endswith(".csv")]
-
-    combined_data = pd.DataFrame()
-
-    with ProcessPoolExecutor() as executor:
-        futures = {executor.submit(process_file, file_path): file_path for file_path in csv_files}
-
-        for future in tqdm(as_completed(futures), total=len(csv_files)):
-            processed_data = future.result()
-            combined_data = pd.concat([combined_data, processed_data], ignore_index=True)
-
-    print(f"Saving data to {output_file}")
-    combined_data.to_csv(output_file, index=False)
+RAW_DATA_EXTENSIONS = (".csv", ".parquet")
+
+
+def shard_sort_key(file_name):
+    # "data_10.csv" goes after "data_9.csv"
+    match = re.search(r"(\d+)\.\w+$", file_name)
+    return (int(match.group(1)) if match else -1, file_name)
+
+
+def process_and_concat_raw_data(dir_path, output_file, n_jobs=None, ordered=False, cache=None):
+    """
+    Processes every raw shard of dir_path and appends the results to output_file.
+
+    Each processed shard is written as soon as it is ready and at most 2 * n_jobs shards are in
+    flight, so memory use does not depend on the number of shards.
+
+    :param dir_path: directory with "data_{idx}.csv" or "data_{idx}.parquet" shards
+    :param output_file: ".csv" or ".parquet" file to write the processed games to
+    :param n_jobs: number of worker processes (default: os.cpu_count())
+    :param ordered: write the shards in the data_{idx} order instead of the completion order
+    :param cache: optional ProcessingCache, unchanged shards are read from it instead of being
+        processed again
+    :return: number of written games
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    file_names = sorted(
+        (name for name in os.listdir(dir_path) if name.endswith(RAW_DATA_EXTENSIONS)),
+        key=shard_sort_key,
+    )
+    file_paths = [os.path.join(dir_path, file_name) for file_name in file_names]
+
+    process = process_file
+    if cache is not None:
+        process = partial(process_file_cached, cache=cache)
+
+    n_cached = 0
+    imap = imap_in_order if ordered else imap_unordered
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        with DataFrameStreamWriter(output_file) as writer:
+            results = imap(executor, process, file_paths, 2 * n_jobs)
+            for processed_data in tqdm(results, total=len(file_paths)):
+                if cache is not None:
+                    processed_data, is_cached = processed_data
+                    n_cached += is_cached
+                writer.write(processed_data)
+
+    if cache is not None:
+        print(f"Reused {n_cached} of {len(file_paths)} shards from {cache.cache_dir}")
+        cache.evict()
+    print(f"Saved {writer.n_rows} games to {output_file}")
+    return writer.n_rows
@@ -0,0 +1,98 @@
+import os
+import hashlib
+import inspect
+
+import pyarrow.parquet as pq
+
+from chesswinnerprediction import constants
+from chesswinnerprediction.processing import game_features, utils
+from chesswinnerprediction.processing.utils import process_file, table_to_df
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+# bump to invalidate the cache when processing changes outside of the fingerprinted modules
+PROCESSING_VERSION = 1
+FINGERPRINT_MODULES = [constants, utils, game_features]
+
+
+def file_content_hash(file_path):
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as data_file:
+        while chunk := data_file.read(HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def processing_fingerprint():
+    """Hash of the source code of the processing functions, changes with any edit of them."""
+    fingerprint = hashlib.blake2b(str(PROCESSING_VERSION).encode(), digest_size=8)
+    for module in FINGERPRINT_MODULES:
+        fingerprint.update(inspect.getsource(module).encode())
+    return fingerprint.hexdigest()
+
+
+class ProcessingCache:
+    """
+    Disk cache of processed raw shards.
+
+    An entry is keyed on the content hash of the shard and the fingerprint of the processing
+    code, so a changed shard or a change in processing.utils makes it stale. Entries are parquet
+    files whose mtime is the last use time, the least recently used ones are deleted when the
+    cache grows over max_size_gb.
+
+    :param cache_dir: directory to keep the entries in
+    :param max_size_gb: size limit of the cache directory
+    """
+
+    def __init__(self, cache_dir, max_size_gb=10):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024**3)
+        self.fingerprint = processing_fingerprint()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, file_path):
+        key = f"{self.fingerprint}_{file_content_hash(file_path)}"
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def get(self, entry_path):
+        if not os.path.exists(entry_path):
+            return None
+        data = table_to_df(pq.read_table(entry_path))
+        os.utime(entry_path)
+        return data
+
+    def put(self, entry_path, data):
+        # several workers can process the same shard, the last finished one wins
+        tmp_entry_path = f"{entry_path}.{os.getpid()}.tmp"
+        data.to_parquet(tmp_entry_path, index=False)
+        os.replace(tmp_entry_path, entry_path)
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits into max_size_gb."""
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".parquet"):
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+                entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dir, file_name))
+            total_size -= size
+
+
+def process_file_cached(file_path, cache):
+    """
+    process_file that reuses the cached result of an unchanged shard.
+
+    :return: (processed DataFrame, True if it was taken from the cache)
+    """
+    entry_path = cache.entry_path(file_path)
+    data = cache.get(entry_path)
+    if data is not None:
+        return data, True
+
+    data = process_file(file_path)
+    cache.put(entry_path, data)
+    return data, False
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+from chesswinnerprediction.processing.utils import iter_data_file_chunks
+
+ELO_BAND = "EloBand"  # mean rating of the players rounded down to ELO_BAND_WIDTH
+ELO_BAND_WIDTH = 200
+STRATUM_COLUMN, KEY_COLUMN = "_stratum", "_key"
+
+
+def elo_bands(data: pd.DataFrame) -> pd.Series:
+    mean_elo = (data["WhiteElo"].astype(np.int64) + data["BlackElo"]) // 2
+    return mean_elo // ELO_BAND_WIDTH * ELO_BAND_WIDTH
+
+
+def allocate_sample(counts, weights, size, capacity):
+    """
+    Splits size between strata proportionally to count * weight.
+
+    A stratum gets at most min(count, capacity) games, the quota a capped stratum cannot take is
+    split again between the other strata of positive weight, until size or all their games are
+    allocated. The rounding remainder goes to the strata with the largest fractional parts.
+
+    >>> allocate_sample([100, 10000], [100, 1], 1000, 1000).tolist()
+    [100, 900]
+    """
+    counts, weights = np.asarray(counts), np.asarray(weights, dtype=np.float64)
+    limits = np.minimum(counts, capacity)
+    shares = counts * weights
+    is_capped = shares <= 0
+    target = min(size, limits[~is_capped].sum())
+
+    quotas = np.where(is_capped, 0.0, limits).astype(np.float64)
+    while not is_capped.all():
+        free = target - limits[is_capped & (shares > 0)].sum()
+        open_quotas = free * shares[~is_capped] / shares[~is_capped].sum()
+        is_over = open_quotas >= limits[~is_capped]
+        if not is_over.any():
+            quotas[~is_capped] = open_quotas
+            break
+        is_capped[np.flatnonzero(~is_capped)[is_over]] = True
+
+    allocation = np.minimum(np.floor(quotas + 1e-9).astype(np.int64), limits)
+    remainder = target - allocation.sum()
+    for idx in np.argsort(allocation - quotas, kind="stable"):
+        if remainder <= 0:
+            break
+        if allocation[idx] < limits[idx] and shares[idx] > 0:
+            allocation[idx] += 1
+            remainder -= 1
+    return allocation
+
+
+class ReservoirSampler:
+    """
+    One-pass stratified sample of a stream of games, without keeping the stream in memory.
+
+    Every game gets a uniform random key, and every stratum keeps the games with its size smallest
+    keys, which is a uniform sample of the stratum of any size up to size. Once a stratum is full,
+    the games of a new chunk with larger keys are dropped right away. At the end the sample size is
+    split between the strata proportionally to their number of games times their weight, so e.g.
+    draws can be oversampled, and samples of several sizes taken from one pass are nested.
+
+    Memory use is up to size games per stratum, so strata should stay coarse.
+
+    :param size: largest sample size
+    :param stratify_by: columns to stratify by, e.g. ["Result", "Event", "EloBand"], EloBand is
+        computed from the ratings, None - a simple reservoir sample
+    :param weights: oversampling weights of column values, e.g. {"Result": {"1/2-1/2": 3}},
+        the weight of a stratum is the product of the weights of its values, the columns have to
+        be in stratify_by
+    :param random_state: seed of the keys
+    """
+
+    def __init__(self, size, stratify_by=None, weights=None, random_state=42):
+        self.size = size
+        self.stratify_by = list(stratify_by or [])
+        self.weights = weights or {}
+        if not set(self.weights) <= set(self.stratify_by):
+            raise ValueError("Only stratify_by columns can have oversampling weights")
+
+        self._rng = np.random.default_rng(random_state)
+        self.counts = pd.Series(dtype=np.int64)
+        self.stratum_weights = pd.Series(dtype=np.float64)
+        self._reservoir = None
+        self._thresholds = pd.Series(dtype=np.float64)
+
+    def _stratum_columns(self, data):
+        return pd.DataFrame(
+            {
+                column: elo_bands(data) if column == ELO_BAND else data[column]
+                for column in self.stratify_by
+            },
+            index=data.index,
+        )
+
+    def _strata(self, stratum_columns):
+        if stratum_columns.empty:
+            return np.zeros(len(stratum_columns), dtype=np.uint64)
+        return pd.util.hash_pandas_object(stratum_columns, index=False).to_numpy()
+
+    def _row_weights(self, stratum_columns):
+        weights = np.ones(len(stratum_columns))
+        for column, value_weights in self.weights.items():
+            weights *= stratum_columns[column].map(value_weights).fillna(1).to_numpy()
+        return weights
+
+    def update(self, data: pd.DataFrame):
+        """Adds a chunk of games to the stream."""
+        if data.empty:
+            return
+        stratum_columns = self._stratum_columns(data)
+        strata = self._strata(stratum_columns)
+        keys = self._rng.random(len(data))
+
+        chunk_counts = pd.Series(strata).value_counts()
+        self.counts = self.counts.add(chunk_counts, fill_value=0).astype(np.int64)
+        chunk_weights = pd.Series(self._row_weights(stratum_columns), index=strata)
+        chunk_weights = chunk_weights[~chunk_weights.index.duplicated()]
+        self.stratum_weights = self.stratum_weights.combine_first(chunk_weights)
+
+        thresholds = pd.Series(strata).map(self._thresholds).fillna(1.0).to_numpy()
+        is_candidate = keys < thresholds
+        candidates = data[is_candidate].assign(
+            **{STRATUM_COLUMN: strata[is_candidate], KEY_COLUMN: keys[is_candidate]}
+        )
+        if self._reservoir is not None:
+            candidates = pd.concat([self._reservoir, candidates], ignore_index=True)
+
+        candidates = candidates.sort_values(KEY_COLUMN, kind="stable")
+        self._reservoir = candidates.groupby(STRATUM_COLUMN, sort=False).head(self.size)
+        stratum_keys = self._reservoir.groupby(STRATUM_COLUMN)[KEY_COLUMN]
+        is_full = stratum_keys.size() >= self.size
+        self._thresholds = stratum_keys.max()[is_full]
+
+    def sample(self, size=None) -> pd.DataFrame:
+        """:return: sample of up to size games (default: self.size) in a random order"""
+        size = self.size if size is None else size
+        if size > self.size:
+            raise ValueError(f"The sampler keeps at most {self.size} games")
+        if self._reservoir is None:
+            return pd.DataFrame()
+
+        strata = self.counts.index
+        allocation = allocate_sample(
+            self.counts.to_numpy(), self.stratum_weights[strata].to_numpy(), size, self.size
+        )
+        stratum_sizes = pd.Series(allocation, index=strata)
+        ranks = self._reservoir.groupby(STRATUM_COLUMN).cumcount().to_numpy()
+        stratum_limits = self._reservoir[STRATUM_COLUMN].map(stratum_sizes).to_numpy()
+        sample = self._reservoir[ranks < stratum_limits]
+        return sample.drop(columns=[STRATUM_COLUMN, KEY_COLUMN]).reset_index(drop=True)
+
+
+def sample_data_file(file_path, sampler, chunk_size=125000):
+    """Feeds every game of a processed file to the sampler, one chunk at a time."""
+    for chunk in iter_data_file_chunks(file_path, chunk_size):
+        sampler.update(chunk)
+    return sampler
@@ -0,0 +1,51 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class DataFrameStreamWriter:
+    """
+    Appends DataFrames to one ".csv" or ".parquet" file without keeping them in memory.
+
+    The layout of the file is taken from the first non-empty DataFrame, every parquet chunk is
+    written as a separate row group.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.is_parquet = file_path.endswith(".parquet")
+        self.n_rows = 0
+        self._columns = None
+        self._parquet_writer = None
+
+    def write(self, data: pd.DataFrame):
+        if data.empty:
+            return
+
+        if self._columns is None:
+            self._columns = list(data.columns)
+        data = data[self._columns]
+
+        if self.is_parquet:
+            table = pa.Table.from_pandas(data, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.file_path, table.schema)
+            self._parquet_writer.write_table(table.cast(self._parquet_writer.schema))
+        else:
+            is_first = self.n_rows == 0
+            data.to_csv(
+                self.file_path, mode="w" if is_first else "a", header=is_first, index=False
+            )
+
+        self.n_rows += len(data)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,161 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from chesswinnerprediction.processing.stream_writer import DataFrameStreamWriter
+from chesswinnerprediction.processing.utils import iter_data_file_chunks
+
+ENCODED_COLUMNS = ["Event", "ECO", "Opening", "TimeControl"]
+TARGET_COLUMNS = ["WhiteWin", "BlackWin", "Draw"]
+COUNT_COLUMN = "Games"
+
+
+def encoding_column_name(target, column):
+    # e.g. "DrawEventProb"
+    return f"{target}{column}Prob"
+
+
+def category_keys(values: pd.Series) -> pd.Series:
+    # missing values are a category of their own, "nan", in the counts and in the encoding
+    return values.astype(str)
+
+
+class TargetEncodingStore:
+    """
+    Per-category result counts of the training games, used to encode categories as smoothed
+    result probabilities.
+
+    Counts are accumulated chunk by chunk with update, so the training data never has to be in
+    memory at once, and the stores of different shards or months are combined with merge. The
+    encoding of a category seen in n games with k wins is (k + smoothing * prior) / (n + smoothing),
+    the prior being the result frequency of all counted games, rare and unseen categories get
+    values close to or equal to the prior.
+
+    :param columns: categorical columns to encode
+    :param targets: 0/1 result columns to encode them with
+    :param smoothing: number of prior games added to every category
+    :param sources: names of the shards or months in the counts, merge refuses to add one twice
+    """
+
+    def __init__(self, columns=None, targets=None, smoothing=20, sources=None):
+        self.columns = list(columns or ENCODED_COLUMNS)
+        self.targets = list(targets or TARGET_COLUMNS)
+        self.smoothing = smoothing
+        self.sources = list(sources or [])
+        self.n_games = 0
+        self.target_sums = pd.Series(0, index=self.targets, dtype=np.int64)
+        self.counts = {
+            column: pd.DataFrame(columns=[COUNT_COLUMN] + self.targets, dtype=np.int64)
+            for column in self.columns
+        }
+
+    def _add_counts(self, column, counts):
+        total = self.counts[column].add(counts, fill_value=0)
+        self.counts[column] = total.astype(np.int64)
+
+    def update(self, data: pd.DataFrame):
+        """Adds the games of a training chunk to the counts."""
+        targets = data[self.targets].astype(np.int64)
+        self.n_games += len(data)
+        self.target_sums += targets.sum()
+        for column in self.columns:
+            grouped = targets.groupby(category_keys(data[column]).to_numpy())
+            counts = grouped.sum()
+            counts.insert(0, COUNT_COLUMN, grouped.size())
+            self._add_counts(column, counts)
+
+    def merge(self, other):
+        """Adds the counts of another store, e.g. of another shard or month."""
+        if other.columns != self.columns or other.targets != self.targets:
+            raise ValueError("Only stores of the same columns and targets can be merged")
+        already_counted = set(other.sources) & set(self.sources)
+        if already_counted:
+            raise ValueError(f"The counts of {sorted(already_counted)} are already in the store")
+        self.sources += other.sources
+        self.n_games += other.n_games
+        self.target_sums += other.target_sums
+        for column in self.columns:
+            self._add_counts(column, other.counts[column])
+
+    def prior(self):
+        return self.target_sums / max(self.n_games, 1)
+
+    def encoding(self, column) -> pd.DataFrame:
+        """Smoothed probabilities of every counted category of a column."""
+        counts = self.counts[column]
+        smoothed_sums = counts[self.targets] + self.smoothing * self.prior()
+        return smoothed_sums.div(counts[COUNT_COLUMN] + self.smoothing, axis=0)
+
+    def transform(self, data: pd.DataFrame) -> pd.DataFrame:
+        """Adds a "{target}{column}Prob" column for every encoded column and target."""
+        data = data.copy()
+        prior = self.prior()
+        for column in self.columns:
+            encoding = self.encoding(column).reindex(category_keys(data[column]))
+            for target in self.targets:
+                values = encoding[target].fillna(prior[target]).to_numpy(dtype=np.float32)
+                data[encoding_column_name(target, column)] = values
+        return data
+
+    def save(self, path):
+        state = {
+            "columns": self.columns,
+            "targets": self.targets,
+            "smoothing": self.smoothing,
+            "sources": self.sources,
+            "n_games": self.n_games,
+            "target_sums": self.target_sums.tolist(),
+            "counts": {
+                column: {str(key): row for key, row in zip(counts.index, counts.values.tolist())}
+                for column, counts in self.counts.items()
+            },
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as store_file:
+            json.dump(state, store_file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as store_file:
+            state = json.load(store_file)
+
+        store = cls(state["columns"], state["targets"], state["smoothing"], state.get("sources"))
+        store.n_games = state["n_games"]
+        store.target_sums[:] = state["target_sums"]
+        for column, counts in state["counts"].items():
+            store.counts[column] = pd.DataFrame.from_dict(
+                counts, orient="index", columns=[COUNT_COLUMN] + store.targets, dtype=np.int64
+            )
+        return store
+
+
+def fit_target_encoding(file_paths, store=None, chunk_size=125000, **store_params):
+    """
+    Counts the training games of the files one chunk at a time.
+
+    :param file_paths: training ".csv" or ".parquet" files, never the validation or test ones
+    :param store: optional store to add the counts to, it must not already hold these games,
+        stores of other months are combined with TargetEncodingStore.merge
+    :param store_params: TargetEncodingStore parameters of a new store
+    :return: TargetEncodingStore
+    """
+    if store is None:
+        store = TargetEncodingStore(**store_params)
+
+    columns = store.columns + store.targets
+    for file_path in file_paths:
+        for chunk in iter_data_file_chunks(file_path, chunk_size, columns=columns):
+            store.update(chunk)
+    return store
+
+
+def apply_target_encoding(store, input_file, output_file, chunk_size=125000):
+    """Writes the games of input_file with the encoded columns added, one chunk at a time."""
+    with DataFrameStreamWriter(output_file) as writer:
+        for chunk in iter_data_file_chunks(input_file, chunk_size):
+            writer.write(store.transform(chunk))
+    print(f"Saved {writer.n_rows} encoded games to {output_file}")
+    return writer.n_rows
@@ -1,5 +1,7 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from chesswinnerprediction.constants import (
     WHITE_WIN_STR,
@@ -9,6 +11,18 @@ from chesswinnerprediction.constants import (
     BASELINE_COLUMNS,
     MIN_GAME_DURATION
 )
+from chesswinnerprediction.dataloader.movetext import CLOCK_DIGIT_SECONDS
+from chesswinnerprediction.processing.game_features import (
+    add_eval_features,
+    add_time_usage_features,
+    evals_to_ragged,
+)
+
+# An old clock list of n one-digit-hour clocks is n tokens "['H:MM:SS'," / " 'H:MM:SS'," / ...
+# " 'H:MM:SS']": the positions of their digits and of the separators they all share
+HMS_TOKEN = b" '0:00:00',"
+HMS_DIGITS = [2, 4, 5, 7, 8]
+HMS_SEPARATORS = [1, 3, 6, 9]
 
 
 def process_elo(data: pd.DataFrame) -> pd.DataFrame:
@@ -34,54 +48,192 @@ def process_result(data: pd.DataFrame) -> pd.DataFrame:
     return data
 
 
-def add_external_features(data: pd.DataFrame) -> pd.DataFrame:
-    # data["EloDiffAbs"] = data["EloDiff"].abs().astype(np.int16)
-    # data["MeanElo"] = ((data["WhiteElo"] + data["BlackElo"]) / 2).astype(np.float32)
-
-    data["DrawEventProb"] = data.groupby("Event")["Draw"].transform("mean")
-    data["WhiteWinEventProb"] = data.groupby("Event")["WhiteWin"].transform("mean")
-    data["BlackWinEventProb"] = data.groupby("Event")["BlackWin"].transform("mean")
-    return data
-
-
 def drop_data(data: pd.DataFrame) -> pd.DataFrame:
     # data.drop(columns=["TimeControl"], inplace=True)
     # data.drop(columns=["Result"], inplace=True)
     # data.drop(columns=["Event"], inplace=True)
-    data.drop(columns=["times_list"], inplace=True)
+    data.drop(columns=["times_list", "evaluations_list"], inplace=True)
 
     data = data[data["GameDuration"] > MIN_GAME_DURATION]
     return data
 
 
-def parse_times_list_to_seconds(time_list_str):
-    def time_str_to_seconds(time_str):
-        h, m, s = map(int, time_str.split(":"))
-        return h * 3600 + m * 60 + s
+def hms_text_to_seconds(text):
+    """
+    Seconds of the "H:MM:SS" clocks of a text, e.g. "['0:03:00', '0:02:58']".
 
-    # time_list_str[2:-2] - get string without '"[' and ']"' symbols
-    time_list = time_list_str[2:-2].split("', '")
-    return [time_str_to_seconds(time_str) for time_str in time_list]
+    The digits are read straight from the bytes around every pair of colons, hours can have
+    several digits.
+    """
+    # padded, so the digits before the first and after the last colon can always be indexed
+    chars = np.frombuffer(f"  {text}  ".encode("ascii"), dtype=np.uint8)
+    colons = np.flatnonzero(chars == ord(":"))
+    first, second = colons[0::2], colons[1::2]
+    if len(first) != len(second) or (second - first != 3).any():
+        raise ValueError("The clocks are not in the H:MM:SS format")
+    positions = np.column_stack([first - 1, first + 1, first + 2, second + 1, second + 2])
+    digits = chars[positions].astype(np.int32) - ord("0")
+    if ((digits < 0) | (digits > 9)).any():
+        raise ValueError("The clocks are not in the H:MM:SS format")
+    seconds = digits @ CLOCK_DIGIT_SECONDS
 
+    hour_position, hour_scale = first - 2, 36000
+    while True:
+        hour_digits = chars[np.maximum(hour_position, 0)].astype(np.int32) - ord("0")
+        is_digit = (hour_digits >= 0) & (hour_digits <= 9) & (hour_position >= 0)
+        if not is_digit.any():
+            return seconds
+        seconds += np.where(is_digit, hour_digits * hour_scale, 0)
+        # a position stops moving once its hours end
+        hour_position = np.where(is_digit, hour_position - 1, -1)
+        hour_scale *= 10
 
-def calc_game_duration(time_and_increment):
-    time_list, increment_time = time_and_increment.values
-    # - time_list: A list of remaining times for each player in seconds
-    #       Format: [white_base_time, black_base_time, ..., white_end_time, black_end_time]
-    # - increment_time: The time increment added after each move
 
-    increment = (len(time_list) - 2) * increment_time
-    base_time_total = sum(time_list[:2])
-    end_time_total = sum(time_list[-2:])
-    return base_time_total - end_time_total + increment
+def strings_to_bytes(strings):
+    """
+    Concatenated bytes of strings, taken from their Arrow buffers without a loop over the strings.
 
+    :return: (uint8 array of all strings, int64 array of len(strings) + 1 offsets, string i is
+        chars[offsets[i]:offsets[i + 1]])
+    """
+    array = pa.array(strings, type=pa.large_string(), from_pandas=True)
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if array.null_count:
+        raise ValueError("The strings contain missing values")
+    _, offsets_buffer, chars_buffer = array.buffers()
+    first, stop = array.offset, array.offset + len(array) + 1
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int64)[first:stop]
+    chars = np.frombuffer(chars_buffer, dtype=np.uint8) if chars_buffer else np.zeros(0, np.uint8)
+    start, end = offsets[0], offsets[-1]
+    return chars[start:end], offsets - start
 
-def process_moves_time(data: pd.DataFrame) -> pd.DataFrame:
-    data["times_in_second"] = data["times_list"].apply(parse_times_list_to_seconds)
-    data["GameDuration"] = data[["times_in_second", "IncrementTime"]].apply(calc_game_duration, axis=1)
+
+def count_per_string(chars, offsets, symbol):
+    """Occurrences of a one-byte symbol in every string of strings_to_bytes."""
+    counts = np.zeros(len(chars) + 1, dtype=np.int64)
+    np.cumsum(chars == ord(symbol), out=counts[1:])
+    return np.diff(counts[offsets])
+
+
+def hms_lists_to_seconds(chars, offsets):
+    """
+    Seconds of the clocks of old "['0:03:00', '0:02:58', ...]" lists, see strings_to_bytes.
+
+    When every clock has a one-digit hour, the lists are fixed-size HMS_TOKEN tokens and the digits
+    of all lists are read with one strided view of the bytes, otherwise with hms_text_to_seconds.
+
+    :return: (int32 array of the seconds of all lists, int64 array of the clocks per list)
+    """
+    str_lengths = np.diff(offsets)
+    is_empty = str_lengths == len("[]")
+    if ((str_lengths % len(HMS_TOKEN) == 0) | is_empty).all():
+        n_clocks = np.where(is_empty, 0, str_lengths // len(HMS_TOKEN))
+        token_chars = chars[np.repeat(~is_empty, str_lengths)] if is_empty.any() else chars
+        tokens = token_chars.reshape(-1, len(HMS_TOKEN))
+
+        # the first token of a list opens it with "[", its last token closes it with "]"
+        expected = np.frombuffer(HMS_TOKEN, dtype=np.uint8)
+        list_ends = np.cumsum(n_clocks)[~is_empty]
+        first_chars = np.full(len(tokens), expected[0])
+        first_chars[list_ends - n_clocks[~is_empty]] = ord("[")
+        last_chars = np.full(len(tokens), expected[-1])
+        last_chars[list_ends - 1] = ord("]")
+        digits = tokens[:, HMS_DIGITS] - expected[HMS_DIGITS]
+        if (
+            (digits <= 9).all()
+            and (tokens[:, HMS_SEPARATORS] == expected[HMS_SEPARATORS]).all()
+            and (tokens[:, 0] == first_chars).all()
+            and (tokens[:, -1] == last_chars).all()
+            and (chars[offsets[:-1][is_empty]] == ord("[")).all()
+            and (chars[offsets[:-1][is_empty] + 1] == ord("]")).all()
+        ):
+            return digits.astype(np.int32) @ CLOCK_DIGIT_SECONDS, n_clocks
+
+    n_clocks = count_per_string(chars, offsets, ":") // 2
+    return hms_text_to_seconds(chars.tobytes().decode("ascii")), n_clocks
+
+
+def times_to_ragged(times_list):
+    """
+    Converts per-game clock lists to one flat array.
+
+    :param times_list: clock lists as arrays (parquet shards) or strings (csv shards), either
+        "[180, 178, ...]" in seconds or the old "['0:03:00', '0:02:58', ...]"
+    :return: (int32 array of remaining seconds of all games, int64 array of len(times_list) + 1
+        offsets, the clocks of game i are values[offsets[i]:offsets[i + 1]])
+    """
+    if isinstance(next(iter(times_list), None), str):
+        chars, str_offsets = strings_to_bytes(times_list)
+        if (chars == ord(":")).any():
+            values, lengths = hms_lists_to_seconds(chars, str_offsets)
+        else:
+            lengths = count_per_string(chars, str_offsets, ",") + (np.diff(str_offsets) > 2)
+            text = chars.tobytes().decode("ascii")
+            for symbol in "[],":
+                text = text.replace(symbol, " ")
+            # a string of only separators would be parsed as [0]
+            numbers = np.fromstring(text, dtype=np.int32, sep=" ") if lengths.sum() else []
+            values = np.asarray(numbers, dtype=np.int32)
+        # fromstring stops at the first malformed token, the clocks would shift between games
+        if len(values) != lengths.sum():
+            raise ValueError("The clock lists could not be parsed to their number of moves")
+    else:
+        times_list = list(times_list)
+        lengths = [len(time_list) for time_list in times_list]
+        values = np.concatenate(times_list or [[]]).astype(np.int32)
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return values, offsets
+
+
+def side_time_used(values, starts, n_moves, increment_time, side):
+    """
+    Time a side spent on its moves: first clock - last clock + increments of all but its first move.
+
+    :param side: 0 - white, 1 - black
+    """
+    side_moves = (n_moves - side + 1) // 2
+    has_moves = side_moves > 0
+    first = np.where(has_moves, starts + side, 0)
+    last = np.where(has_moves, starts + side + 2 * (side_moves - 1), 0)
+
+    time_used = values[first].astype(np.int64) - values[last] + (side_moves - 1) * increment_time
+    return np.where(has_moves, time_used, 0)
+
+
+def add_clock_features(data: pd.DataFrame, values, offsets) -> pd.DataFrame:
+    starts, n_moves = offsets[:-1], np.diff(offsets)
+    increment_time = data["IncrementTime"].to_numpy(dtype=np.int64)
+    if not len(values):
+        values = np.zeros(1, dtype=np.int32)
+
+    data["NumMoves"] = n_moves.astype(np.int16)
+    data["WhiteTimeUsed"] = side_time_used(values, starts, n_moves, increment_time, side=0)
+    data["BlackTimeUsed"] = side_time_used(values, starts, n_moves, increment_time, side=1)
+    # base_time_total - end_time_total + (n_moves - 2) * increment, games with less than
+    # two moves get the same value as the original per-game sum over time_list[:2] and [-2:]
+    first_two = np.minimum(n_moves, 2)
+    cumsum = np.concatenate([[0], np.cumsum(values, dtype=np.int64)])
+    base_time_total = cumsum[starts + first_two] - cumsum[starts]
+    end_time_total = cumsum[offsets[1:]] - cumsum[offsets[1:] - first_two]
+    data["GameDuration"] = base_time_total - end_time_total + (n_moves - 2) * increment_time
     return data
 
 
+def process_moves_time(data: pd.DataFrame) -> pd.DataFrame:
+    # the clocks stay in the flat array, the per-game lists of times_in_second are not kept
+    values, offsets = times_to_ragged(data["times_list"])
+    data = add_clock_features(data, values, offsets)
+    return add_time_usage_features(data, values, offsets)
+
+
+def process_move_evals(data: pd.DataFrame) -> pd.DataFrame:
+    evals, offsets = evals_to_ragged(data["evaluations_list"])
+    return add_eval_features(data, evals, offsets)
+
+
 def process_data_df(data: pd.DataFrame) -> pd.DataFrame:
     df = data[BASELINE_COLUMNS]
     df = df[df["Result"] != "*"]
@@ -96,15 +248,55 @@ def process_data_df(data: pd.DataFrame) -> pd.DataFrame:
 
     # move data
     df = process_moves_time(df)
-
-    # df = add_external_features(df)
+    df = process_move_evals(df)
 
     df = drop_data(df)
 
     return df
 
 
+def read_data_file(file_path, columns=None):
+    """
+    Reads a ".csv" or ".parquet" data file.
+
+    :param file_path: path to the file
+    :param columns: optional list of columns to load, parquet files skip the other columns on disk
+    :return: DataFrame
+    """
+    if file_path.endswith(".parquet"):
+        return pd.read_parquet(file_path, columns=columns)
+    return pd.read_csv(file_path, usecols=columns)
+
+
+def table_to_df(table: pa.Table) -> pd.DataFrame:
+    """to_pandas, but list columns are python lists as in freshly processed data, not arrays."""
+    data = table.to_pandas()
+    for field in table.schema:
+        if pa.types.is_list(field.type):
+            column = table.column(field.name).combine_chunks()
+            values, bounds = column.flatten().to_pylist(), column.offsets.to_pylist()
+            data[field.name] = [values[start:stop] for start, stop in zip(bounds, bounds[1:])]
+    return data
+
+
+def iter_data_file_chunks(file_path, chunk_size=125000, columns=None):
+    """Reads a ".csv" or ".parquet" data file as DataFrames of up to chunk_size rows, in order."""
+    if file_path.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(file_path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield table_to_df(pa.Table.from_batches([batch]))
+    else:
+        yield from pd.read_csv(file_path, usecols=columns, chunksize=chunk_size)
+
+
+def write_data_file(data: pd.DataFrame, file_path):
+    if file_path.endswith(".parquet"):
+        data.to_parquet(file_path, index=False)
+    else:
+        data.to_csv(file_path, index=False)
+
+
 def process_file(file_path):
-    data = pd.read_csv(file_path)
+    data = read_data_file(file_path, columns=BASELINE_COLUMNS)
     processed_data = process_data_df(data)
     return processed_data
@@ -0,0 +1,43 @@
+import os
+import argparse
+
+from chesswinnerprediction.constants import INTERIM_FOLDER_PATH
+from chesswinnerprediction.processing.player_history import add_player_history
+
+DEFAULT_STATE_PATH = os.path.join(INTERIM_FOLDER_PATH, "player_history.npz")
+
+
+def main(file_paths, state_path, chunk_size):
+    for file_path in file_paths:
+        name, extension = os.path.splitext(file_path)
+        add_player_history(file_path, f"{name}_history{extension}", state_path, chunk_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Add per-player history features to processed files."
+    )
+    parser.add_argument(
+        "file_paths",
+        nargs="+",
+        help="Processed files written with --ordered, from the oldest month to the newest",
+    )
+    parser.add_argument(
+        "--state_path",
+        type=str,
+        default=DEFAULT_STATE_PATH,
+        help=f"History of the earlier months, updated after every file. Default: {DEFAULT_STATE_PATH}",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=125000,
+        help="Number of games read at once. Default: 125000",
+    )
+    args = parser.parse_args()
+
+    try:
+        main(args.file_paths, args.state_path, args.chunk_size)
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
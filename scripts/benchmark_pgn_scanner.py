@@ -0,0 +1,113 @@
+import io
+import time
+import argparse
+
+import zstandard as zstd
+
+from chesswinnerprediction.constants import EXTERNAL_FOLDER_PATH, EXAMPLE_NAME
+from chesswinnerprediction.dataloader.movetext import parse_movetexts
+from chesswinnerprediction.dataloader.pgn_scanner import MOVES_PATTERN, PGNStreamScanner
+
+
+def legacy_iter_records(reader):
+    # the original pgn_zst_to_dataframe reader loop
+    buffer = b""
+    for chunk in iter(lambda: reader.read(4096), b""):
+        buffer += chunk
+        while b"\n\n" in buffer:
+            part, buffer = buffer.split(b"\n\n", maxsplit=1)
+            yield part
+
+
+def legacy_parse_movetext(moves):
+    # the original process_moves_and_evals_and_ckl, works only for games with evals
+    moves = moves.replace(b"!", b"").replace(b"?", b"").decode("utf-8")
+    split_moves = moves.split(". ")[1:]
+
+    parse_success = True
+    chess_moves, evaluations, times = [], [], []
+    for move_parts in map(str.split, split_moves):
+        if len(move_parts) != 8:
+            parse_success = False
+            break
+
+        chess_moves.append(move_parts[0])
+        evaluations.append(move_parts[3][:-1])
+        times.append(move_parts[5][:-1])
+
+    return chess_moves, evaluations, times, parse_success
+
+
+def read_decompressed(pgn_zst_path, size_mb):
+    with open(pgn_zst_path, "rb") as compressed_file:
+        with zstd.ZstdDecompressor().stream_reader(compressed_file) as reader:
+            return reader.read(size_mb * 1024 * 1024)
+
+
+def measure(name, iter_records, data):
+    start = time.perf_counter()
+    n_records = sum(1 for _ in iter_records(io.BytesIO(data)))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<10} {len(data) / 1024 ** 2 / elapsed:>10.1f} MB/s  ({n_records} records)")
+    return n_records
+
+
+def legacy_parse_movetexts(movetexts):
+    return list(zip(*map(legacy_parse_movetext, movetexts)))
+
+
+def measure_parser(name, parse_movetexts_fn, movetexts):
+    start = time.perf_counter()
+    n_success = sum(parse_movetexts_fn(movetexts)[3])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<10} {len(movetexts) / elapsed:>10.0f} games/s  ({n_success} parsed)")
+
+
+def main(file_path, size_mb, block_size):
+    print(f"Decompressing first {size_mb}MB of {file_path}")
+    data = read_decompressed(file_path, size_mb)
+
+    legacy_records = measure("legacy", legacy_iter_records, data)
+    scanner_records = measure(
+        "scanner", lambda reader: PGNStreamScanner(reader, block_size).iter_records(), data
+    )
+    if legacy_records != scanner_records:
+        raise ValueError(f"Record count mismatch: {legacy_records} != {scanner_records}")
+
+    records = PGNStreamScanner(io.BytesIO(data), block_size).iter_records()
+    # the legacy parser only handles games with evals, so both parsers get the same games
+    movetexts = [record for record in records if MOVES_PATTERN in record and b"[%eval " in record]
+    print(f"\nParsing {len(movetexts)} games with evals")
+    measure_parser("legacy", legacy_parse_movetexts, movetexts)
+    measure_parser("bytes", parse_movetexts, movetexts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare PGN scanners and movetext parsers speed."
+    )
+    parser.add_argument(
+        "--file_path",
+        type=str,
+        default=f"{EXTERNAL_FOLDER_PATH}/{EXAMPLE_NAME}.pgn.zst",
+        help="Path to the .pgn.zst file",
+    )
+    parser.add_argument(
+        "--size_mb",
+        type=int,
+        default=256,
+        help="Amount of decompressed data to scan in MB (default: 256)",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=1024 * 1024,
+        help="Scanner block size in bytes (default: 1MB)",
+    )
+    args = parser.parse_args()
+
+    try:
+        main(args.file_path, args.size_mb, args.block_size)
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
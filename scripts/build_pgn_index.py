@@ -0,0 +1,42 @@
+import os
+import argparse
+
+from chesswinnerprediction.constants import EXTERNAL_FOLDER_PATH, EXAMPLE_NAME
+from chesswinnerprediction.dataloader.pgn_index import PGNIndex, write_seekable_pgn_zst
+
+
+def main(file_path, seekable):
+    if seekable:
+        seekable_file_path = file_path.replace(".pgn.zst", ".seekable.pgn.zst")
+        print(f"Writing seekable archive to {seekable_file_path}")
+        write_seekable_pgn_zst(file_path, seekable_file_path)
+        file_path = seekable_file_path
+
+    index_path = file_path.replace(".pgn.zst", ".index.parquet")
+    index = PGNIndex.build(file_path)
+    index.save(index_path)
+    print(f"Indexed {len(index)} games in {len(index.frames)} frames: {index_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a byte-offset game index of a .pgn.zst file."
+    )
+    parser.add_argument(
+        "--file_path",
+        type=str,
+        default=os.path.join(EXTERNAL_FOLDER_PATH, EXAMPLE_NAME + ".pgn.zst"),
+        help="Path to the .pgn.zst file",
+    )
+    parser.add_argument(
+        "--seekable",
+        action="store_true",
+        help="Recompress the archive into small zstd frames first to make random access cheap",
+    )
+    args = parser.parse_args()
+
+    try:
+        main(args.file_path, args.seekable)
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
@@ -1,33 +1,81 @@
 import os
 import argparse
+from contextlib import nullcontext
 
 from chesswinnerprediction.constants import (
     MIN_DATE,
     EXAMPLE_URL,
     EXTERNAL_FOLDER_PATH,
     RAW_FOLDER_PATH,
+    INTERIM_FOLDER_PATH,
 )
-from chesswinnerprediction import download_pgn_zst_file, pgn_zst_to_dataframe
+from chesswinnerprediction import download_pgn_zst_file, pgn_zst_to_dataframe, pgn_zst_to_features
+from chesswinnerprediction.dataloader.download_pgn_zst import open_url_stream
+from chesswinnerprediction.dataloader.game_filter import GameFilter
 
 
-def main(url, split_size):
+def build_game_filter(args):
+    filter_args = {
+        "events": args.events,
+        "time_controls": args.time_controls,
+        "min_elo": args.min_elo,
+        "max_elo": args.max_elo,
+        "exclude_results": args.exclude_results,
+    }
+    if all(value is None for value in filter_args.values()):
+        return None
+    return GameFilter(**filter_args)
+
+
+def main(args):
+    url = args.url
     date = url.split("_")[-1].replace(".pgn.zst", "")
     if date < MIN_DATE:
         raise ValueError(
             f"Data in {date} does not contain 'clk' and 'eval' data. You must use data from {MIN_DATE} or later!"
         )
 
-    file_path = download_pgn_zst_file(url, EXTERNAL_FOLDER_PATH)
-    file_name = os.path.basename(file_path)
+    if args.stream:
+        # games are decoded while the file is being downloaded
+        source = open_url_stream(url, EXTERNAL_FOLDER_PATH)
+    else:
+        source = nullcontext(download_pgn_zst_file(url, EXTERNAL_FOLDER_PATH, args.n_segments))
+    file_name = os.path.basename(url)
+    game_filter = build_game_filter(args)
 
-    csv_files_dir_name = file_name.replace(".pgn.zst", "")
-    csv_files_dir = os.path.join(RAW_FOLDER_PATH, str(csv_files_dir_name))
-    if os.path.exists(csv_files_dir):
-        raise ValueError(f"To process {file_name} again, delete the directory: {csv_files_dir}")
+    with source as pgn_zst:
+        if args.features_only:
+            if not os.path.exists(INTERIM_FOLDER_PATH):
+                os.makedirs(INTERIM_FOLDER_PATH)
+            features_file_name = file_name.replace(".pgn.zst", f".{args.output_format}")
+            features_file_path = os.path.join(INTERIM_FOLDER_PATH, features_file_name)
+            pgn_zst_to_features(
+                pgn_zst, features_file_path, n_jobs=args.n_jobs, game_filter=game_filter
+            )
+            return
 
-    os.makedirs(csv_files_dir)
+        csv_files_dir_name = file_name.replace(".pgn.zst", "")
+        csv_files_dir = os.path.join(RAW_FOLDER_PATH, str(csv_files_dir_name))
+        if os.path.exists(csv_files_dir) and not args.resume:
+            raise ValueError(
+                f"To process {file_name} again, delete the directory: {csv_files_dir}"
+            )
 
-    pgn_zst_to_dataframe(file_path, csv_files_dir, split_size=split_size)
+        os.makedirs(csv_files_dir, exist_ok=True)
+
+        index_path = os.path.join(
+            EXTERNAL_FOLDER_PATH, file_name.replace(".pgn.zst", ".index.parquet")
+        )
+        pgn_zst_to_dataframe(
+            pgn_zst,
+            csv_files_dir,
+            split_size=args.split_size,
+            n_jobs=args.n_jobs,
+            output_format=args.output_format,
+            resume=args.resume,
+            index_path=index_path if os.path.exists(index_path) else None,
+            game_filter=game_filter,
+        )
 
 
 if __name__ == "__main__":
@@ -44,10 +92,60 @@ if __name__ == "__main__":
         default=125000,
         help="Size to split the PGN files into. Default: 125000",
     )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=1,
+        help="Number of processes to parse the PGN file with (0 - all cores). Default: 1",
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="Format of the saved shards. Default: csv",
+    )
+    parser.add_argument(
+        "--features_only",
+        action="store_true",
+        help=f"Skip the raw shards and write processed games to {INTERIM_FOLDER_PATH}",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from the last saved shard",
+    )
+    parser.add_argument(
+        "--n_segments",
+        type=int,
+        default=1,
+        help="Number of byte ranges to download in parallel. Default: 1",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Start decoding games while the file is being downloaded",
+    )
+    parser.add_argument(
+        "--events",
+        nargs="+",
+        help='Keep only these events, e.g. "Rated Blitz game" "Rated Blitz tournament"',
+    )
+    parser.add_argument(
+        "--time_controls",
+        nargs="+",
+        help="Keep only these time controls, e.g. 180+0 300+3",
+    )
+    parser.add_argument("--min_elo", type=int, help="Minimal rating of both players")
+    parser.add_argument("--max_elo", type=int, help="Maximal rating of both players")
+    parser.add_argument(
+        "--exclude_results",
+        nargs="+",
+        help='Drop games with these results, e.g. "*" for unfinished games',
+    )
     args = parser.parse_args()
 
     try:
-        main(args.url, args.split_size)
+        main(args)
     except Exception as e:
         print(f"Error: {e}")
         exit(1)
@@ -0,0 +1,105 @@
+import os
+import argparse
+
+from chesswinnerprediction.constants import MIN_DATE, RAW_FOLDER_PATH
+from chesswinnerprediction.processing.ingest_archives import ArchiveIngestion, archive_months
+
+DEFAULT_MANIFEST_PATH = os.path.join(RAW_FOLDER_PATH, "ingestion_manifest.json")
+
+
+def main(args):
+    months = archive_months(args.start_month, args.end_month)
+    os.makedirs(os.path.dirname(os.path.abspath(args.manifest_path)), exist_ok=True)
+
+    ingestion = ArchiveIngestion(
+        args.manifest_path,
+        max_downloads=args.max_downloads,
+        n_cpus=args.n_cpus,
+        memory_gb=args.memory_gb,
+        n_jobs=args.n_jobs,
+        split_size=args.split_size,
+        output_format=args.output_format,
+        n_segments=args.n_segments,
+        delete_archives=args.delete_archives,
+    )
+    failed_months = ingestion.run(months)
+    if failed_months:
+        raise ValueError(f"Failed months: {failed_months}, run the script again to retry them")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Download and process a range of monthly archives."
+    )
+    parser.add_argument(
+        "start_month",
+        nargs="?",
+        default=MIN_DATE,
+        help=f"First month as YYYY-MM. Default: {MIN_DATE}",
+    )
+    parser.add_argument(
+        "end_month",
+        nargs="?",
+        default=None,
+        help="Last month as YYYY-MM. Default: the previous month",
+    )
+    parser.add_argument(
+        "--manifest_path",
+        type=str,
+        default=DEFAULT_MANIFEST_PATH,
+        help=f"Progress file, rerun with the same file to skip finished work. Default: {DEFAULT_MANIFEST_PATH}",
+    )
+    parser.add_argument(
+        "--max_downloads",
+        type=int,
+        default=2,
+        help="Number of archives downloaded at once. Default: 2",
+    )
+    parser.add_argument(
+        "--n_cpus",
+        type=int,
+        default=None,
+        help="Number of cores for decoding and processing. Default: all cores",
+    )
+    parser.add_argument(
+        "--memory_gb",
+        type=float,
+        default=8,
+        help="Memory budget for decoding and processing. Default: 8",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=4,
+        help="Number of processes of one decode or process job. Default: 4",
+    )
+    parser.add_argument(
+        "--split_size",
+        type=int,
+        default=125000,
+        help="Number of games in one raw shard. Default: 125000",
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="Format of the raw shards and processed files. Default: csv",
+    )
+    parser.add_argument(
+        "--n_segments",
+        type=int,
+        default=1,
+        help="Number of byte ranges to download in parallel for one archive. Default: 1",
+    )
+    parser.add_argument(
+        "--delete_archives",
+        action="store_true",
+        help="Delete a .pgn.zst archive once it is decoded",
+    )
+    args = parser.parse_args()
+
+    try:
+        main(args)
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
@@ -3,15 +3,19 @@ import argparse
 
 from chesswinnerprediction.constants import RAW_FOLDER_PATH, EXAMPLE_CSV_DIR, INTERIM_FOLDER_PATH
 from chesswinnerprediction import process_and_concat_raw_data
+from chesswinnerprediction.processing.processing_cache import ProcessingCache
 
+DEFAULT_CACHE_DIR = os.path.join(INTERIM_FOLDER_PATH, "processing_cache")
 
-def main(dir_name):
+
+def main(dir_name, output_format, ordered, cache_dir, cache_size_gb):
     if not os.path.exists(INTERIM_FOLDER_PATH):
         os.makedirs(INTERIM_FOLDER_PATH)
 
     file_name = os.path.basename(dir_name)
-    file_path = os.path.join(INTERIM_FOLDER_PATH, file_name + ".csv")
-    process_and_concat_raw_data(dir_name, file_path)
+    file_path = os.path.join(INTERIM_FOLDER_PATH, f"{file_name}.{output_format}")
+    cache = ProcessingCache(cache_dir, cache_size_gb) if cache_dir else None
+    process_and_concat_raw_data(dir_name, file_path, ordered=ordered, cache=cache)
 
 
 if __name__ == "__main__":
@@ -22,10 +26,33 @@ if __name__ == "__main__":
         default=EXAMPLE_CSV_DIR,
         help=f"Directory name in {RAW_FOLDER_PATH} to process. Default: {EXAMPLE_CSV_DIR}",
     )
+    parser.add_argument(
+        "--output_format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="Format of the processed file. Default: csv",
+    )
+    parser.add_argument(
+        "--ordered",
+        action="store_true",
+        help="Write the shards in their index order instead of the order they are processed in",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help=f"Cache of processed shards, empty string - no cache. Default: {DEFAULT_CACHE_DIR}",
+    )
+    parser.add_argument(
+        "--cache_size_gb",
+        type=float,
+        default=10,
+        help="Size limit of the cache, least recently used shards are deleted. Default: 10",
+    )
     args = parser.parse_args()
 
     try:
-        main(args.dir_name)
+        main(args.dir_name, args.output_format, args.ordered, args.cache_dir, args.cache_size_gb)
     except Exception as e:
         print(f"Error: {e}")
         exit(1)
@@ -1,18 +1,30 @@
 import os
 import argparse
 
-import pandas as pd
-from sklearn.model_selection import train_test_split
+from chesswinnerprediction.constants import PROCESSED_FOLDER_PATH, INTERIM_FOLDER_PATH, EXAMPLE_NAME, DRAW_STR
+from chesswinnerprediction.processing.data_split import SPLIT_NAMES, split_file
+from chesswinnerprediction.processing.sampling import ReservoirSampler
+from chesswinnerprediction.processing.utils import write_data_file
 
-from chesswinnerprediction.constants import PROCESSED_FOLDER_PATH, INTERIM_FOLDER_PATH, EXAMPLE_NAME
 
-
-def split_csv(file_path, train_size, valid_size, test_size, random_state):
+def split_csv(
+    file_path,
+    train_size,
+    valid_size,
+    test_size,
+    random_state,
+    mode,
+    key_column,
+    chunk_size,
+    sample_sizes=None,
+    stratify_by=None,
+    draw_weight=1.0,
+):
     if not os.path.exists(PROCESSED_FOLDER_PATH):
         os.makedirs(PROCESSED_FOLDER_PATH)
 
     csv_file_name = os.path.basename(file_path)
-    processed_file_dir, _ = csv_file_name.split(".")
+    processed_file_dir, file_format = csv_file_name.split(".")
     processed_dir_path = os.path.join(PROCESSED_FOLDER_PATH, processed_file_dir)
 
     if not os.path.exists(processed_dir_path):
@@ -20,19 +32,32 @@ def split_csv(file_path, train_size, valid_size, test_size, random_state):
     else:
         raise ValueError(f"Processed data already exists at: {processed_dir_path}.\nDelete directory to process again.")
 
-    print(f"Reading data from {file_path}")
-    df = pd.read_csv(file_path)
+    print(f"Splitting data from {file_path} by {key_column if mode == 'hash' else 'game order'} into: "
+          f"\nTrain: {train_size}\nValidation: {valid_size}\nTest: {test_size}")
 
-    print(f"Splitting data into: \nTrain: {train_size}\nValidation: {valid_size}\nTest: {test_size}")
+    train_sampler = None
+    if sample_sizes:
+        weights = {"Result": {DRAW_STR: draw_weight}} if draw_weight != 1 else None
+        train_sampler = ReservoirSampler(max(sample_sizes), stratify_by, weights, random_state)
 
-    train_df, temp_df = train_test_split(df, train_size=train_size, random_state=random_state)
-    valid_size_relative = valid_size / (valid_size + test_size)
-    valid_df, test_df = train_test_split(temp_df, train_size=valid_size_relative, random_state=random_state)
+    output_paths = [os.path.join(str(processed_dir_path), f"{name}.{file_format}") for name in SPLIT_NAMES]
+    split_counts = split_file(
+        file_path,
+        output_paths,
+        [train_size, valid_size, test_size],
+        mode=mode,
+        key_column=key_column,
+        random_state=random_state,
+        chunk_size=chunk_size,
+        train_sampler=train_sampler,
+    )
+    for name, n_games in zip(SPLIT_NAMES, split_counts):
+        print(f"Saved {n_games} {name} games to {processed_dir_path}")
 
-    print(f"Saving data to {processed_dir_path}")
-    train_df.to_csv(os.path.join(str(processed_dir_path), "train.csv"), index=False)
-    valid_df.to_csv(os.path.join(str(processed_dir_path), "valid.csv"), index=False)
-    test_df.to_csv(os.path.join(str(processed_dir_path), "test.csv"), index=False)
+    for sample_size in sample_sizes or []:
+        sample = train_sampler.sample(sample_size)
+        write_data_file(sample, os.path.join(str(processed_dir_path), f"train_sample_{sample_size}.{file_format}"))
+        print(f"Saved a sample of {len(sample)} train games to {processed_dir_path}")
 
 
 if __name__ == "__main__":
@@ -47,7 +72,7 @@ if __name__ == "__main__":
         "--file_path",
         type=str,
         default=os.path.join(INTERIM_FOLDER_PATH, EXAMPLE_NAME + ".csv"),
-        help="Path to the input CSV file"
+        help="Path to the input .csv or .parquet file"
     )
     parser.add_argument(
         "--train_size",
@@ -66,6 +91,45 @@ if __name__ == "__main__":
         default=0.07,
         help="Test split size(default: 0.15)"
     )
+    parser.add_argument(
+        "--mode",
+        choices=["hash", "time"],
+        default="hash",
+        help="hash - split by the hash of --key_column, time - earliest games to train, "
+             "latest to test, the file has to be in game order (default: hash)"
+    )
+    parser.add_argument(
+        "--key_column",
+        type=str,
+        default="Site",
+        help="Column to hash, Site - split by game, White - keep the games of a player together "
+             "(default: Site)"
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=125000,
+        help="Number of games read at once (default: 125000)"
+    )
+    parser.add_argument(
+        "--sample_sizes",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Also write train_sample_{size} files, nested samples of the train split (default: none)"
+    )
+    parser.add_argument(
+        "--stratify_by",
+        nargs="+",
+        default=None,
+        help="Columns to stratify the samples by, e.g. Result Event EloBand (default: none)"
+    )
+    parser.add_argument(
+        "--draw_weight",
+        type=float,
+        default=1.0,
+        help="Oversampling weight of draws in the samples, needs Result in --stratify_by (default: 1)"
+    )
 
     args = parser.parse_args()
 
@@ -73,6 +137,18 @@ if __name__ == "__main__":
         if args.train_size + args.valid_size + args.test_size != 1.0:
             raise ValueError("The sum of train_size, valid_size, and test_size must be 1.")
 
-        split_csv(args.file_path, args.train_size, args.valid_size, args.test_size, args.random_state)
+        split_csv(
+            args.file_path,
+            args.train_size,
+            args.valid_size,
+            args.test_size,
+            args.random_state,
+            args.mode,
+            args.key_column,
+            args.chunk_size,
+            args.sample_sizes,
+            args.stratify_by,
+            args.draw_weight,
+        )
     except ValueError as e:
         print(f"Error: {e}")
@@ -0,0 +1,121 @@
+import os
+import argparse
+
+from chesswinnerprediction.constants import PROCESSED_FOLDER_PATH, EXAMPLE_NAME
+from chesswinnerprediction.processing.target_encoding import (
+    ENCODED_COLUMNS,
+    TargetEncodingStore,
+    apply_target_encoding,
+    fit_target_encoding,
+)
+
+SPLITS = ["train", "valid", "test"]
+
+
+def merge_into_history(store, history_path):
+    """Adds the counts of a month to the store of all months, each month at most once."""
+    if not os.path.exists(history_path):
+        history = TargetEncodingStore(store.columns, store.targets, store.smoothing)
+    else:
+        history = TargetEncodingStore.load(history_path)
+        if history.columns != store.columns or history.smoothing != store.smoothing:
+            raise ValueError(
+                f"{history_path} encodes {history.columns} with smoothing {history.smoothing}, "
+                f"not {store.columns} with smoothing {store.smoothing}"
+            )
+    if set(store.sources) <= set(history.sources):
+        print(f"The counts of {store.sources} are already in {history_path}, not added again")
+        return history
+
+    history.merge(store)
+    history.save(history_path)
+    print(f"Saved the counts of {history.n_games} training games of {history.sources}")
+    return history
+
+
+def main(dir_path, output_format, store_path, history_path, columns, smoothing, chunk_size):
+    store_path = store_path or os.path.join(dir_path, "target_encoding.json")
+    # always a fresh fit of this month's training games, so a rerun does not count them twice
+    month = os.path.basename(os.path.normpath(dir_path))
+    store = fit_target_encoding(
+        [os.path.join(dir_path, f"train.{output_format}")],
+        chunk_size=chunk_size,
+        columns=columns,
+        smoothing=smoothing,
+        sources=[month],
+    )
+    store.save(store_path)
+    print(f"Saved the counts of {store.n_games} training games to {store_path}")
+
+    if history_path is not None:
+        store = merge_into_history(store, history_path)
+
+    for split in SPLITS:
+        input_file = os.path.join(dir_path, f"{split}.{output_format}")
+        output_file = os.path.join(dir_path, f"{split}_encoded.{output_format}")
+        apply_target_encoding(store, input_file, output_file, chunk_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Encode categorical columns with result probabilities of the training split."
+    )
+    parser.add_argument(
+        "dir_path",
+        nargs="?",
+        default=os.path.join(PROCESSED_FOLDER_PATH, EXAMPLE_NAME),
+        help="Directory with the train, valid and test files of split_data.py",
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="Format of the split files. Default: csv",
+    )
+    parser.add_argument(
+        "--store_path",
+        type=str,
+        default=None,
+        help="Counts file of this month, it is overwritten. "
+        "Default: target_encoding.json in dir_path",
+    )
+    parser.add_argument(
+        "--history_path",
+        type=str,
+        default=None,
+        help="Counts file of several months, this month is added to it once and the splits are "
+        "encoded with it. Default: only this month's counts are used",
+    )
+    parser.add_argument(
+        "--columns",
+        nargs="+",
+        default=ENCODED_COLUMNS,
+        help=f"Columns to encode. Default: {' '.join(ENCODED_COLUMNS)}",
+    )
+    parser.add_argument(
+        "--smoothing",
+        type=float,
+        default=20,
+        help="Number of prior games added to every category. Default: 20",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=125000,
+        help="Number of games read at once. Default: 125000",
+    )
+    args = parser.parse_args()
+
+    try:
+        main(
+            args.dir_path,
+            args.output_format,
+            args.store_path,
+            args.history_path,
+            args.columns,
+            args.smoothing,
+            args.chunk_size,
+        )
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)